@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# Columns kept in the snapshot, anything else is loaded from the database on first access.
+# Listed in the model's field order, which Model.from_db expects
+SNAPSHOT_FIELDS = ("id", "is_superuser", "username", "is_staff", "is_active")
+
+
+def _snapshot_key(user_id):
+    return f"users:auth_snapshot:{user_id}"
+
+
+def invalidate_user_snapshot(user_id):
+    key = _snapshot_key(user_id)
+    cache.delete(key)
+    # Again after commit, a concurrent request may have cached the old row in between
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that builds request.user from a cached snapshot of the user row.
+
+    The token is validated as usual, then the user is read from the cache for up to
+    AUTH_USER_SNAPSHOT_SECONDS instead of with a SELECT on every request. The snapshot is
+    dropped whenever the user is saved or deleted (profile updates, password changes,
+    deactivation), see accounts.signals.
+
+    request.user only has the SNAPSHOT_FIELDS loaded, the other fields are deferred and
+    cost a query if a view reads them.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        key = _snapshot_key(user_id)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            row = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values_list(
+                *SNAPSHOT_FIELDS, "password"
+            ).first()
+            if row is None:
+                raise AuthenticationFailed("User not found", code="user_not_found")
+            # Only a digest of the password hash is kept, for CHECK_REVOKE_TOKEN
+            snapshot = (row[:-1], get_md5_hash_password(row[-1]))
+            cache.set(key, snapshot, settings.AUTH_USER_SNAPSHOT_SECONDS)
+
+        values, password_digest = snapshot
+        user = User.from_db(DEFAULT_DB_ALIAS, SNAPSHOT_FIELDS, values)
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if (
+            api_settings.CHECK_REVOKE_TOKEN
+            and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password_digest
+        ):
+            raise AuthenticationFailed("The user's password has been changed.", code="password_changed")
+        return user
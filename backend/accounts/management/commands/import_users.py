@@ -0,0 +1,170 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from accounts.models import UserProfile
+
+USERNAME_MAX_LENGTH = User._meta.get_field("username").max_length
+
+
+def _init_worker():
+    # Only needed when the pool spawns instead of forking
+    django.setup()
+
+
+def _hash_password(password):
+    return make_password(password)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates users and their profiles from a CSV or NDJSON file with username, password, "
+        "email and location columns. Usernames that already exist are skipped, so an "
+        "interrupted import can simply be run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file with a header row, or NDJSON (one object per line).")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "ndjson"],
+            help="File format, guessed from the extension by default.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Users inserted per transaction.")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Processes hashing passwords, 0 hashes in this process.",
+        )
+
+    def handle(self, *args, **options):
+        file_format = options["format"] or ("ndjson" if options["path"].endswith((".ndjson", ".jsonl")) else "csv")
+        self.imported = self.skipped = 0
+        self.started = time.perf_counter()
+
+        executor = ProcessPoolExecutor(options["workers"], initializer=_init_worker) if options["workers"] else None
+        try:
+            with open(options["path"], newline="", encoding="utf-8") as source:
+                rows = self._read(source, file_format)
+                pending = None
+                while chunk := list(islice(rows, options["batch_size"])):
+                    # The previous chunk isn't inserted yet, its usernames count as taken
+                    taken = {user["username"] for user in pending[0]} if pending is not None else set()
+                    users = self._new_users(chunk, taken)
+                    # Hash this chunk in the pool while the previous one is inserted
+                    passwords = [user["password"] for user in users]
+                    if executor is not None:
+                        chunksize = max(1, len(passwords) // (options["workers"] * 4))
+                        hashes = executor.map(_hash_password, passwords, chunksize=chunksize)
+                    else:
+                        hashes = map(_hash_password, passwords)
+                    if pending is not None:
+                        self._insert(*pending)
+                    pending = (users, hashes, chunk[-1][0])
+                if pending is not None:
+                    self._insert(*pending)
+        except (OSError, csv.Error) as e:
+            raise CommandError(f"Could not read {options['path']}: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {self.imported} users, skipped {self.skipped} in {elapsed:.1f}s "
+                f"({self.imported / elapsed if elapsed else 0:.0f} users/s)."
+            )
+        )
+
+    def _read(self, source, file_format):
+        """Yields (line number, row dict), rows that can't be parsed are reported and skipped."""
+        if file_format == "csv":
+            reader = csv.DictReader(source)
+            for row in reader:
+                yield reader.line_num, row
+            return
+
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                self._skip(line_number, f"invalid JSON ({e})")
+                continue
+            if not isinstance(row, dict):
+                self._skip(line_number, "not an object")
+                continue
+            yield line_number, row
+
+    def _new_users(self, chunk, taken):
+        """The valid rows of chunk whose username isn't taken yet."""
+        users = {}
+        for line_number, row in chunk:
+            username = (row.get("username") or "").strip()
+            if not username or len(username) > USERNAME_MAX_LENGTH:
+                self._skip(line_number, "missing or too long username")
+                continue
+            if username in users or username in taken:
+                self._skip(line_number, f"duplicate username {username}")
+                continue
+            users[username] = {
+                "username": username,
+                # No password means an unusable one, the user signs in after a reset
+                "password": row.get("password") or None,
+                "email": (row.get("email") or "").strip(),
+                "location": (row.get("location") or "").strip(),
+            }
+
+        # Rows imported by an earlier, interrupted run
+        existing = set(User.objects.filter(username__in=users).values_list("username", flat=True))
+        self.skipped += len(existing)
+        return [user for username, user in users.items() if username not in existing]
+
+    def _insert(self, users, hashes, last_line):
+        # Users and profiles go in together, a chunk is either fully imported or not at all
+        try:
+            self._bulk_create(users, hashes)
+        except IntegrityError as e:
+            raise CommandError(
+                f"Import stopped in the chunk ending at line {last_line} ({e}), "
+                f"{self.imported} users were imported. Run it again to resume."
+            )
+
+        self.imported += len(users)
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"Line {last_line}: {self.imported} imported, {self.skipped} skipped, "
+            f"{self.imported / elapsed if elapsed else 0:.0f} users/s"
+        )
+
+    @staticmethod
+    @transaction.atomic
+    def _bulk_create(users, hashes):
+        created = User.objects.bulk_create(
+            [
+                User(username=user["username"], email=user["email"], password=password)
+                for user, password in zip(users, hashes)
+            ]
+        )
+        UserProfile.objects.bulk_create(
+            [
+                UserProfile(user=user, location=row["location"], image=None)
+                for user, row in zip(created, users)
+            ]
+        )
+
+    def _skip(self, line_number, reason):
+        self.skipped += 1
+        self.stderr.write(f"Skipping line {line_number}: {reason}")
@@ -1,3 +1,4 @@
+from api.storage import image_storage
 from django.contrib.auth.models import User
 from django.db import models
 
@@ -5,7 +6,9 @@ from django.db import models
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     location = models.CharField(max_length=50, null=True, blank=True)
-    image = models.ImageField(upload_to="profile_images/", null=True, blank=True)
+    image = models.ImageField(upload_to="profile_images/", storage=image_storage, null=True, blank=True)
+    # Resized copies of image, {"200": {"webp": name, "jpeg": name}, ...}
+    image_variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return self.user.username
@@ -17,3 +20,30 @@ class UserBlock(models.Model):
         User, on_delete=models.CASCADE, related_name="blocked_by"
     )
     
+
+
+class AccountDeletionJob(models.Model):
+    """Progress of a deleted account's purge, see accounts.services.deletion_services.
+
+    The user is deactivated straight away and their rows are removed in batches by
+    accounts.tasks.purge_user_account. Not a foreign key, the job outlives the user row.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    STATUS_CHOICES = [(PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done")]
+
+    user_id = models.BigIntegerField(unique=True)
+    username = models.CharField(max_length=150)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # The stage being worked through, and rows deleted so far per stage
+    stage = models.CharField(max_length=50, blank=True)
+    deleted = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.username} ({self.status})"
@@ -1,12 +1,16 @@
+from api.serializers import ImageVariantsField, SniffedImageField
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import UserProfile
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
+    image = SniffedImageField(required=False, allow_null=True)
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = UserProfile
-        fields = ["location", "image"]
+        fields = ["location", "image", "image_variants"]
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -18,8 +22,27 @@ class UserSerializer(serializers.ModelSerializer):
         extra_kwargs = {"password": {"write_only": True}}
 
     def to_representation(self, instance):
-        """Customize the serialized response to include nested profile data."""
+        """Customize the serialized response to include nested profile data.
+
+        Views load the profile with select_related("profile"), so this doesn't query.
+        """
         representation = super().to_representation(instance)
         if hasattr(instance, "profile"):
             representation["profile"] = UserProfileSerializer(instance.profile).data
         return representation
+
+
+class PublicProfileSerializer(serializers.Serializer):
+    """Compact profile shown on seller cards, rendered from UserService.get_public_profiles."""
+
+    id = serializers.IntegerField()
+    username = serializers.CharField()
+    location = serializers.CharField(allow_null=True)
+    avatar = serializers.SerializerMethodField()
+    listing_count = serializers.IntegerField()
+
+    def get_avatar(self, profile):
+        request = self.context.get("request")
+        if profile["avatar"] and request is not None:
+            return request.build_absolute_uri(profile["avatar"])
+        return profile["avatar"]
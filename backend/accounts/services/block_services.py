@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from accounts.models import UserBlock
+
+
+class BlockService:
+    """Block lookups served from the cache.
+
+    For each user the cache holds two id sets: the users they blocked and the users who
+    blocked them. Feeds and messaging exclude both, so checking a block is a set membership
+    test and filtering a queryset is a NOT IN over a short literal list instead of a
+    subquery. The entries are dropped whenever a UserBlock row involving the user is saved
+    or deleted, and expire after BLOCK_CACHE_SECONDS for processes that don't share the cache.
+    """
+
+    @staticmethod
+    def _blocked_key(user_id):
+        return f"blocks:blocked:{user_id}"
+
+    @staticmethod
+    def _blocked_by_key(user_id):
+        return f"blocks:blocked_by:{user_id}"
+
+    @classmethod
+    def _block_sets(cls, user_id):
+        """(blocked, blocked_by) for user_id, from one cache round trip when both are cached."""
+        blocked_key, blocked_by_key = cls._blocked_key(user_id), cls._blocked_by_key(user_id)
+        cached = cache.get_many([blocked_key, blocked_by_key])
+
+        missing = {}
+        if blocked_key not in cached:
+            missing[blocked_key] = frozenset(
+                UserBlock.objects.filter(user_id=user_id).values_list("blocked_user_id", flat=True)
+            )
+        if blocked_by_key not in cached:
+            missing[blocked_by_key] = frozenset(
+                UserBlock.objects.filter(blocked_user_id=user_id).values_list("user_id", flat=True)
+            )
+        if missing:
+            cache.set_many(missing, settings.BLOCK_CACHE_SECONDS)
+            cached.update(missing)
+        return cached[blocked_key], cached[blocked_by_key]
+
+    @classmethod
+    def blocked_ids(cls, user_id) -> frozenset:
+        """Ids of the users user_id has blocked."""
+        return cls._block_sets(user_id)[0]
+
+    @classmethod
+    def blocked_by_ids(cls, user_id) -> frozenset:
+        """Ids of the users who have blocked user_id."""
+        return cls._block_sets(user_id)[1]
+
+    @classmethod
+    def hidden_user_ids(cls, user_id) -> frozenset:
+        """Ids of the users user_id shouldn't see or exchange messages with, either way round."""
+        blocked, blocked_by = cls._block_sets(user_id)
+        return blocked | blocked_by
+
+    @classmethod
+    def is_blocked_by(cls, user_id, other_user_id) -> bool:
+        """Whether other_user_id has blocked user_id."""
+        return other_user_id in cls.blocked_by_ids(user_id)
+
+    @classmethod
+    def is_blocked_between(cls, user_id, other_user_id) -> bool:
+        """Whether either user has blocked the other."""
+        return other_user_id in cls.hidden_user_ids(user_id)
+
+    @staticmethod
+    def block(user, blocked_user) -> bool:
+        _, created = UserBlock.objects.get_or_create(user=user, blocked_user=blocked_user)
+        return created
+
+    @staticmethod
+    def unblock(user, blocked_user) -> bool:
+        deleted, _ = UserBlock.objects.filter(user=user, blocked_user=blocked_user).delete()
+        return deleted > 0
+
+    @classmethod
+    def invalidate(cls, block):
+        keys = [cls._blocked_key(block.user_id), cls._blocked_by_key(block.blocked_user_id)]
+        cache.delete_many(keys)
+        # Again after commit, a concurrent read may have cached the old rows in between
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from accounts.models import AccountDeletionJob, UserBlock, UserProfile
+from listings.models import Listing, SavedListing
+from listings.services.ranking_services import HotScoreService
+from user_messages.models import ArchivedMessage, Conversation, InboxCounter, Message
+from user_messages.services.message_services import MessageService
+
+
+class AccountDeletionService:
+    """Removes a deleted account's rows in bounded batches.
+
+    Each batch is deleted in its own short transaction together with the job's progress,
+    so SQLite is never locked for long and a retried job picks up where it stopped. Every
+    batch re-selects what is left, which makes running a stage twice harmless. Deleting
+    rows with an image releases their StoredBlob references, the files themselves are
+    removed by api.tasks.collect_unreferenced_blobs.
+    """
+
+    @staticmethod
+    def _stages(user_id):
+        # Dependents first, each stage only ever cascades into a bounded set of rows
+        return [
+            ("messages", Message, Q(sender_id=user_id) | Q(receiver_id=user_id), None),
+            ("archived_messages", ArchivedMessage, Q(sender_id=user_id) | Q(receiver_id=user_id), None),
+            (
+                "conversations",
+                Conversation,
+                Q(user_one_id=user_id) | Q(user_two_id=user_id),
+                lambda ids: MessageService.discard_conversations(user_id, ids),
+            ),
+            ("saved_listings", SavedListing, Q(user_id=user_id), AccountDeletionService._delete_saved_listings),
+            ("listing_saves", SavedListing, Q(listing__author_id=user_id), None),
+            ("listings", Listing, Q(author_id=user_id), None),
+            ("blocks", UserBlock, Q(user_id=user_id) | Q(blocked_user_id=user_id), None),
+            ("inbox_counter", InboxCounter, Q(user_id=user_id), None),
+            ("profile", UserProfile, Q(user_id=user_id), None),
+        ]
+
+    @staticmethod
+    @transaction.atomic
+    def request_deletion(user):
+        """Deactivates the user and records the purge job, idempotent."""
+        if user.is_active:
+            user.is_active = False
+            user.save(update_fields=["is_active"])
+        job, _ = AccountDeletionJob.objects.get_or_create(
+            user_id=user.id, defaults={"username": user.username}
+        )
+        return job
+
+    @classmethod
+    def run(cls, job, batch_size=None):
+        """Works through the job's remaining stages, then deletes the user row itself."""
+        if job.status == AccountDeletionJob.DONE:
+            return job
+        batch_size = batch_size or settings.ACCOUNT_DELETION_BATCH_SIZE
+        AccountDeletionJob.objects.filter(id=job.id).update(
+            status=AccountDeletionJob.RUNNING, attempts=F("attempts") + 1
+        )
+        job.refresh_from_db()
+
+        for stage, model, condition, delete in cls._stages(job.user_id):
+            while True:
+                with transaction.atomic():
+                    ids = list(model.objects.filter(condition).values_list("pk", flat=True)[:batch_size])
+                    if not ids:
+                        break
+                    if delete is not None:
+                        delete(ids)
+                    else:
+                        # Deleted through the ORM so image references and caches are released
+                        model.objects.filter(pk__in=ids).delete()
+                    job.stage = stage
+                    job.deleted[stage] = job.deleted.get(stage, 0) + len(ids)
+                    job.save(update_fields=["stage", "deleted", "updated_at"])
+
+        with transaction.atomic():
+            User.objects.filter(id=job.user_id).delete()
+            job.stage = ""
+            job.status = AccountDeletionJob.DONE
+            job.completed_at = timezone.now()
+            job.save(update_fields=["stage", "status", "completed_at", "updated_at"])
+        return job
+
+    @staticmethod
+    def _delete_saved_listings(ids):
+        # Keep the saves counters of other users' listings in step
+        saved = list(SavedListing.objects.filter(pk__in=ids).values_list("listing_id", flat=True))
+        SavedListing.objects.filter(pk__in=ids).delete()
+        for listing_id in saved:
+            HotScoreService.mark_stale(listing_id, saves=F("saves") - 1)
@@ -1,11 +1,20 @@
+from django.conf import settings
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.db import transaction
+from django.db.models import Count
 
 from accounts.models import UserProfile
+from api.tasks import generate_image_derivatives, refresh_image_variants
 
 
 class UserService:
+    # Public profiles are also dropped on every change, the timeout only bounds how long a
+    # freshly generated avatar thumbnail takes to replace the original image
+    PUBLIC_PROFILE_CACHE_TIMEOUT = 10 * 60
+
     @staticmethod
     @transaction.atomic
     def create_user(username, password, email="", profile=None):
@@ -15,11 +24,13 @@ class UserService:
             password=make_password(password),
         )
         if profile:
-            UserProfile.objects.create(
+            user_profile = UserProfile.objects.create(
                 user=user,
                 location=profile.get("location"),
                 image=profile.get("image"),
             )
+            if user_profile.image:
+                generate_image_derivatives("accounts.UserProfile", user_profile.id)
         else:
             UserProfile.objects.create(
                 user=user,
@@ -43,16 +54,85 @@ class UserService:
         # If explicit profile with extra data is added - save the new profile data
         if profile:
             user_profile, _ = UserProfile.objects.get_or_create(user=user)
+            old_image_name = user_profile.image.name
             if "location" in profile:
                 user_profile.location = profile["location"]
             if "image" in profile:
                 user_profile.image = profile["image"]
             user_profile.save()
+            if user_profile.image.name != old_image_name:
+                refresh_image_variants(user_profile)
 
+        UserService.invalidate_public_profile(user.id)
         return user
 
     @staticmethod
     @transaction.atomic
     def delete_user(user_id):
+        """Deactivates the user now, their data is purged in batches by a background task."""
+        # Imported here, the purge depends on the listings and messaging services
+        from accounts.services.deletion_services import AccountDeletionService
+        from accounts.tasks import purge_user_account
+
         user = User.objects.get(id=user_id)
-        user.delete()
\ No newline at end of file
+        job = AccountDeletionService.request_deletion(user)
+        UserService.invalidate_public_profile(user.id)
+        purge_user_account(job.id)
+        return job
+
+    @staticmethod
+    def _public_profile_key(user_id):
+        return f"users:public_profile:{user_id}"
+
+    @classmethod
+    def get_public_profiles(cls, user_ids):
+        """Compact public profiles of active users, {user_id: profile}, served from the cache.
+
+        A profile holds the username, location, avatar thumbnail url and listing count.
+        Missing entries are built with one query for all of them.
+        """
+        keys = {cls._public_profile_key(user_id): user_id for user_id in user_ids}
+        profiles = {keys[key]: profile for key, profile in cache.get_many(keys).items()}
+
+        missing = [user_id for user_id in keys.values() if user_id not in profiles]
+        if missing:
+            users = (
+                User.objects.filter(id__in=missing, is_active=True)
+                .select_related("profile")
+                .annotate(listing_count=Count("listing"))
+            )
+            built = {user.id: cls._build_public_profile(user) for user in users}
+            cache.set_many(
+                {cls._public_profile_key(user_id): profile for user_id, profile in built.items()},
+                cls.PUBLIC_PROFILE_CACHE_TIMEOUT,
+            )
+            profiles.update(built)
+        return profiles
+
+    @staticmethod
+    def _build_public_profile(user):
+        profile = getattr(user, "profile", None)
+        avatar = None
+        if profile is not None and profile.image:
+            avatar = profile.image.url
+            # The smallest generated copy, in the preferred format, stands in for the original
+            if profile.image_variants:
+                formats = profile.image_variants[min(profile.image_variants, key=int)]
+                for image_format in settings.IMAGE_DERIVATIVE_FORMATS:
+                    if image_format in formats:
+                        avatar = default_storage.url(formats[image_format])
+                        break
+        return {
+            "id": user.id,
+            "username": user.username,
+            "location": profile.location if profile is not None else None,
+            "avatar": avatar,
+            "listing_count": user.listing_count,
+        }
+
+    @classmethod
+    def invalidate_public_profile(cls, user_id):
+        key = cls._public_profile_key(user_id)
+        cache.delete(key)
+        # Again after commit, a concurrent read may have cached the old row in between
+        transaction.on_commit(lambda: cache.delete(key))
@@ -1,7 +1,7 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from .models import UserBlock, UserProfile
 
 
 """
@@ -15,4 +15,44 @@ def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, "profile"):  # Ensure the UserProfile exists
         instance.profile.save()
 
-        """
\ No newline at end of file
+        """
+
+# Covers UserService.update_user and delete_user, password changes and deactivation
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_auth_snapshot(sender, instance, **kwargs):
+    from accounts.authentication import invalidate_user_snapshot
+
+    invalidate_user_snapshot(instance.id)
+
+
+@receiver(post_save, sender=UserBlock)
+@receiver(post_delete, sender=UserBlock)
+def invalidate_block_cache(sender, instance, **kwargs):
+    from accounts.services.block_services import BlockService
+
+    BlockService.invalidate(instance)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_public_profile(sender, instance, **kwargs):
+    from accounts.services.user_services import UserService
+
+    UserService.invalidate_public_profile(instance.user_id)
+
+
+# The listing count is part of the author's public profile
+@receiver(post_save, sender="listings.Listing")
+def invalidate_public_profile_on_listing_create(sender, instance, created, **kwargs):
+    from accounts.services.user_services import UserService
+
+    if created:
+        UserService.invalidate_public_profile(instance.author_id_id)
+
+
+@receiver(post_delete, sender="listings.Listing")
+def invalidate_public_profile_on_listing_delete(sender, instance, **kwargs):
+    from accounts.services.user_services import UserService
+
+    UserService.invalidate_public_profile(instance.author_id_id)
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, lock_task, on_commit_task
+
+from .models import AccountDeletionJob
+from .services.deletion_services import AccountDeletionService
+
+
+@on_commit_task(retries=3, retry_delay=60, priority=settings.TASK_PRIORITIES["cleanup"])
+def purge_user_account(job_id: int):
+    # Batched and resumable, a retry continues from the last committed batch
+    with lock_task(f"purge-user-account-{job_id}"):
+        try:
+            job = AccountDeletionJob.objects.get(id=job_id)
+        except AccountDeletionJob.DoesNotExist:
+            return None
+        return AccountDeletionService.run(job).deleted
+
+
+@db_periodic_task(crontab(minute="15"), priority=settings.TASK_PRIORITIES["cleanup"])
+def resume_account_deletions():
+    # Picks up purges whose task was lost or ran out of retries
+    stalled = AccountDeletionJob.objects.exclude(status=AccountDeletionJob.DONE).filter(
+        updated_at__lt=timezone.now() - timedelta(hours=1)
+    )
+    for job_id in stalled.values_list("id", flat=True):
+        purge_user_account(job_id)
@@ -1,15 +1,29 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-from accounts.models import UserBlock
+from accounts.models import AccountDeletionJob, UserBlock
 from accounts.models import UserProfile
+from accounts.services.deletion_services import AccountDeletionService
+from accounts.tasks import purge_user_account
+from listings.models import Listing, SavedListing
+from user_messages.models import Message
+from user_messages.services.message_services import MessageService
 
 
 # Base class with common setup
 class BaseUserTestCase(APITestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         # Create two users; user1 is the primary authenticated user
         self.user1 = User.objects.create_user(
@@ -90,9 +104,20 @@ class UpdateAccountTestCase(BaseUserTestCase):
 class DeleteAccountTestCase(BaseUserTestCase):
     def test_delete_account(self):
         url = reverse("user-detail", kwargs={"pk": self.user1.pk})
-        response = self.client.delete(url)
+        # The purge runs once the deactivation has committed
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+        self.assertEqual(AccountDeletionJob.objects.get(user_id=self.user1.pk).status, AccountDeletionJob.DONE)
+
+    def test_delete_account_deactivates_immediately(self):
+        url = reverse("user-detail", kwargs={"pk": self.user1.pk})
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.user1.refresh_from_db()
+        self.assertFalse(self.user1.is_active)
+        self.assertEqual(AccountDeletionJob.objects.get(user_id=self.user1.pk).status, AccountDeletionJob.PENDING)
 
     def test_delete_account_unauthenticated(self):
         self.client.logout()
@@ -179,6 +204,39 @@ class IsUserBlockedTestCase(BaseUserTestCase):
         self.assertIn("User is not blocked", response.data.get("detail", ""))
 
 
+class BlockedStatusTestCase(BaseUserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user3 = User.objects.create_user(username="user3", password="password123")
+        self.url = reverse("user-blocked-status")
+
+    def test_blocked_status(self):
+        self.client.post(reverse("user-block-user", kwargs={"pk": self.user2.pk}))
+        UserBlock.objects.create(user=self.user3, blocked_user=self.user1)
+
+        ids = f"{self.user2.pk},{self.user3.pk},{self.user1.pk}"
+        response = self.client.get(self.url, {"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"blocked": [self.user2.pk], "blocked_by": [self.user3.pk]})
+
+    def test_blocked_status_is_cached(self):
+        self.client.get(self.url, {"ids": self.user2.pk})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"ids": self.user2.pk})
+        self.assertEqual(response.data["blocked"], [])
+
+    def test_unblock_invalidates_cache(self):
+        block_url = reverse("user-block-user", kwargs={"pk": self.user2.pk})
+        self.client.post(block_url)
+        self.assertEqual(self.client.get(self.url, {"ids": self.user2.pk}).data["blocked"], [self.user2.pk])
+        self.client.post(reverse("user-unblock-user", kwargs={"pk": self.user2.pk}))
+        self.assertEqual(self.client.get(self.url, {"ids": self.user2.pk}).data["blocked"], [])
+
+    def test_blocked_status_invalid_ids(self):
+        response = self.client.get(self.url, {"ids": "2,abc"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class ListBlockedUsersTestCase(BaseUserTestCase):
     def test_list_blocked_users(self):
         # Block user2 and verify that list returns it
@@ -195,3 +253,178 @@ class ListBlockedUsersTestCase(BaseUserTestCase):
 
         blocked_ids = [user["id"] for user in response.data]
         self.assertIn(self.user2.pk, blocked_ids)
+
+
+class ListUsersTestCase(BaseUserTestCase):
+    def test_list_query_count_does_not_grow_with_users(self):
+        UserProfile.objects.create(user=self.user1, location="Here")
+        for i in range(5):
+            user = User.objects.create_user(username=f"extra{i}", password="password123")
+            UserProfile.objects.create(user=user, location="There")
+        # The page count and one joined query for the page, whatever its size
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("user-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["profile"]["location"], "Here")
+
+
+class PublicProfileTestCase(BaseUserTestCase):
+    def setUp(self):
+        super().setUp()
+        UserProfile.objects.create(user=self.user2, location="Campus")
+        self.url = reverse("user-public-profile", kwargs={"pk": self.user2.pk})
+
+    def test_public_profile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data,
+            {"id": self.user2.pk, "username": "user2", "location": "Campus", "avatar": None, "listing_count": 0},
+        )
+
+    def test_public_profile_is_cached(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data["username"], "user2")
+
+    def test_update_invalidates_public_profile(self):
+        self.client.get(reverse("user-public-profile", kwargs={"pk": self.user1.pk}))
+        self.client.patch(reverse("user-detail", kwargs={"pk": self.user1.pk}), {"username": "renamed"})
+        response = self.client.get(reverse("user-public-profile", kwargs={"pk": self.user1.pk}))
+        self.assertEqual(response.data["username"], "renamed")
+
+    def test_public_profiles_bulk(self):
+        url = reverse("user-public-profiles")
+        response = self.client.get(url, {"ids": f"{self.user2.pk},{self.user1.pk},999"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([profile["id"] for profile in response.data], [self.user2.pk, self.user1.pk])
+        self.assertIsNone(response.data[1]["location"])
+
+    def test_inactive_user_has_no_public_profile(self):
+        User.objects.filter(pk=self.user2.pk).update(is_active=False)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CachedAuthenticationTestCase(BaseUserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=None)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user1)}")
+        self.url = reverse("user-blocked-status")
+
+    def test_user_is_read_from_cache(self):
+        # The user row and the block sets on the first request, nothing after that
+        self.client.get(self.url, {"ids": self.user2.pk})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"ids": self.user2.pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+
+    def test_deactivation_invalidates_snapshot(self):
+        self.client.get(self.url)
+        self.user1.is_active = False
+        self.user1.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user_is_rejected(self):
+        self.client.get(self.url)
+        self.user1.delete()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_update_refreshes_snapshot(self):
+        self.client.get(self.url)
+        self.client.patch(reverse("user-detail", kwargs={"pk": self.user1.pk}), {"username": "renamed"})
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+
+class AccountPurgeTestCase(BaseUserTestCase):
+    def setUp(self):
+        super().setUp()
+        UserProfile.objects.create(user=self.user1, location="Here")
+        self.listings = [
+            Listing.objects.create(
+                title=f"Listing {i}", condition="FN", description="", price=1, image="listings/a.jpg",
+                author_id=self.user1,
+            )
+            for i in range(3)
+        ]
+        self.other_listing = Listing.objects.create(
+            title="Other", condition="FN", description="", price=1, image="listings/b.jpg", author_id=self.user2,
+        )
+        SavedListing.objects.create(user=self.user1, listing=self.other_listing)
+        SavedListing.objects.create(user=self.user2, listing=self.listings[0])
+        Listing.objects.filter(id=self.other_listing.id).update(saves=1)
+        for i in range(5):
+            MessageService.create_message(self.user1, self.user2, self.other_listing, f"Hi {i}")
+        UserBlock.objects.create(user=self.user2, blocked_user=self.user1)
+        self.job = AccountDeletionService.request_deletion(self.user1)
+
+    def test_purge_in_batches(self):
+        job = AccountDeletionService.run(self.job, batch_size=2)
+        self.assertEqual(job.status, AccountDeletionJob.DONE)
+        self.assertEqual(job.deleted["messages"], 5)
+        self.assertEqual(job.deleted["listings"], 3)
+        self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(list(Listing.objects.values_list("id", flat=True)), [self.other_listing.id])
+        self.other_listing.refresh_from_db()
+        self.assertEqual(self.other_listing.saves, 0)
+        # user2's unread messages from the departed user no longer count
+        self.assertEqual(MessageService.unread_count(self.user2), 0)
+
+    def test_purge_is_idempotent(self):
+        # A batch that already committed is not redone, and a finished job is a no-op
+        Message.objects.filter(sender=self.user1)[:1].get().delete()
+        AccountDeletionService.run(self.job)
+        job = AccountDeletionService.run(AccountDeletionJob.objects.get(id=self.job.id))
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.deleted["messages"], 4)
+
+    def test_task_runs_purge(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            purge_user_account(self.job.id)
+        self.assertFalse(User.objects.filter(pk=self.user1.pk).exists())
+
+
+class ImportUsersTestCase(APITestCase):
+    def _write(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, "w") as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def _import(self, path, **options):
+        out = StringIO()
+        call_command("import_users", path, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_import_csv(self):
+        path = self._write(
+            ".csv",
+            "username,password,email,location\n"
+            "alice,secret123,alice@example.com,North\n"
+            "bob,,bob@example.com,\n"
+            ",nopassword,,\n"
+            "alice,again,,\n",
+        )
+        output = self._import(path, workers=2, batch_size=2)
+        self.assertIn("Imported 2 users, skipped 2", output)
+        alice = User.objects.get(username="alice")
+        self.assertTrue(alice.check_password("secret123"))
+        self.assertEqual(alice.profile.location, "North")
+        self.assertFalse(User.objects.get(username="bob").has_usable_password())
+
+    def test_import_ndjson_resumes(self):
+        lines = [json.dumps({"username": f"user{i}", "password": "pw"}) for i in range(5)]
+        path = self._write(".ndjson", "\n".join(lines[:3]) + "\n")
+        self._import(path, workers=0)
+        # A rerun over the full file only creates the users that are missing
+        path = self._write(".ndjson", "\n".join(lines) + "\nnot json\n")
+        output = self._import(path, workers=0, batch_size=2)
+        self.assertIn("Imported 2 users, skipped 4", output)
+        self.assertEqual(UserProfile.objects.count(), 5)
@@ -1,24 +1,43 @@
+import logging
+
 from django.contrib.auth.models import User
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.parsers import FormParser, JSONParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 
+from accounts.services.block_services import BlockService
 from accounts.services.user_services import UserService
+from api.db_routers import ReplicaReadMixin
+from api.tasks import refresh_image_variants
+from api.uploads import StreamingImageMultiPartParser
 from accounts.models import UserProfile
 
 from accounts.models import UserBlock
-from .serializers import UserSerializer
+from .serializers import PublicProfileSerializer, UserSerializer
+
+logger = logging.getLogger(__name__)
 
+# Upper bound on the ids accepted by blocked_status
+MAX_BLOCKED_STATUS_IDS = 500
+# Upper bound on the ids accepted by public_profiles
+MAX_PUBLIC_PROFILE_IDS = 100
 
-class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
+
+class UserViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
+    # The profile is joined in, serializing a page of users is a single query
+    queryset = User.objects.select_related("profile").order_by("id")
     serializer_class = UserSerializer
+    # Profiles are served from a read replica when one is configured
+    replica_actions = {"list", "retrieve", "public_profile", "public_profiles"}
+    # Uploads stream to disk with early size and format checks
+    parser_classes = [JSONParser, StreamingImageMultiPartParser, FormParser]
 
     def get_permissions(self):
         # User must be authenticated if performing any action other than create/retrieve/list
-        self.permission_classes = ([AllowAny] if (self.action in ["create", "retrieve", "list"]) else [IsAuthenticated])
+        self.permission_classes = ([AllowAny] if (self.action in ["create", "retrieve", "list", "public_profile", "public_profiles"]) else [IsAuthenticated])
         return super().get_permissions()
 
     def create(self, request, *args, **kwargs):
@@ -56,7 +75,7 @@ class UserViewSet(viewsets.ModelViewSet):
 
             return Response(user_data, status=status.HTTP_201_CREATED)
         except Exception as e:
-            print(str(e))
+            logger.exception("User registration failed")
             return Response({"error": "An error occured"}, status=status.HTTP_400_BAD_REQUEST)
 
     def update(self, request, *args, **kwargs):
@@ -88,12 +107,15 @@ class UserViewSet(viewsets.ModelViewSet):
         profile, created = UserProfile.objects.get_or_create(user=instance, defaults={"location": "", "image": None})
 
         if profile:
+            old_image_name = profile.image.name
             # Explicit check for fields to be "None"
             if location is not None:
                 profile.location = location
             if image is not None:
                 profile.image = image
             profile.save()
+            if profile.image.name != old_image_name:
+                refresh_image_variants(profile)
 
         response_data = self.get_serializer(user).data
         return Response(response_data)
@@ -111,19 +133,17 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["post"], permission_classes=[IsAuthenticated])
     def block_user(self, request, pk=None):
         blocked_user = self.get_object()
-        block = UserBlock.objects.filter(user=request.user, blocked_user=blocked_user)
 
-        if block.exists():
+        if blocked_user == request.user:
             return Response(
-                {"detail": "User is already blocked."},
+                {"detail": "You can't block yourself."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        elif blocked_user == request.user:
+        if not BlockService.block(request.user, blocked_user):
             return Response(
-                {"detail": "You can't block yourself."},
+                {"detail": "User is already blocked."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        UserBlock.objects.create(user=request.user, blocked_user=blocked_user)
         return Response(
             {"detail": "User blocked successfully."}, status=status.HTTP_201_CREATED
         )
@@ -131,9 +151,7 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["post"], permission_classes=[IsAuthenticated])
     def unblock_user(self, request, pk=None):
         blocked_user = self.get_object()
-        block = UserBlock.objects.filter(user=request.user, blocked_user=blocked_user)
-        if block.exists():
-            block.delete()
+        if BlockService.unblock(request.user, blocked_user):
             return Response(
                 {"detail": "User unblocked successfully."},
                 status=status.HTTP_204_NO_CONTENT,
@@ -145,15 +163,75 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["get"], permission_classes=[IsAuthenticated])
     def is_user_blocked(self, request, pk=None):
         blocked_user = self.get_object()
-        is_blocked = UserBlock.objects.filter(
-            user=request.user, blocked_user=blocked_user
-        ).exists()
+        is_blocked = blocked_user.id in BlockService.blocked_ids(request.user.id)
         block_detail = "User is blocked." if is_blocked else "User is not blocked."
         return Response({"detail": block_detail}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["get"])
+    def public_profile(self, request, pk=None):
+        try:
+            user_id = int(pk)
+        except ValueError:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        profile = UserService.get_public_profiles([user_id]).get(user_id)
+        if profile is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(PublicProfileSerializer(profile, context={"request": request}).data)
+
+    # Full url example: /users/public_profiles/?ids=2,5,9
+    @action(detail=False, methods=["get"])
+    def public_profiles(self, request):
+        """Public profiles of several users at once, e.g. the authors on a page of listings."""
+        try:
+            user_ids = list(
+                dict.fromkeys(int(user_id) for user_id in request.query_params.get("ids", "").split(",") if user_id)
+            )
+        except ValueError:
+            return Response(
+                {"detail": "ids must be a comma separated list of user ids."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(user_ids) > MAX_PUBLIC_PROFILE_IDS:
+            return Response(
+                {"detail": f"At most {MAX_PUBLIC_PROFILE_IDS} ids can be requested at once."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        profiles = UserService.get_public_profiles(user_ids)
+        # Unknown and inactive users are left out
+        found = [profiles[user_id] for user_id in user_ids if user_id in profiles]
+        return Response(PublicProfileSerializer(found, many=True, context={"request": request}).data)
+
+    # Full url example: /users/blocked_status/?ids=2,5,9
+    @action(detail=False, methods=["get"], permission_classes=[IsAuthenticated])
+    def blocked_status(self, request):
+        """Which of the given users the current user blocked, and which blocked them."""
+        try:
+            user_ids = {int(user_id) for user_id in request.query_params.get("ids", "").split(",") if user_id}
+        except ValueError:
+            return Response(
+                {"detail": "ids must be a comma separated list of user ids."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(user_ids) > MAX_BLOCKED_STATUS_IDS:
+            return Response(
+                {"detail": f"At most {MAX_BLOCKED_STATUS_IDS} ids can be checked at once."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        blocked = BlockService.blocked_ids(request.user.id)
+        blocked_by = BlockService.blocked_by_ids(request.user.id)
+        return Response(
+            {
+                "blocked": sorted(user_ids & blocked),
+                "blocked_by": sorted(user_ids & blocked_by),
+            },
+            status=status.HTTP_200_OK,
+        )
+
     @action(detail=False, permission_classes=[IsAuthenticated])
     def list_blocked_users(self, request):
-        blocked_users = UserBlock.objects.filter(user=request.user)
+        blocked_users = UserBlock.objects.filter(user=request.user).select_related("blocked_user")
         blocked_user_data = [
             {"id": block.blocked_user.id, "username": block.blocked_user.username}
             for block in blocked_users
@@ -1,7 +1,13 @@
 #api/apps.py
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from api.signals import TRACKED_FILE_FIELDS, connect_blob_tracking
+
+        for model_label, field_name in TRACKED_FILE_FIELDS:
+            connect_blob_tracking(apps.get_model(model_label), field_name)
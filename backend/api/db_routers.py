@@ -0,0 +1,93 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+# Set for the duration of a request whose reads may be served by a replica
+_read_from_replica = ContextVar("read_from_replica", default=False)
+
+# The pin travels with the client, so whichever worker serves its next request sees it.
+# Signed with the user id, a client can't pin or unpin anyone else
+PIN_COOKIE = "primary_pin"
+PIN_COOKIE_SALT = "api.db_routers.pin"
+
+
+def pin_to_primary(response, user_id):
+    """Sends the user's reads to the primary for REPLICA_STICKY_SECONDS, so they see their
+    own writes before the replicas have caught up."""
+    response.set_signed_cookie(
+        PIN_COOKIE,
+        str(user_id),
+        salt=PIN_COOKIE_SALT,
+        max_age=settings.REPLICA_STICKY_SECONDS,
+        httponly=True,
+        samesite="Lax",
+    )
+
+
+def is_pinned_to_primary(request, user_id):
+    pinned_user_id = request.get_signed_cookie(
+        PIN_COOKIE, default=None, salt=PIN_COOKIE_SALT, max_age=settings.REPLICA_STICKY_SECONDS
+    )
+    return pinned_user_id == str(user_id)
+
+
+class ReplicaRouter:
+    """Routes reads to the DATABASE_REPLICAS aliases where a view allowed it.
+
+    Only reads made while ReplicaReadMixin flagged the request go to a replica, everything
+    else (writes, tasks, commands, reads in views that weren't opted in) stays on the
+    primary. So do reads inside a transaction on the primary, they must see its writes
+    and select_for_update has to lock the primary's rows.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not _read_from_replica.get() or not settings.DATABASE_REPLICAS:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """Viewset mixin serving the read only actions in replica_actions from a replica.
+
+    A user who just wrote through any of these viewsets is pinned to the primary for a
+    short while by a cookie, see pin_to_primary.
+    """
+
+    replica_actions = {"list", "retrieve"}
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _read_from_replica.set(False)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _read_from_replica.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # After authentication, the user is needed to check the pin
+        _read_from_replica.set(
+            request.method in SAFE_METHODS
+            and self.action in self.replica_actions
+            and not (request.user.is_authenticated and is_pinned_to_primary(request, request.user.id))
+        )
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in SAFE_METHODS and request.user.is_authenticated:
+            pin_to_primary(response, request.user.id)
+        return response
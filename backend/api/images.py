@@ -0,0 +1,70 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Pillow format name and file extension for each derivative format
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "webp"),
+    "jpeg": ("JPEG", "jpg"),
+}
+
+
+def derivative_name(original_name: str, size: int, image_format: str) -> str:
+    """Storage name of a resized copy of original_name.
+
+    Names are derived from the original so they can be resolved without a database lookup,
+    e.g. listings/pen.jpg -> derived/listings/pen_400.webp
+    """
+    root, _ = os.path.splitext(original_name)
+    _, extension = DERIVATIVE_FORMATS[image_format]
+    return f"{settings.IMAGE_DERIVATIVE_DIR}/{root}_{size}.{extension}"
+
+
+def pick_derivative_size(requested_width: int):
+    """Smallest configured size that covers requested_width, or None for the original."""
+    for size in sorted(settings.IMAGE_DERIVATIVE_SIZES):
+        if size >= requested_width:
+            return size
+    return None
+
+
+def generate_derivatives(original_name: str) -> dict:
+    """Writes every configured size and format of an image and returns their storage names.
+
+    The result has the shape {"200": {"webp": name, "jpeg": name}, ...}. Images are rotated
+    according to their EXIF orientation and then saved without any EXIF data.
+    """
+    with default_storage.open(original_name, "rb") as original_file:
+        with Image.open(original_file) as original:
+            original = ImageOps.exif_transpose(original)
+            if original.mode not in ("RGB", "RGBA"):
+                original = original.convert("RGBA" if "transparency" in original.info else "RGB")
+
+            variants = {}
+            for size in settings.IMAGE_DERIVATIVE_SIZES:
+                resized = original.copy()
+                # thumbnail keeps the aspect ratio and never upscales
+                resized.thumbnail((size, size), Image.LANCZOS)
+                variants[str(size)] = {
+                    image_format: _save_derivative(resized, derivative_name(original_name, size, image_format), image_format)
+                    for image_format in settings.IMAGE_DERIVATIVE_FORMATS
+                }
+    return variants
+
+
+def _save_derivative(image, name, image_format):
+    pillow_format, _ = DERIVATIVE_FORMATS[image_format]
+    if pillow_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = BytesIO()
+    image.save(buffer, format=pillow_format, quality=settings.IMAGE_DERIVATIVE_QUALITY, optimize=True)
+
+    # Regenerating replaces the old file instead of getting a suffixed name
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
@@ -0,0 +1,37 @@
+import json
+import logging
+import random
+
+# Attributes every LogRecord has, anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class SampleFilter(logging.Filter):
+    """Lets through a fraction of the records below WARNING, warnings and errors always pass.
+
+    For chatty per-item logs (one per prediction, per task run) that are only needed to
+    get a feel for what is happening.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed through extra= as top level keys."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -0,0 +1,44 @@
+from accounts.models import UserProfile
+from django.core.management.base import BaseCommand
+from listings.models import Listing
+
+from api.images import generate_derivatives
+from api.tasks import generate_image_derivatives
+
+
+class Command(BaseCommand):
+    help = "Generates resized image variants for listings and profiles that don't have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="Resize in this process instead of queueing huey tasks.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Regenerate variants even for images that already have them.",
+        )
+
+    def handle(self, *args, **options):
+        for model, label in ((Listing, "listings.Listing"), (UserProfile, "accounts.UserProfile")):
+            queryset = model.objects.exclude(image="").exclude(image__isnull=True)
+            if not options["force"]:
+                queryset = queryset.filter(image_variants={})
+
+            count = 0
+            for pk, image_name in queryset.values_list("pk", "image").iterator(chunk_size=500):
+                if options["sync"]:
+                    try:
+                        variants = generate_derivatives(image_name)
+                    except (OSError, ValueError) as e:
+                        self.stderr.write(f"Skipping {label} {pk} ({image_name}): {e}")
+                        continue
+                    model.objects.filter(pk=pk, image=image_name).update(image_variants=variants)
+                else:
+                    generate_image_derivatives(label, pk)
+                count += 1
+
+            action = "Resized" if options["sync"] else "Queued"
+            self.stdout.write(self.style.SUCCESS(f"{action} {count} {model._meta.verbose_name_plural}."))
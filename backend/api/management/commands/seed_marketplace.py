@@ -0,0 +1,530 @@
+import io
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F, Max
+from PIL import Image
+
+from accounts.models import UserBlock, UserProfile
+from api.models import StoredBlob
+from listings.classification.ListingTagClassifier import ListingTagClassifier
+from listings.models import Listing, SavedListing, Tag
+from listings.services.ranking_services import HotScoreService
+from user_messages.models import Conversation, InboxCounter, Message
+from user_messages.search import MESSAGE_INDEX, ensure_search_index, is_supported
+
+LOCATIONS = [
+    "North Campus", "South Campus", "East Hall", "West Hall", "Library Commons", "Engineering Quad",
+    "Student Union", "Greek Row", "Off Campus", "Graduate Village", "Athletics Center", "Downtown",
+]
+ADJECTIVES = ["Barely used", "Like new", "Cheap", "Vintage", "Sturdy", "Compact", "Large", "Small", "Classic", "Clean"]
+DESCRIPTIONS = [
+    "Used for one semester, works perfectly.",
+    "Some scratches but nothing that affects use.",
+    "Moving out and need this gone by the end of the week.",
+    "Comes with everything in the original box.",
+    "Pick up on campus only, price is negotiable.",
+    "Great for a dorm room, barely fits in my new place.",
+    "Bought it new last year, selling because I upgraded.",
+    "",
+]
+OPENERS = [
+    "Hi, is this still available?",
+    "Hey! Would you take {offer} for the {item}?",
+    "Is the {item} still for sale?",
+    "Can I pick up the {item} tomorrow?",
+    "Interested in the {item}, any damage I should know about?",
+]
+REPLIES = [
+    "Yes it is!",
+    "Sorry, someone else already asked about it.",
+    "I could do {offer}, that's the lowest I can go.",
+    "Sure, how about after 5pm at the {location}?",
+    "It works fine, just a few cosmetic scratches.",
+    "Sounds good, see you then.",
+    "Can you do a bit more? I was hoping for {price}.",
+    "Thanks! Let me know when you are outside.",
+    "Still interested?",
+    "Deal.",
+]
+# (condition, weight)
+CONDITIONS = [("FN", 2), ("MW", 5), ("FR", 4), ("WW", 2), ("RD", 1)]
+
+
+def zipf_cumulative_weights(count, exponent):
+    return list(accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+
+class SkewedPicker:
+    """Draws indices in range(count) with a Zipf-like skew, the popular ones are a seeded
+    permutation rather than the lowest indices."""
+
+    def __init__(self, rng, count, exponent):
+        self.rng = rng
+        self.order = list(range(count))
+        rng.shuffle(self.order)
+        self.cumulative = zipf_cumulative_weights(count, exponent)
+        self.rank = [0] * count
+        for rank, index in enumerate(self.order):
+            self.rank[index] = rank
+
+    def pick(self):
+        position = bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.order[min(position, len(self.order) - 1)]
+
+    def share(self, index):
+        """The probability of index being picked."""
+        rank = self.rank[index]
+        weight = self.cumulative[rank] - (self.cumulative[rank - 1] if rank else 0)
+        return weight / self.cumulative[-1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with a synthetic marketplace: users, listings with tags, saves, "
+        "blocks and message threads, skewed like real traffic (a few popular listings and "
+        "very active users, most of them quiet). The same --seed and --end-date always "
+        "produce the same data."
+    )
+    # Conversation draws in a row that may fail before giving up on more messages
+    MAX_THREAD_MISSES = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--listings", type=int, default=5000)
+        parser.add_argument("--messages", type=int, default=50000)
+        parser.add_argument("--saves", type=int, help="Saved listings, twice the listings by default.")
+        parser.add_argument("--blocks", type=int, help="User blocks, one per 50 users by default.")
+        parser.add_argument("--thread-length", type=float, default=6, help="Average messages per conversation.")
+        parser.add_argument("--days", type=int, default=365, help="Length of the generated history.")
+        parser.add_argument(
+            "--end-date",
+            type=date.fromisoformat,
+            default=date.today(),
+            help="Last day of the generated history (YYYY-MM-DD), today by default.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=10000, help="Rows inserted per transaction.")
+        parser.add_argument("--password", default="password123", help="Password of every seeded user.")
+        parser.add_argument(
+            "--drop-indexes",
+            action="store_true",
+            help="Drop the secondary indexes of the loaded tables while loading and build them again "
+            "at the end. Faster for large loads, only for a scratch database.",
+        )
+
+    def handle(self, *args, **options):
+        if options["users"] < 2 or options["listings"] < 1:
+            raise CommandError("Seeding needs at least 2 users and 1 listing.")
+        self.options = options
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.prefix = f"seed{options['seed']}_"
+        if User.objects.filter(username=f"{self.prefix}0").exists():
+            raise CommandError(f"Seed {options['seed']} is already loaded, pick another --seed.")
+
+        self.end = datetime.combine(options["end_date"], datetime.min.time(), tzinfo=timezone.utc) + timedelta(days=1)
+        self.start = self.end - timedelta(days=options["days"])
+
+        indexes = []
+        if options["drop_indexes"]:
+            indexes = self._drop_indexes(Listing, Listing.tags.through, SavedListing, Conversation, Message)
+        try:
+            with self._generated_timestamps():
+                self._stage("users", self._seed_users)
+                self._stage("listings", self._seed_listings)
+                self._stage("saves", self._seed_saves)
+                self._stage("blocks", self._seed_blocks)
+                self._stage("messages", self._seed_messages)
+        finally:
+            # Also after a failed load, so the database is never left without its indexes
+            if indexes:
+                self._stage("indexes", lambda: self._create_indexes(indexes), unit="indexes")
+            if is_supported():
+                self._stage("search index", self._rebuild_search_index)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Done. Run rebuild_similarity_index --sync to index the new listings for similar listings."
+            )
+        )
+
+    def _stage(self, name, seed, unit="rows"):
+        started = time.perf_counter()
+        count = seed()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{name}: {count:,} {unit} in {elapsed:.1f}s ({count / elapsed if elapsed else 0:,.0f} {unit}/s)"
+        )
+
+    def _chunks(self, rows):
+        """Lists of up to batch_size items from rows."""
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _random_time(self, after=None):
+        after = after or self.start
+        return after + (self.end - after) * self.rng.random()
+
+    @staticmethod
+    def _next_id(model):
+        return (model.objects.aggregate(last=Max("pk"))["last"] or 0) + 1
+
+    @staticmethod
+    @contextmanager
+    def _generated_timestamps():
+        """Lets bulk_create store the generated history in auto_now and auto_now_add fields,
+        which would otherwise all be set to the current time."""
+        fields = [
+            Listing._meta.get_field("last_modified_at"),
+            SavedListing._meta.get_field("saved_at"),
+            Message._meta.get_field("created_at"),
+            Message._meta.get_field("edited_at"),
+        ]
+        saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+        for field in fields:
+            field.auto_now = field.auto_now_add = False
+        try:
+            yield
+        finally:
+            for field, auto_now, auto_now_add in saved:
+                field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+    @staticmethod
+    def _drop_indexes(*models):
+        """Drops the secondary indexes of the bulk loaded tables, returning their definitions.
+        Only with --drop-indexes.
+
+        Building an index once over the loaded rows is much faster than millions of random
+        inserts into its b-tree. Only done on SQLite, where the definitions are at hand in
+        sqlite_master.
+        """
+        if connection.vendor != "sqlite":
+            return []
+        tables = [model._meta.db_table for model in models]
+        with connection.cursor() as cursor:
+            # Indexes backing a UNIQUE column or the primary key have no sql and are kept
+            cursor.execute(
+                f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+                f"AND tbl_name IN ({', '.join(['%s'] * len(tables))})",
+                tables,
+            )
+            indexes = cursor.fetchall()
+            for name, _ in indexes:
+                cursor.execute(f"DROP INDEX {connection.ops.quote_name(name)}")
+        return indexes
+
+    @staticmethod
+    def _create_indexes(indexes):
+        with connection.cursor() as cursor:
+            for _, sql in indexes:
+                cursor.execute(sql)
+        return len(indexes)
+
+    def _seed_users(self):
+        rng = self.rng
+        count = self.options["users"]
+        # Hashing is the slow part of creating a user, every seeded user shares one hash
+        password = make_password(self.options["password"])
+        self.first_user_id = self._next_id(User)
+        self.user_joined = []
+        # Activity skew, used for who sells, buys, saves and messages
+        self.users = SkewedPicker(rng, count, exponent=0.9)
+
+        for chunk in self._chunks(range(count)):
+            users, profiles = [], []
+            for index in chunk:
+                joined = self._random_time()
+                self.user_joined.append(joined)
+                user_id = self.first_user_id + index
+                username = f"{self.prefix}{index}"
+                users.append(
+                    User(
+                        id=user_id, password=password, username=username, email=f"{username}@example.edu",
+                        date_joined=joined,
+                    )
+                )
+                profiles.append(UserProfile(user_id=user_id, location=rng.choice(LOCATIONS)))
+            with transaction.atomic():
+                User.objects.bulk_create(users, batch_size=self.batch_size)
+                UserProfile.objects.bulk_create(profiles, batch_size=self.batch_size)
+        return count * 2
+
+    def _placeholder_image(self, listing_count):
+        image = Image.new("RGB", (400, 300), (200, 200, 200))
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG")
+        name = storages["images"].save("listings/seed.jpg", ContentFile(buffer.getvalue()))
+        # Keep the blob referenced, the rows are inserted without the tracking signals
+        blob, _ = StoredBlob.objects.get_or_create(name=name)
+        StoredBlob.objects.filter(pk=blob.pk).update(refcount=F("refcount") + listing_count, released_at=None)
+        return name
+
+    def _seed_listings(self):
+        rng = self.rng
+        count = self.options["listings"]
+        tag_names = ListingTagClassifier().ALL_TAGS
+        existing = dict(Tag.objects.filter(tag_name__in=tag_names).values_list("tag_name", "id"))
+        missing = [Tag(tag_name=name) for name in tag_names if name not in existing]
+        Tag.objects.bulk_create(missing)
+        existing.update(Tag.objects.filter(tag_name__in=tag_names).values_list("tag_name", "id"))
+        tag_ids = [existing[name] for name in tag_names]
+        tags = SkewedPicker(rng, len(tag_names), exponent=1.1)
+        image = self._placeholder_image(count)
+        conditions, condition_weights = zip(*CONDITIONS)
+
+        self.listings = SkewedPicker(rng, count, exponent=1.0)
+        # Saves are drawn up front, each listing's counter is written with the listing
+        self.saves = self._draw_saves()
+        save_counts = [0] * count
+        for _, listing_index in self.saves:
+            save_counts[listing_index] += 1
+
+        self.first_listing_id = self._next_id(Listing)
+        self.listing_authors = []
+        self.listing_created = []
+        self.listing_titles = []
+        self.listing_prices = []
+        total_likes = count * 3
+        through = Listing.tags.through
+        for chunk in self._chunks(range(count)):
+            listings, listing_tags = [], []
+            for index in chunk:
+                listing_id = self.first_listing_id + index
+                author = self.users.pick()
+                created = self._random_time(self.user_joined[author])
+                primary, *others = dict.fromkeys(tags.pick() for _ in range(rng.randint(1, 3)))
+                title = f"{rng.choice(ADJECTIVES)} {tag_names[primary]}"[:50]
+                price = round(min(rng.lognormvariate(3, 1), 5000), 2)
+                likes = int(total_likes * self.listings.share(index) * rng.uniform(0.5, 1.5))
+                dislikes = int(likes * rng.uniform(0, 0.2))
+                saves = save_counts[index]
+                listings.append(
+                    Listing(
+                        id=listing_id, title=title, condition=rng.choices(conditions, weights=condition_weights)[0],
+                        description=rng.choice(DESCRIPTIONS), price=price, image=image, likes=likes,
+                        dislikes=dislikes, saves=saves,
+                        hot_score=HotScoreService.compute(likes, dislikes, saves, created.date()),
+                        hot_score_stale=False, created_at=created.date(), last_modified_at=created,
+                        author_id_id=self.first_user_id + author,
+                    )
+                )
+                listing_tags.extend(
+                    through(listing_id=listing_id, tag_id=tag_ids[tag]) for tag in (primary, *others)
+                )
+                self.listing_authors.append(author)
+                self.listing_created.append(created)
+                self.listing_titles.append(title)
+                self.listing_prices.append(price)
+
+            with transaction.atomic():
+                Listing.objects.bulk_create(listings, batch_size=self.batch_size)
+                through.objects.bulk_create(listing_tags, batch_size=self.batch_size)
+        return count
+
+    def _draw_saves(self):
+        """(user index, listing index) pairs, no user saves a listing twice."""
+        count = self.options["saves"] if self.options["saves"] is not None else self.options["listings"] * 2
+        listing_count = self.options["listings"]
+        seen = set()
+        saves = []
+        # Bounded, with few users and listings there may not be that many distinct pairs
+        for _ in range(count * 3):
+            if len(saves) == count:
+                break
+            user, listing = self.users.pick(), self.listings.pick()
+            if user * listing_count + listing in seen:
+                continue
+            seen.add(user * listing_count + listing)
+            saves.append((user, listing))
+        return saves
+
+    def _seed_saves(self):
+        for chunk in self._chunks(self.saves):
+            saves = [
+                SavedListing(
+                    user_id=self.first_user_id + user,
+                    listing_id=self.first_listing_id + listing,
+                    saved_at=self._random_time(max(self.listing_created[listing], self.user_joined[user])),
+                )
+                for user, listing in chunk
+            ]
+            SavedListing.objects.bulk_create(saves, batch_size=self.batch_size)
+        return len(self.saves)
+
+    def _seed_blocks(self):
+        rng = self.rng
+        user_count = self.options["users"]
+        count = self.options["blocks"] if self.options["blocks"] is not None else user_count // 50
+        self.blocked_pairs = set()
+        blocks = []
+        for _ in range(count * 3):
+            if len(blocks) == count:
+                break
+            # Anyone may block, the blocked user tends to be an active one
+            user, blocked = rng.randrange(user_count), self.users.pick()
+            if user == blocked or (user, blocked) in self.blocked_pairs:
+                continue
+            self.blocked_pairs.add((user, blocked))
+            blocks.append(UserBlock(user_id=self.first_user_id + user, blocked_user_id=self.first_user_id + blocked))
+        UserBlock.objects.bulk_create(blocks, batch_size=self.batch_size)
+        return len(blocks)
+
+    def _seed_messages(self):
+        total = self.options["messages"]
+        if not total:
+            return 0
+        search = is_supported()
+        if search:
+            ensure_search_index()
+        self.next_message_id = self._next_id(Message)
+        self.next_conversation_id = self._next_id(Conversation)
+        self.inbox_unread = {}
+        self.seen_conversations = set()
+
+        try:
+            if search:
+                # Indexed in one pass afterwards, much faster than a trigger per row
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {MESSAGE_INDEX.table}_insert")
+            produced = misses = 0
+            # Bounded, with few users and listings the distinct (listing, pair) threads run out
+            while produced < total and misses < self.MAX_THREAD_MISSES:
+                conversations, messages, last_message_ids = [], [], []
+                while produced < total and len(messages) < self.batch_size:
+                    thread = self._thread(total - produced)
+                    if thread is None:
+                        misses += 1
+                        if misses == self.MAX_THREAD_MISSES:
+                            break
+                        continue
+                    misses = 0
+                    conversation, thread_messages = thread
+                    conversations.append(conversation)
+                    messages.extend(thread_messages)
+                    last_message_ids.append(thread_messages[-1].id)
+                    produced += len(thread_messages)
+                with transaction.atomic():
+                    # Conversations go in without their last message, which doesn't exist
+                    # yet. A pending foreign key violation would make SQLite look for
+                    # referencing rows on every message insert
+                    Conversation.objects.bulk_create(conversations, batch_size=self.batch_size)
+                    Message.objects.bulk_create(messages, batch_size=self.batch_size)
+                    for conversation, last_message_id in zip(conversations, last_message_ids):
+                        conversation.last_message_id = last_message_id
+                    Conversation.objects.bulk_update(conversations, ["last_message"], batch_size=self.batch_size)
+        finally:
+            if search:
+                with connection.cursor() as cursor:
+                    for trigger in MESSAGE_INDEX.triggers:
+                        cursor.execute(trigger)
+
+        InboxCounter.objects.bulk_create(
+            [InboxCounter(user_id=user_id, unread=unread) for user_id, unread in self.inbox_unread.items()],
+            batch_size=self.batch_size,
+        )
+        if produced < total:
+            self.stderr.write(
+                self.style.WARNING(
+                    f"Only {produced:,} of {total:,} messages, there are no more distinct conversations "
+                    f"between these users and listings. Seed more users or listings for a longer history."
+                )
+            )
+        return produced
+
+    def _thread(self, remaining):
+        """An unsaved conversation about a listing, without its last message yet, and its
+        messages, or None if the drawn pair can't or already does talk about it."""
+        rng = self.rng
+        listing = self.listings.pick()
+        seller, buyer = self.listing_authors[listing], self.users.pick()
+        if buyer == seller or (buyer, seller) in self.blocked_pairs or (seller, buyer) in self.blocked_pairs:
+            return None
+        listing_id = self.first_listing_id + listing
+        seller_id, buyer_id = self.first_user_id + seller, self.first_user_id + buyer
+        user_one_id, user_two_id = Conversation.ordered_pair(seller_id, buyer_id)
+        if (listing_id, user_one_id, user_two_id) in self.seen_conversations:
+            return None
+        self.seen_conversations.add((listing_id, user_one_id, user_two_id))
+
+        mean = self.options["thread_length"]
+        length = 1 if mean <= 1 else min(1 + int(rng.expovariate(1 / (mean - 1))), remaining)
+        price = self.listing_prices[listing]
+        context = {
+            "item": self.listing_titles[listing].split(" ", 2)[-1],
+            "price": f"${price:.0f}",
+            "offer": f"${price * rng.uniform(0.6, 0.9):.0f}",
+            "location": rng.choice(LOCATIONS),
+        }
+        conversation_id = self.next_conversation_id
+        self.next_conversation_id += 1
+
+        sent = self._random_time(max(self.listing_created[listing], self.user_joined[buyer]))
+        sender, receiver = buyer_id, seller_id
+        messages, senders = [], []
+        for position in range(length):
+            template = rng.choice(OPENERS) if position == 0 else rng.choice(REPLIES)
+            messages.append(
+                Message(
+                    id=self.next_message_id, content=template.format(**context), created_at=sent,
+                    edited_at=sent, related_listing_id=listing_id, sender_id=sender, receiver_id=receiver,
+                    conversation_id=conversation_id,
+                )
+            )
+            senders.append(sender)
+            self.next_message_id += 1
+            # Mostly a back and forth, replies come within minutes to a day
+            sent = min(sent + timedelta(seconds=rng.expovariate(1 / 7200)), self.end)
+            if rng.random() < 0.75:
+                sender, receiver = receiver, sender
+
+        read_state = []
+        for user_id in (user_one_id, user_two_id):
+            last_read_id, unread = self._read_state(rng, messages, senders, user_id)
+            read_state.append((last_read_id, unread))
+            if unread:
+                self.inbox_unread[user_id] = self.inbox_unread.get(user_id, 0) + unread
+        (user_one_read, user_one_unread), (user_two_read, user_two_unread) = read_state
+        conversation = Conversation(
+            id=conversation_id, related_listing_id=listing_id, user_one_id=user_one_id, user_two_id=user_two_id,
+            last_message_at=messages[-1].created_at, user_one_last_read_id=user_one_read,
+            user_two_last_read_id=user_two_read, user_one_unread=user_one_unread, user_two_unread=user_two_unread,
+        )
+        return conversation, messages
+
+    @staticmethod
+    def _read_state(rng, messages, senders, user_id):
+        """(last read message id, unread count) of user_id in a thread.
+
+        Everything up to the user's own last message has been read, what they received
+        after it is read or not with even odds.
+        """
+        last_sent = max((index for index, sender in enumerate(senders) if sender == user_id), default=-1)
+        read_up_to = len(messages) - 1 if rng.random() < 0.5 else last_sent
+        last_read_id = messages[read_up_to].id if read_up_to >= 0 else 0
+        unread = sum(1 for sender in senders[read_up_to + 1:] if sender != user_id)
+        return last_read_id, unread
+
+    def _rebuild_search_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(MESSAGE_INDEX.rebuild)
+            cursor.execute(MESSAGE_INDEX.optimize)
+        return Message.objects.count()
@@ -0,0 +1,198 @@
+"""Prometheus metrics, rendered in the text exposition format by MetricsView.
+
+Request metrics live in the memory of the process that served the request, recording one
+costs a dict lookup and a few additions under a lock. With several web workers each keeps
+its own series, scrape them one by one or run a single worker per scrape target.
+
+Task metrics are recorded by the huey consumer, a different process, so they are kept in
+the Django cache instead and read back when /metrics is scraped. That needs a cache shared
+between the web and consumer processes (CACHE_URL). Without one they are only registered
+when tasks run in the web process itself (HUEY_IMMEDIATE), rather than exporting series
+that never move.
+"""
+
+import bisect
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Seconds, for request and task latencies
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield f"{self.name}_total{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS, registry=REGISTRY):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labelvalues -> [count per bucket (not cumulative, the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labelvalues)
+            if series is None:
+                series = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _series(self):
+        with self._lock:
+            return sorted((labelvalues, (list(counts), total)) for labelvalues, (counts, total) in self._values.items())
+
+    def samples(self):
+        for labelvalues, (counts, total) in self._series():
+            yield from _histogram_samples(self, labelvalues, counts, total)
+
+
+def _histogram_samples(histogram, labelvalues, counts, total):
+    cumulative = 0
+    for bound, count in zip((*histogram.buckets, float("inf")), counts):
+        cumulative += count
+        labels = _format_labels(histogram.labelnames, labelvalues, [("le", _format_value(float(bound)))])
+        yield f"{histogram.name}_bucket{labels} {cumulative}"
+    labels = _format_labels(histogram.labelnames, labelvalues)
+    yield f"{histogram.name}_sum{labels} {_format_value(total)}"
+    yield f"{histogram.name}_count{labels} {cumulative}"
+
+
+class SharedHistogram(Histogram):
+    """Histogram kept in the Django cache, so every process records into the same series.
+
+    An observation is two cache increments, the bucket it falls in and the sum (stored in
+    microseconds, the cache only increments integers).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._known_labels = set()
+
+    def _key(self, labelvalues, suffix):
+        return f"metrics:{self.name}:{':'.join(map(str, labelvalues))}:{suffix}"
+
+    def _labels_key(self):
+        return f"metrics:{self.name}:labels"
+
+    @staticmethod
+    def _incr(key, amount):
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            # First observation, a concurrent one may be lost, which metrics can live with
+            if not cache.add(key, amount, timeout=None):
+                cache.incr(key, amount)
+
+    def observe(self, value, *labelvalues):
+        if labelvalues not in self._known_labels:
+            labels = cache.get(self._labels_key(), frozenset())
+            if labelvalues not in labels:
+                cache.set(self._labels_key(), labels | {labelvalues}, timeout=None)
+            self._known_labels.add(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        self._incr(self._key(labelvalues, index), 1)
+        self._incr(self._key(labelvalues, "sum"), round(value * 1_000_000))
+
+    def _series(self):
+        series = []
+        for labelvalues in sorted(cache.get(self._labels_key(), frozenset())):
+            keys = [self._key(labelvalues, index) for index in range(len(self.buckets) + 1)]
+            sum_key = self._key(labelvalues, "sum")
+            values = cache.get_many([*keys, sum_key])
+            counts = [values.get(key, 0) for key in keys]
+            series.append((labelvalues, (counts, values.get(sum_key, 0) / 1_000_000)))
+        return series
+
+
+http_requests = Counter(
+    "http_requests", "HTTP requests by route and response status.", ["method", "route", "status"]
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request.", ["method", "route"]
+)
+http_request_db_queries = Histogram(
+    "http_request_db_queries", "SQL queries run while handling a request.", ["method", "route"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+http_request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Time spent in SQL queries while handling a request.", ["method", "route"]
+)
+http_response_size = Histogram(
+    "http_response_size_bytes", "Size of non-streaming response bodies.", ["method", "route"],
+    buckets=SIZE_BUCKETS,
+)
+
+TASK_METRICS_ENABLED = settings.SHARED_CACHE or settings.HUEY_IMMEDIATE
+task_duration = task_queue_lag = None
+if TASK_METRICS_ENABLED:
+    task_duration = SharedHistogram(
+        "huey_task_duration_seconds", "Time spent running a huey task.", ["task", "outcome"]
+    )
+    task_queue_lag = SharedHistogram(
+        "huey_task_queue_lag_seconds", "Time a huey task waited between being enqueued and starting.", ["task"]
+    )
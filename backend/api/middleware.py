@@ -0,0 +1,83 @@
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+
+from . import metrics
+
+
+class _QueryTimer:
+    """Database execute wrapper counting the queries of a request and their total time."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+class RequestMetricsMiddleware:
+    """Records latency, SQL queries, response size and status per route, see api.metrics.
+
+    Requests are labelled with the name of the URL pattern they resolved to
+    (listing-detail) rather than the path, so the number of series stays bounded. Goes
+    first in MIDDLEWARE to time the whole stack.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Under ASGI the chain stays async, so streaming and long-poll views don't hold a
+        # worker thread for as long as they are open
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = _QueryTimer()
+        started = time.perf_counter()
+        with self._timing_queries(timer):
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = _QueryTimer()
+        started = time.perf_counter()
+        with self._timing_queries(timer):
+            response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    @staticmethod
+    def _timing_queries(timer):
+        # Every alias, reads may go to a replica. execute_wrapper only wraps the
+        # connection objects seen by the calling thread, queries an async view runs
+        # through sync_to_async may use another thread's connections and aren't counted
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(timer))
+        return stack
+
+    @staticmethod
+    def _record(request, response, duration, timer):
+        match = getattr(request, "resolver_match", None)
+        route = (match.view_name or match.route) if match is not None else "<unmatched>"
+        method = request.method
+        metrics.http_requests.inc(method, route, response.status_code)
+        metrics.http_request_duration.observe(duration, method, route)
+        metrics.http_request_db_queries.observe(timer.count, method, route)
+        metrics.http_request_db_duration.observe(timer.duration, method, route)
+        if not response.streaming:
+            metrics.http_response_size.observe(len(response.content), method, route)
@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class StoredBlob(models.Model):
+    """Reference count for a stored file.
+
+    Rows are kept in sync by the signals in api.signals. Once refcount drops to zero the
+    file is deleted by the collect_unreferenced_blobs task after a grace period.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.IntegerField(default=0)
+    released_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
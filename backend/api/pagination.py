@@ -1,4 +1,10 @@
-from rest_framework.pagination import PageNumberPagination
+import heapq
+from itertools import islice
+
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class StandardResultsSetPagination(PageNumberPagination):
     """Pagination class that paginates responses into distinct page numbers.
@@ -13,4 +19,188 @@ class StandardResultsSetPagination(PageNumberPagination):
 
     page_size = 12
     page_size_query_param = "page_size"
-    max_page_size = 100
\ No newline at end of file
+    max_page_size = 100
+
+
+class HotScoreCursorPagination(CursorPagination):
+    """Keyset pagination for listings ordered by their precomputed hot score.
+
+    Each page continues from the last hot_score seen instead of an OFFSET, so deep pages
+    cost the same as the first one and results don't shift as scores change.
+
+    Attributes:
+        ordering (tuple): Fixed ordering, id breaks ties between equal scores.
+    """
+
+    ordering = ("-hot_score", "-id")
+    page_size = 12
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+
+class InboxCursorPagination(CursorPagination):
+    """Keyset pagination for a user's conversations, most recently active first.
+
+    Attributes:
+        ordering (tuple): Fixed ordering, id breaks ties between equal timestamps.
+    """
+
+    ordering = ("-last_message_at", "-id")
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+
+class IdCursorPagination(BasePagination):
+    """Incremental pagination over a queryset by primary key.
+
+    ?after_id=<id> returns the page_size objects following that id, oldest first, which is
+    what a client polling for new objects needs. ?before_id=<id> returns the page_size
+    objects preceding it, newest first, for scrolling back. Each page is a single range
+    scan on the id with a LIMIT, there is no COUNT(*) and pages never shift as new rows
+    are added.
+
+    A list of querysets can be passed instead of one, e.g. the two directions of a
+    conversation. Each is limited separately and the results are merged by id, which lets
+    every part use its own index range instead of the database picking a plan for an OR.
+
+    Older objects can live in a second store, e.g. an archive table. Pass it as fallback and
+    a page scrolling back past the oldest object of queryset continues into the fallback.
+
+    Attributes:
+        page_size (int): The default number of objects on each page.
+        page_size_query_param (String): The query string that is used to choose the page size.
+        max_page_size (int): The maximum number of objects per page.
+    """
+
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    @staticmethod
+    def is_requested(request):
+        return "after_id" in request.query_params or "before_id" in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None, fallback=None):
+        after_id = self._get_id(request, "after_id")
+        before_id = self._get_id(request, "before_id")
+        page_size = self._get_page_size(request)
+
+        rows = self._page(queryset, after_id, before_id, page_size + 1)
+        if fallback is not None and after_id is None and len(rows) <= page_size:
+            # Past the oldest object in queryset, continue below it in the fallback
+            oldest_id = rows[-1].id if rows else before_id
+            rows += self._page(fallback, None, oldest_id, page_size + 1 - len(rows))
+
+        # One extra row tells whether there is another page
+        self.has_more = len(rows) > page_size
+        return rows[:page_size]
+
+    @staticmethod
+    def _page(queryset, after_id, before_id, limit):
+        descending = after_id is None
+        parts = []
+        for part in queryset if isinstance(queryset, (list, tuple)) else [queryset]:
+            if after_id is not None:
+                part = part.filter(id__gt=after_id)
+            if before_id is not None:
+                part = part.filter(id__lt=before_id)
+            parts.append(list(part.order_by("-id" if descending else "id")[:limit]))
+        return list(islice(heapq.merge(*parts, key=lambda obj: obj.id, reverse=descending), limit))
+
+    def get_paginated_response(self, data):
+        return Response({"has_more": self.has_more, "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["has_more", "results"],
+            "properties": {
+                "has_more": {"type": "boolean"},
+                "results": schema,
+            },
+        }
+
+    @staticmethod
+    def _get_id(request, param):
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({param: ["A valid integer is required."]})
+
+    def _get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+
+class UncountedPageNumberPagination(BasePagination):
+    """Page number pagination that never counts the rows.
+
+    Each page is a single slice of page_size + 1 rows, the extra one tells whether there is
+    a next page. Responses have next and previous links but no count, so sequences where a
+    total is expensive (e.g. live messages continued by an archive) are only read as far as
+    the requested page.
+
+    Attributes:
+        page_size (int): The number of objects on each page.
+        page_query_param (String): The query string that holds the page number.
+    """
+
+    page_size = 25
+    page_query_param = "page"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            raise NotFound("Invalid page.")
+        if self.page_number < 1:
+            raise NotFound("Invalid page.")
+
+        start = (self.page_number - 1) * self.page_size
+        rows = list(queryset[start:start + self.page_size + 1])
+        if not rows and self.page_number > 1:
+            raise NotFound("Invalid page.")
+        self.request = request
+        self.has_next = len(rows) > self.page_size
+        return rows[:self.page_size]
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "previous": self.get_previous_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+
+from accounts.authentication import CachedJWTAuthentication
+
+logger = logging.getLogger(__name__)
+
+
+def user_channel(user_id) -> str:
+    return f"user:{user_id}"
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    """The fan-out backend configured in REALTIME_BROKER, one instance per process."""
+    config = settings.REALTIME_BROKER
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+def publish_to_users(user_ids, event: dict):
+    broker = get_broker()
+    for user_id in set(user_ids):
+        broker.publish(user_channel(user_id), event)
+
+
+def authenticate_stream(request):
+    """Id of the user a SimpleJWT access token belongs to, or None.
+
+    EventSource can't send headers, so the token is also accepted as ?token=. The user is
+    checked like on every other request, from the cached snapshot of CachedJWTAuthentication,
+    so deactivated or deleted accounts are turned away. It may query the database on a
+    cache miss, async views call it through sync_to_async.
+    """
+    auth = CachedJWTAuthentication()
+    raw_token = None
+    header = auth.get_header(request)
+    if header is not None:
+        raw_token = auth.get_raw_token(header)
+    if raw_token is None:
+        raw_token = request.GET.get("token")
+    if not raw_token:
+        return None
+
+    try:
+        return auth.get_user(auth.get_validated_token(raw_token)).id
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None
+
+
+class InMemorySubscription:
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_pending)
+
+    def deliver(self, event):
+        # Runs on the subscriber's event loop. A consumer that stopped reading loses its
+        # oldest events rather than growing without bound
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        """Next event, or None if nothing arrived within timeout seconds."""
+        if timeout <= 0:
+            # wait_for with a zero timeout gives up without looking at the queue
+            try:
+                return self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker:
+    """Fans events out to subscribers in this process.
+
+    Enough for a single ASGI worker and for tests. Events published from a request thread
+    are handed to each subscriber's event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, max_pending=100, **options):
+        self.max_pending = max_pending
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = InMemorySubscription(self, channel, self.max_pending)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.channel, None)
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # The subscriber's loop has already shut down
+                self.unsubscribe(subscription)
+
+
+class RedisSubscription:
+    def __init__(self, client, channel):
+        self.client = client
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.channel = channel
+
+    async def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        # At least one look, a zero timeout only takes what has already arrived
+        remaining = max(timeout, 0)
+        while True:
+            message = await self.pubsub.get_message(timeout=remaining)
+            if message is not None:
+                return json.loads(message["data"])
+            if (remaining := deadline - time.monotonic()) <= 0:
+                return None
+
+    async def __aenter__(self):
+        await self.pubsub.subscribe(self.channel)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+class RedisBroker:
+    """Fans events out through Redis pub/sub so every ASGI worker sees them.
+
+    OPTIONS: url (redis://host:port/db) and an optional channel prefix.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="backpackbazaar:", **options):
+        self.url = url
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def subscribe(self, channel):
+        # One connection per stream, owned by the stream's event loop
+        return RedisSubscription(redis.asyncio.Redis.from_url(self.url), self.prefix + channel)
+
+    def publish(self, channel, event):
+        try:
+            self._client.publish(self.prefix + channel, json.dumps(event))
+        except Exception:
+            # Clients catch up with after_id, a lost push must not fail the write
+            logger.exception("Failed to publish realtime event to %s", channel)
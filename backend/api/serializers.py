@@ -0,0 +1,26 @@
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """Renders a model's image_variants as URLs instead of storage names."""
+
+    def to_representation(self, value):
+        request = self.context.get("request")
+        variants = {}
+        for size, formats in (value or {}).items():
+            variants[size] = {}
+            for image_format, name in formats.items():
+                url = default_storage.url(name)
+                variants[size][image_format] = request.build_absolute_uri(url) if request else url
+        return variants
+
+
+class SniffedImageField(serializers.ImageField):
+    """ImageField that skips the Pillow check for files StreamingImageUploadHandler already
+    validated from their header."""
+
+    def to_internal_value(self, data):
+        if getattr(data, "image_info", None) is None:
+            return super().to_internal_value(data)
+        return serializers.FileField.to_internal_value(self, data)
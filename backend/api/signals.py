@@ -0,0 +1,65 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils import timezone
+
+from .models import StoredBlob
+
+# (model label, file field) pairs whose files are reference counted
+TRACKED_FILE_FIELDS = (
+    ("listings.Listing", "image"),
+    ("accounts.UserProfile", "image"),
+)
+
+
+def acquire_blob(name):
+    updated = StoredBlob.objects.filter(name=name).update(refcount=F("refcount") + 1, released_at=None)
+    if not updated:
+        try:
+            with transaction.atomic():
+                StoredBlob.objects.create(name=name, refcount=1)
+        except IntegrityError:
+            # Created concurrently, count this reference on the existing row
+            StoredBlob.objects.filter(name=name).update(refcount=F("refcount") + 1, released_at=None)
+
+
+def release_blob(name):
+    StoredBlob.objects.filter(name=name).update(refcount=F("refcount") - 1)
+    StoredBlob.objects.filter(name=name, refcount__lte=0, released_at__isnull=True).update(
+        released_at=timezone.now()
+    )
+
+
+def _stored_name(instance, field_name):
+    # Read the raw column value so deferred fields aren't loaded
+    value = instance.__dict__.get(field_name)
+    return getattr(value, "name", value) or ""
+
+
+def connect_blob_tracking(model, field_name):
+    loaded_attr = f"_loaded_{field_name}_name"
+
+    def remember_name(sender, instance, **kwargs):
+        setattr(instance, loaded_attr, _stored_name(instance, field_name))
+
+    def update_references(sender, instance, created, raw=False, **kwargs):
+        if raw:
+            return
+        old_name = getattr(instance, loaded_attr, "")
+        new_name = _stored_name(instance, field_name)
+        if new_name != old_name:
+            if new_name:
+                acquire_blob(new_name)
+            if old_name:
+                release_blob(old_name)
+        setattr(instance, loaded_attr, new_name)
+
+    def release_reference(sender, instance, **kwargs):
+        name = getattr(instance, loaded_attr, "")
+        if name:
+            release_blob(name)
+
+    uid = f"blob-tracking-{model._meta.label}-{field_name}"
+    post_init.connect(remember_name, sender=model, weak=False, dispatch_uid=uid)
+    post_save.connect(update_references, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(release_reference, sender=model, weak=False, dispatch_uid=uid)
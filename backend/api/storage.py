@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, storages
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage that names files after the SHA-256 of their contents.
+
+    The upload_to directory is kept, so listings/pen.jpg is stored as
+    listings/3f/3fa2...e1.jpg. Identical uploads map to the same name and are only written
+    once, and because a name can never point at different bytes it is safe to cache
+    forever. How many rows reference each file is tracked by api.models.StoredBlob.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        name = self.hashed_name(name, content)
+        if self.exists(name) and (self._claim(name) or self.exists(name)):
+            # Same bytes are already stored, skip the write entirely
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    @staticmethod
+    def _claim(name):
+        """Restarts the grace period of an unreferenced blob about to be reused.
+
+        Returns False if there is no StoredBlob row, e.g. because collect_unreferenced_blobs
+        just deleted it. The collector unlinks the file before its transaction commits and
+        this update waits for that, so the caller can tell whether the file is still there.
+        """
+        from .models import StoredBlob
+
+        return bool(
+            StoredBlob.objects.filter(name=name).update(
+                released_at=Case(When(refcount__lte=0, then=Value(timezone.now())), default=F("released_at"))
+            )
+        )
+
+    @staticmethod
+    def hashed_name(name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+
+        hex_digest = digest.hexdigest()
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(directory, hex_digest[:2], f"{hex_digest}{extension}").replace(os.sep, "/")
+
+
+def image_storage():
+    # Callable so the storage can be swapped through settings.STORAGES["images"]
+    return storages["images"]
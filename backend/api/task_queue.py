@@ -0,0 +1,36 @@
+"""Huey classes that record when each task was enqueued, for the queue lag metric.
+
+The time is stored next to huey's own message when a task is serialized, so it covers
+every task without being one of its arguments, and is read back as task.enqueued_at.
+Scheduled and retried tasks are serialized again when they become due, their lag counts
+from then. Tasks run in immediate mode are never serialized and have no enqueue time.
+"""
+
+import time
+
+import huey
+from huey.registry import Message
+
+
+class EnqueueTimeMixin:
+    def serialize_task(self, task):
+        message = self._registry.create_message(task)
+        return self.serializer.serialize((time.time(), message))
+
+    def deserialize_task(self, data):
+        payload = self.serializer.deserialize(data)
+        if isinstance(payload, Message):
+            # Queued before enqueue times were recorded
+            return self._registry.create_task(payload)
+        enqueued_at, message = payload
+        task = self._registry.create_task(message)
+        task.enqueued_at = enqueued_at
+        return task
+
+
+class SqliteHuey(EnqueueTimeMixin, huey.SqliteHuey):
+    pass
+
+
+class PriorityRedisHuey(EnqueueTimeMixin, huey.PriorityRedisHuey):
+    pass
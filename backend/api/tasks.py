@@ -0,0 +1,91 @@
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage, storages
+from django.db import transaction
+from django.utils import timezone
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, lock_task, on_commit_task, signal
+from huey.signals import SIGNAL_COMPLETE, SIGNAL_ERROR, SIGNAL_EXECUTING, SIGNAL_INTERRUPTED, SIGNAL_LOCKED
+
+from . import metrics
+from .images import derivative_name, generate_derivatives
+from .models import StoredBlob
+
+
+@on_commit_task(priority=settings.TASK_PRIORITIES["images"])
+def generate_image_derivatives(model_label: str, pk: int, field_name: str = "image"):
+    # Resizes an uploaded image off the request, model_label is e.g. "listings.Listing"
+    model = apps.get_model(model_label)
+    try:
+        instance = model.objects.only(field_name).get(pk=pk)
+    except model.DoesNotExist:
+        return None
+
+    image = getattr(instance, field_name)
+    if not image:
+        return None
+
+    variants = generate_derivatives(image.name)
+    # Only record the variants if the image wasn't replaced in the meantime
+    model.objects.filter(pk=pk, **{field_name: image.name}).update(image_variants=variants)
+    return variants
+
+
+def refresh_image_variants(instance, field_name="image"):
+    """Drops the variants of a saved instance whose image changed and queues new ones."""
+    type(instance).objects.filter(pk=instance.pk).update(image_variants={})
+    instance.image_variants = {}
+    generate_image_derivatives(instance._meta.label, instance.pk, field_name)
+
+
+@db_periodic_task(crontab(minute="*/15"), priority=settings.TASK_PRIORITIES["cleanup"])
+@lock_task("collect-unreferenced-blobs")
+def collect_unreferenced_blobs(batch_size: int = 500):
+    # Deletes image files (and their derivatives) that no row has referenced for a while
+    cutoff = timezone.now() - settings.BLOB_GC_GRACE_PERIOD
+    names = list(
+        StoredBlob.objects.filter(refcount__lte=0, released_at__lt=cutoff)
+        .values_list("name", flat=True)[:batch_size]
+    )
+
+    collected = 0
+    for name in names:
+        with transaction.atomic():
+            # Re-check, the blob may have been uploaded again since it was selected, which
+            # also restarts its grace period (see ContentAddressedStorage.save)
+            deleted, _ = StoredBlob.objects.filter(name=name, refcount__lte=0, released_at__lt=cutoff).delete()
+            if not deleted:
+                continue
+            # Unlinked before the row deletion commits, a concurrent upload of the same
+            # bytes waits for it and then writes the file again
+            storages["images"].delete(name)
+            for size in settings.IMAGE_DERIVATIVE_SIZES:
+                for image_format in settings.IMAGE_DERIVATIVE_FORMATS:
+                    default_storage.delete(derivative_name(name, size, image_format))
+        collected += 1
+    return collected
+
+
+# Start times of the tasks running in this process, by task id
+_task_started = {}
+
+
+def record_task_start(signal, task):
+    _task_started[task.id] = time.perf_counter()
+    # Set when the task was dequeued, see api.task_queue
+    enqueued_at = getattr(task, "enqueued_at", None)
+    if enqueued_at is not None:
+        metrics.task_queue_lag.observe(max(time.time() - enqueued_at, 0), task.name)
+
+
+def record_task_duration(signal, task, *args):
+    started = _task_started.pop(task.id, None)
+    if started is not None:
+        metrics.task_duration.observe(time.perf_counter() - started, task.name, signal)
+
+
+if metrics.TASK_METRICS_ENABLED:
+    signal(SIGNAL_EXECUTING)(record_task_start)
+    signal(SIGNAL_COMPLETE, SIGNAL_ERROR, SIGNAL_LOCKED, SIGNAL_INTERRUPTED)(record_task_duration)
@@ -0,0 +1,491 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from io import StringIO
+
+from unittest import skipUnless
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import storages
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Max, Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from huey.contrib.djhuey import HUEY
+from accounts.models import UserBlock, UserProfile
+from listings.models import Listing, SavedListing
+from listings.tasks import add_listing_tags
+from PIL import Image
+from rest_framework import status
+from rest_framework.test import APIClient
+from user_messages.models import Conversation, InboxCounter, Message
+from user_messages.search import search_messages
+
+from . import metrics
+from .db_routers import PIN_COOKIE, ReplicaRouter, _read_from_replica, is_pinned_to_primary, pin_to_primary
+from .management.commands.seed_marketplace import Command as SeedCommand
+from .middleware import RequestMetricsMiddleware
+from .models import StoredBlob
+from .storage import ContentAddressedStorage
+from .tasks import collect_unreferenced_blobs
+from .views import stat_cache
+
+
+class ServeImageViewTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        stat_cache.clear()
+
+        os.makedirs(os.path.join(self.media_root, "listings"))
+        Image.new("RGB", (100, 100), color=(255, 0, 0)).save(
+            os.path.join(self.media_root, "listings", "red.jpg"), format="JPEG"
+        )
+        with open(os.path.join(self.media_root, "listings", "red.jpg"), "rb") as image_file:
+            self.image_bytes = image_file.read()
+        self.url = "/media/listings/red.jpg/"
+
+    def test_serve_image_with_cache_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(b"".join(response.streaming_content), self.image_bytes)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("ETag", response)
+        self.assertIn("Last-Modified", response)
+
+    def test_if_none_match_returns_not_modified(self):
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_if_modified_since_returns_not_modified(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_byte_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), self.image_bytes[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.image_bytes)}")
+
+    def test_suffix_byte_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), self.image_bytes[-5:])
+
+    def test_stale_if_range_sends_full_file(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.image_bytes)}-")
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    @override_settings(MEDIA_SENDFILE="nginx")
+    def test_sendfile_offload(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/listings/red.jpg")
+        self.assertEqual(response.content, b"")
+
+    def test_missing_image(self):
+        response = self.client.get("/media/listings/missing.jpg/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_image_deleted_after_stat_is_not_found(self):
+        self.client.get(self.url)
+        os.remove(os.path.join(self.media_root, "listings", "red.jpg"))
+
+        # The cached stat still says the file is there
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIsNone(stat_cache.stat(os.path.join(self.media_root, "listings", "red.jpg")))
+
+    def test_path_outside_media_root(self):
+        response = self.client.get("/media/..%2F..%2Fsettings.py/")
+        self.assertIn(response.status_code, (status.HTTP_400_BAD_REQUEST, status.HTTP_404_NOT_FOUND))
+
+
+class ContentAddressedStorageTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root, BLOB_GC_GRACE_PERIOD=timedelta(0))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = User.objects.create_user(username="seller", password="password123")
+
+    def _upload(self, name, color=(255, 0, 0)):
+        image_path = os.path.join(self.media_root, "upload.jpg")
+        Image.new("RGB", (50, 50), color=color).save(image_path, format="JPEG")
+        with open(image_path, "rb") as image_file:
+            return SimpleUploadedFile(name, image_file.read(), content_type="image/jpeg")
+
+    def _create_listing(self, image):
+        return Listing.objects.create(
+            title="Pen",
+            condition="FN",
+            description="A pen.",
+            price=1.0,
+            image=image,
+            author_id=self.user,
+        )
+
+    def test_identical_uploads_share_one_file(self):
+        first = self._create_listing(self._upload("first.jpg"))
+        second = self._create_listing(self._upload("second.jpg"))
+
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r"^listings/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        directory = os.path.dirname(storages["images"].path(first.image.name))
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertEqual(StoredBlob.objects.get(name=first.image.name).refcount, 2)
+
+    def test_replacing_image_moves_reference(self):
+        listing = self._create_listing(self._upload("first.jpg"))
+        old_name = listing.image.name
+        listing.image = self._upload("second.jpg", color=(0, 0, 255))
+        listing.save()
+
+        self.assertNotEqual(listing.image.name, old_name)
+        self.assertEqual(StoredBlob.objects.get(name=old_name).refcount, 0)
+        self.assertEqual(StoredBlob.objects.get(name=listing.image.name).refcount, 1)
+
+    def test_deleted_listings_are_garbage_collected(self):
+        first = self._create_listing(self._upload("first.jpg"))
+        second = self._create_listing(self._upload("second.jpg"))
+        name = first.image.name
+
+        first.delete()
+        self.assertEqual(collect_unreferenced_blobs.call_local(), 0)
+        self.assertTrue(storages["images"].exists(name))
+
+        second.delete()
+        self.assertEqual(collect_unreferenced_blobs.call_local(), 1)
+        self.assertFalse(storages["images"].exists(name))
+        self.assertFalse(StoredBlob.objects.filter(name=name).exists())
+
+    @override_settings(BLOB_GC_GRACE_PERIOD=timedelta(hours=1))
+    def test_reupload_restarts_grace_period(self):
+        listing = self._create_listing(self._upload("first.jpg"))
+        name = listing.image.name
+        listing.delete()
+        StoredBlob.objects.filter(name=name).update(released_at=timezone.now() - timedelta(hours=2))
+
+        # Stored again before the new listing row (and its reference) exists
+        self.assertEqual(storages["images"].save("listings/again.jpg", self._upload("again.jpg")), name)
+        self.assertEqual(collect_unreferenced_blobs.call_local(), 0)
+        self.assertTrue(storages["images"].exists(name))
+
+    def test_reupload_racing_the_collector_writes_the_file_again(self):
+        listing = self._create_listing(self._upload("first.jpg"))
+        name = listing.image.name
+        listing.delete()
+
+        class RacingStorage(ContentAddressedStorage):
+            def _claim(self, name):
+                # The collector removes the row and the file after the upload saw it
+                collect_unreferenced_blobs.call_local()
+                return super()._claim(name)
+
+        storage = RacingStorage(location=self.media_root)
+        self.assertEqual(storage.save("listings/again.jpg", self._upload("again.jpg")), name)
+        self.assertTrue(storage.exists(name))
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+
+    def test_reads_stay_on_primary_unless_flagged(self):
+        self.assertIsNone(self.router.db_for_read(Listing))
+        token = _read_from_replica.set(True)
+        try:
+            self.assertEqual(self.router.db_for_read(Listing), "replica")
+            self.assertEqual(self.router.db_for_write(Listing), "default")
+        finally:
+            _read_from_replica.reset(token)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        token = _read_from_replica.set(True)
+        try:
+            self.assertIsNone(self.router.db_for_read(Listing))
+        finally:
+            _read_from_replica.reset(token)
+
+    def _request_after(self, response):
+        # A fresh request, as another worker would see it, with only the client's cookies
+        request = RequestFactory().get("/")
+        request.COOKIES = {name: morsel.value for name, morsel in response.cookies.items()}
+        return request
+
+    def test_pin_is_carried_by_the_client(self):
+        response = HttpResponse()
+        pin_to_primary(response, 1)
+        request = self._request_after(response)
+        self.assertTrue(is_pinned_to_primary(request, 1))
+        self.assertFalse(is_pinned_to_primary(request, 2))
+        self.assertFalse(is_pinned_to_primary(RequestFactory().get("/"), 1))
+
+    def test_pin_expires_and_cant_be_forged(self):
+        response = HttpResponse()
+        pin_to_primary(response, 1)
+        request = self._request_after(response)
+        with override_settings(REPLICA_STICKY_SECONDS=-1):
+            self.assertFalse(is_pinned_to_primary(request, 1))
+
+        request.COOKIES[PIN_COOKIE] = "1"
+        self.assertFalse(is_pinned_to_primary(request, 1))
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "Run with --settings=config.settings_replica")
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """Against the two SQLite files of config.settings_replica. Rows are added to the
+    replica by hand, so anything missing from it shows the read went there."""
+
+    databases = {"default", *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="seller", password="password123")
+        User.objects.using("replica").create(id=self.user.id, username="seller")
+        self.listing = Listing.objects.create(
+            title="Lamp", condition="FN", description="", price=5, image="listings/lamp.jpg",
+            author_id=self.user,
+        )
+
+    def _listed_ids(self):
+        return [listing["id"] for listing in self.client.get(reverse("listing-list")).data["results"]]
+
+    def test_browsing_reads_from_replica(self):
+        # Not replicated yet
+        self.assertEqual(self._listed_ids(), [])
+        Listing.objects.using("replica").create(
+            id=self.listing.id, title="Lamp", condition="FN", description="", price=5,
+            image="listings/lamp.jpg", author_id_id=self.user.id,
+        )
+        self.assertEqual(self._listed_ids(), [self.listing.id])
+
+    def test_writer_reads_own_writes(self):
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self._listed_ids(), [])
+        response = self.client.post(reverse("listing-like-listing", kwargs={"pk": self.listing.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Pinned to the primary after writing
+        self.assertEqual(self._listed_ids(), [self.listing.id])
+
+    def test_pin_is_kept_by_the_client(self):
+        self.client.force_authenticate(user=self.user)
+        self.client.post(reverse("listing-like-listing", kwargs={"pk": self.listing.id}))
+        pin = self.client.cookies[PIN_COOKIE].value
+
+        # Nothing about the pin is kept server side, a fresh client without the cookie
+        # reads from the replica and one sending it is pinned
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self._listed_ids(), [])
+        self.client.cookies[PIN_COOKIE] = pin
+        self.assertEqual(self._listed_ids(), [self.listing.id])
+
+    def test_writes_go_to_primary(self):
+        self.client.force_authenticate(user=self.user)
+        self.client.post(reverse("listing-like-listing", kwargs={"pk": self.listing.id}))
+        self.assertEqual(Listing.objects.using("default").get(id=self.listing.id).likes, 1)
+        self.assertFalse(Listing.objects.using("replica").exists())
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_histogram_exposition(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram("latency_seconds", "Latency.", ["route"], buckets=(0.1, 1), registry=registry)
+        histogram.observe(0.05, "a/")
+        histogram.observe(0.5, "a/")
+        histogram.observe(5, "a/")
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:2], ["# HELP latency_seconds Latency.", "# TYPE latency_seconds histogram"])
+        self.assertIn('latency_seconds_bucket{route="a/",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="a/",le="1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{route="a/",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_sum{route="a/"} 5.55', lines)
+        self.assertIn('latency_seconds_count{route="a/"} 3', lines)
+
+    def test_requests_are_recorded_by_route(self):
+        user = User.objects.create_user(username="seller", password="password123")
+        listing = Listing.objects.create(
+            title="Desk lamp", condition="FN", description="", price=5, image="listings/lamp.jpg", author_id=user
+        )
+        self.client.get(reverse("listing-detail", args=[listing.id]))
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        # Labelled with the URL name, not the listing id
+        self.assertIn('http_requests_total{method="GET",route="listing-detail",status="200"} 1', body)
+        self.assertIn('http_request_db_queries_count{method="GET",route="listing-detail"}', body)
+        self.assertIn('http_response_size_bytes_count{method="GET",route="listing-detail"}', body)
+
+    def test_middleware_is_async_under_asgi(self):
+        async def get_response(request):
+            return None
+
+        self.assertTrue(iscoroutinefunction(RequestMetricsMiddleware(get_response)))
+        self.assertFalse(iscoroutinefunction(RequestMetricsMiddleware(lambda request: None)))
+
+    async def test_async_requests_are_recorded(self):
+        response = await self.async_client.get(reverse("message-wait"), {"after_id": 0})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        body = await sync_to_async(metrics.REGISTRY.render)()
+        self.assertIn('http_requests_total{method="GET",route="message-wait",status="401"}', body)
+
+    @override_settings(METRICS_TOKEN="scrape-token")
+    def test_token_required_when_configured(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape-token")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_task_duration_and_queue_lag(self):
+        task = HUEY.deserialize_task(HUEY.serialize_task(add_listing_tags.s(0, [])))
+        # As if the task had waited in the queue for three seconds
+        task.enqueued_at -= 3
+        HUEY.execute(task)
+
+        body = metrics.REGISTRY.render()
+        self.assertIn('huey_task_duration_seconds_count{task="add_listing_tags",outcome="complete"} 1', body)
+        self.assertIn('huey_task_queue_lag_seconds_bucket{task="add_listing_tags",le="2.5"} 0', body)
+        self.assertIn('huey_task_queue_lag_seconds_bucket{task="add_listing_tags",le="5"} 1', body)
+
+    def test_tasks_queued_before_enqueue_times_still_run(self):
+        task = add_listing_tags.s(0, [])
+        task = HUEY.deserialize_task(HUEY.serializer.serialize(HUEY._registry.create_message(task)))
+        self.assertFalse(hasattr(task, "enqueued_at"))
+        self.assertEqual(task.args, (0, []))
+
+
+class SeedMarketplaceTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _seed(self, seed=7):
+        call_command(
+            "seed_marketplace", "--users", "40", "--listings", "120", "--messages", "600", "--blocks", "5",
+            "--seed", str(seed), "--end-date", "2026-01-31", "--batch-size", "100", stdout=StringIO(),
+        )
+
+    def _snapshot(self):
+        return list(
+            Message.objects.order_by("id").values_list(
+                "content", "sender__username", "receiver__username", "related_listing__title", "created_at"
+            )
+        )
+
+    def test_counts_and_denormalized_state_are_consistent(self):
+        self._seed()
+
+        self.assertEqual(User.objects.filter(username__startswith="seed7_").count(), 40)
+        self.assertEqual(UserProfile.objects.count(), 40)
+        self.assertEqual(Listing.objects.count(), 120)
+        self.assertEqual(Message.objects.count(), 600)
+        self.assertEqual(UserBlock.objects.count(), 5)
+        self.assertFalse(Listing.objects.filter(tags=None).exists())
+        self.assertEqual(Listing.objects.aggregate(saves=Sum("saves"))["saves"], SavedListing.objects.count())
+        self.assertFalse(Message.objects.filter(created_at__gte=datetime(2026, 2, 1, tzinfo=dt_timezone.utc)).exists())
+
+        for conversation in Conversation.objects.all():
+            messages = Message.objects.filter(conversation=conversation)
+            self.assertEqual(conversation.last_message_id, messages.aggregate(last=Max("id"))["last"])
+            for user_id in (conversation.user_one_id, conversation.user_two_id):
+                unread = messages.filter(receiver_id=user_id, id__gt=conversation.last_read_for(user_id)).count()
+                self.assertEqual(conversation.unread_for(user_id), unread)
+        self.assertEqual(
+            InboxCounter.objects.aggregate(unread=Sum("unread"))["unread"],
+            Conversation.objects.aggregate(unread=Sum("user_one_unread") + Sum("user_two_unread"))["unread"],
+        )
+
+        # The search index was rebuilt after the load and its triggers restored
+        user_id = Message.objects.filter(content__contains="available").values_list("sender_id", flat=True)[0]
+        self.assertTrue(search_messages(user_id, "available")[0])
+
+    def test_keeps_generated_timestamps(self):
+        self._seed()
+        end = datetime(2026, 2, 1, tzinfo=dt_timezone.utc)
+        self.assertFalse(Listing.objects.filter(last_modified_at__gte=end).exists())
+        self.assertFalse(SavedListing.objects.filter(saved_at__gte=end).exists())
+        self.assertFalse(Message.objects.filter(edited_at__gte=end).exists())
+        # The fields are automatic again once the load is over
+        self.assertTrue(Message._meta.get_field("created_at").auto_now_add)
+        self.assertTrue(Listing._meta.get_field("last_modified_at").auto_now)
+
+    def test_dropped_indexes_are_restored_after_a_failed_load(self):
+        def indexes():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
+                return sorted(name for (name,) in cursor.fetchall())
+
+        class FailingCommand(SeedCommand):
+            def _seed_messages(self):
+                raise RuntimeError("Interrupted")
+
+        before = indexes()
+        with self.assertRaises(RuntimeError):
+            call_command(
+                FailingCommand(), "--users", "10", "--listings", "10", "--drop-indexes", stdout=StringIO()
+            )
+        self.assertEqual(indexes(), before)
+
+    def test_stops_when_conversations_run_out(self):
+        stderr = StringIO()
+        call_command(
+            "seed_marketplace", "--users", "3", "--listings", "1", "--messages", "5000", "--thread-length", "1",
+            "--seed", "9", stdout=StringIO(), stderr=stderr,
+        )
+        # One listing and three users allow two conversations with the seller
+        self.assertEqual(Conversation.objects.count(), 2)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertIn("Only 2 of 5,000 messages", stderr.getvalue())
+
+    def test_same_seed_generates_the_same_data(self):
+        self._seed()
+        first = self._snapshot()
+        with self.assertRaises(CommandError):
+            self._seed()
+
+        User.objects.filter(username__startswith="seed7_").delete()
+        self._seed()
+        self.assertEqual(self._snapshot(), first)
+
+        self._seed(seed=8)
+        self.assertNotEqual(self._snapshot()[len(first):], first)
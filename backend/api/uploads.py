@@ -0,0 +1,109 @@
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from PIL import Image, UnidentifiedImageError
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.parsers import MultiPartParser
+
+logger = logging.getLogger(__name__)
+
+# Extra room on top of the image size cap for the other multipart fields and boundaries
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Uploaded image is too large."
+    default_code = "upload_too_large"
+
+
+class StreamingImageUploadHandler(TemporaryFileUploadHandler):
+    """Streams uploaded images to a temporary file and validates them as they arrive.
+
+    The request is rejected from its Content-Length before any of the body is read when it
+    can't fit under IMAGE_UPLOAD_MAX_SIZE, and otherwise as soon as a file crosses the cap.
+    The format and dimensions are read from the image header, which Pillow parses without
+    decoding the bitmap, so an invalid file is rejected after its first chunks. Only the
+    header bytes are ever held in memory.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.peak_buffered = 0
+        self.total_bytes = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.IMAGE_UPLOAD_MAX_SIZE + FORM_OVERHEAD_BYTES:
+            raise UploadTooLarge()
+        return super().handle_raw_input(input_data, META, content_length, boundary, encoding)
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_size = 0
+        self.header = bytearray()
+        self.image_info = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file_size += len(raw_data)
+        self.total_bytes += len(raw_data)
+        if self.file_size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            raise UploadTooLarge()
+
+        if self.image_info is None:
+            self.header.extend(raw_data)
+            self.peak_buffered = max(self.peak_buffered, len(self.header))
+            self._sniff(final=len(self.header) >= settings.IMAGE_UPLOAD_SNIFF_BYTES)
+        else:
+            self.peak_buffered = max(self.peak_buffered, len(raw_data))
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if self.image_info is None:
+            self._sniff(final=True)
+
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.image_info = self.image_info
+        return uploaded_file
+
+    def upload_complete(self):
+        logger.info(
+            "Streamed %d upload bytes to disk for %s, peak %d bytes buffered in memory",
+            self.total_bytes,
+            self.request.path if self.request else "-",
+            self.peak_buffered,
+        )
+        if self.request is not None:
+            self.request.upload_stats = {
+                "bytes": self.total_bytes,
+                "peak_buffered_bytes": self.peak_buffered,
+            }
+
+    def _sniff(self, final):
+        # Reads only the image header, the pixel data is never decoded here
+        try:
+            with Image.open(BytesIO(self.header)) as image:
+                image_format, (width, height) = image.format, image.size
+        except (UnidentifiedImageError, SyntaxError, OSError, ValueError):
+            if final:
+                raise ValidationError({self.field_name: ["Upload a valid image."]})
+            # The header may continue in the next chunk
+            return
+
+        if image_format not in settings.IMAGE_UPLOAD_ALLOWED_FORMATS:
+            raise ValidationError({self.field_name: [f"Unsupported image format {image_format}."]})
+        if width * height > settings.IMAGE_UPLOAD_MAX_PIXELS:
+            raise ValidationError({self.field_name: ["Image dimensions are too large."]})
+        self.image_info = {"format": image_format, "width": width, "height": height}
+        self.header = bytearray()
+
+
+class StreamingImageMultiPartParser(MultiPartParser):
+    """Multipart parser that runs file fields through StreamingImageUploadHandler."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context["request"]
+        request._request.upload_handlers = [StreamingImageUploadHandler(request._request)]
+        return super().parse(stream, media_type, parser_context)
@@ -1,28 +1,227 @@
 import mimetypes
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 
 from django.conf import settings
-from django.http import FileResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, parse_http_date_safe
 from django.views import View
 from rest_framework import status
-from rest_framework.response import Response
+
+from . import metrics
+from .images import derivative_name, pick_derivative_size
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@lru_cache(maxsize=64)
+def _guess_mime_type(extension):
+    mime_type, _ = mimetypes.guess_type(f"file{extension}")
+    return mime_type or "application/octet-stream"
+
+
+class _StatCache:
+    """Small LRU of os.stat results so hot images don't hit the filesystem on every request.
+
+    Entries expire after MEDIA_STAT_CACHE_SECONDS, missing files are cached as None so a
+    derivative that hasn't been generated yet is only probed once per expiry.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stat(self, path):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(path)
+                return entry[1]
+
+        try:
+            result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            result = None
+
+        with self._lock:
+            self._entries[path] = (now + settings.MEDIA_STAT_CACHE_SECONDS, result)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def evict(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+stat_cache = _StatCache()
 
 
 class ServeImageView(View):
     """Serve images with correct Content type.
+
+    Optional query parameters pick a resized copy of the image, if one was generated:
+    ?size=<width in px>&format=<webp|jpeg>. Without a format, WebP is served to clients
+    that accept it.
+
+    Responses carry long lived caching headers and ETag/Last-Modified validators, and
+    single byte ranges are supported. With MEDIA_SENDFILE set, the bytes are handed off to
+    the front proxy through X-Accel-Redirect (nginx) or X-Sendfile (apache).
     """
 
     def get(self, request, image_path):
+        image_path, derivative_found = self._resolve_derivative(request, image_path)
+
         # Construct the full path to the image
         full_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, image_path))
-        if not full_path.startswith(settings.MEDIA_ROOT):
-            return Response({"error": "Invalid image path."}, status=status.HTTP_400_BAD_REQUEST)
-        if not os.path.exists(full_path):
-            return Response({"error": "Image not found."}, status=status.HTTP_404_NOT_FOUND)
+        if not full_path.startswith(os.path.join(settings.MEDIA_ROOT, "")):
+            return JsonResponse({"error": "Invalid image path."}, status=status.HTTP_400_BAD_REQUEST)
+        file_stat = stat_cache.stat(full_path)
+        if file_stat is None:
+            return JsonResponse({"error": "Image not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        # Attempt to determine mime type from the file extension
+        mime_type = _guess_mime_type(os.path.splitext(full_path)[1].lower())
+        last_modified = int(file_stat.st_mtime)
+        etag = f'"{last_modified:x}-{file_stat.st_size:x}"'
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return self._add_cache_headers(not_modified, etag, last_modified, derivative_found)
+
+        if settings.MEDIA_SENDFILE:
+            response = self._sendfile_response(image_path, full_path, mime_type)
+        else:
+            try:
+                response = self._file_response(request, full_path, file_stat.st_size, mime_type, etag, last_modified)
+            except FileNotFoundError:
+                # Deleted since it was stat'ed, e.g. by collect_unreferenced_blobs
+                stat_cache.evict(full_path)
+                return JsonResponse({"error": "Image not found."}, status=status.HTTP_404_NOT_FOUND)
+        response["Accept-Ranges"] = "bytes"
+        return self._add_cache_headers(response, etag, last_modified, derivative_found)
+
+    def _resolve_derivative(self, request, image_path):
+        # Returns the path to serve and whether a requested variant was found, None if no
+        # variant was requested. Falls back to the original when it doesn't exist (yet)
+        try:
+            size = pick_derivative_size(int(request.GET["size"]))
+        except (KeyError, ValueError):
+            return image_path, None
+        if size is None:
+            return image_path, None
+
+        image_format = request.GET.get("format")
+        if image_format not in settings.IMAGE_DERIVATIVE_FORMATS:
+            accepts_webp = "image/webp" in request.headers.get("Accept", "")
+            image_format = "webp" if accepts_webp and "webp" in settings.IMAGE_DERIVATIVE_FORMATS else "jpeg"
+
+        derived_path = derivative_name(image_path, size, image_format)
+        if stat_cache.stat(os.path.join(settings.MEDIA_ROOT, derived_path)) is not None:
+            return derived_path, True
+        return image_path, False
+
+    def _file_response(self, request, full_path, file_size, mime_type, etag, last_modified):
+        byte_range = self._parse_range(request, file_size, etag, last_modified)
+        if byte_range is None:
+            return FileResponse(open(full_path, "rb"), content_type=mime_type)
+        if byte_range is False:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"] = f"bytes */{file_size}"
+            return response
+
+        start, end = byte_range
+        length = end - start + 1
+        # Opened here rather than in the generator, so a missing file is still a 404
+        response = StreamingHttpResponse(
+            self._read_range(open(full_path, "rb"), start, length),
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type=mime_type,
+        )
+        response["Content-Length"] = str(length)
+        response["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        return response
 
-        # Attempt to determine mime type using Mimetypes
-        mime_type, _ = mimetypes.guess_type(full_path)
-        mime_type = mime_type or "application/octet-stream"
+    def _sendfile_response(self, image_path, full_path, mime_type):
+        # The proxy reads the file (and handles ranges), the body here stays empty
+        response = HttpResponse(content_type=mime_type)
+        if settings.MEDIA_SENDFILE == "nginx":
+            response["X-Accel-Redirect"] = f"{settings.MEDIA_SENDFILE_URL_PREFIX.rstrip('/')}/{image_path}"
+        else:
+            response["X-Sendfile"] = full_path
+        return response
+
+    def _parse_range(self, request, file_size, etag, last_modified):
+        """Returns (start, end) for a satisfiable single range, False for an unsatisfiable
+        one, or None when the whole file should be sent."""
+        match = RANGE_RE.match(request.headers.get("Range", "").strip())
+        if not match or match.groups() == ("", ""):
+            # Missing, malformed or multi-part ranges get the full file
+            return None
+
+        # If-Range: only honour the range if the client's copy is still current
+        if_range = request.headers.get("If-Range")
+        if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+            return None
+
+        first, last = match.groups()
+        if first == "":
+            # Suffix range, the last N bytes
+            start, end = max(file_size - int(last), 0), file_size - 1
+        else:
+            start = int(first)
+            end = min(int(last), file_size - 1) if last else file_size - 1
+        if start >= file_size or start > end:
+            return False
+        return start, end
+
+    @staticmethod
+    def _read_range(image_file, start, length, chunk_size=64 * 1024):
+        with image_file:
+            image_file.seek(start)
+            while length > 0:
+                chunk = image_file.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    @staticmethod
+    def _add_cache_headers(response, etag, last_modified, derivative_found):
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        if derivative_found is False:
+            # The original stood in for a variant that is still being generated
+            response["Cache-Control"] = settings.MEDIA_FALLBACK_CACHE_CONTROL
+        else:
+            response["Cache-Control"] = settings.MEDIA_CACHE_CONTROL
+        if derivative_found is not None:
+            response["Vary"] = "Accept"
+        return response
+
+
+class MetricsView(View):
+    """Prometheus scrape endpoint, see api.metrics.
+
+    When METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
 
-        # Return file with the guessed Content type
-        return FileResponse(open(full_path, "rb"), content_type=mime_type)
\ No newline at end of file
+    def get(self, request):
+        if settings.METRICS_TOKEN and not constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"
+        ):
+            return JsonResponse({"error": "Invalid credentials"}, status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,379 @@
+"""HTTP load test of the main API flows against a running server.
+
+Each virtual user logs in as one of the accounts created by seed_marketplace and loops
+over scripted journeys, picked by weight:
+
+    browse  the hot feed, filtered listing pages, listing details, images, similar
+            listings and a search (anonymous)
+    engage  likes, saves and the saved listings page
+    sell    creates a listing with an image upload, then views it
+    chat    the inbox, unread badge, a thread, a reply and marking it read
+
+Requests are grouped per endpoint (method and route, ids replaced by {id}). The report
+gives throughput, latency percentiles and error rates per endpoint and overall, as JSON.
+
+    cd backend
+    python manage.py seed_marketplace --users 1000 --listings 20000 --messages 200000
+    python manage.py runserver --noreload   # or the production server setup
+    python benchmarks/load_test.py --users 50 --seconds 60 --output results.json
+
+Only the standard library and Pillow are needed, the server can be on another machine.
+"""
+
+import argparse
+import base64
+import http.client
+import io
+import json
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+from PIL import Image
+
+JOURNEYS = ("browse", "engage", "sell", "chat")
+DEFAULT_WEIGHTS = "browse=6,engage=2,sell=1,chat=3"
+SEARCH_TERMS = ["textbook", "laptop", "desk", "chair", "calculator", "backpack", "lamp", "headphones", "mini-fridge"]
+CONDITIONS = ["FN", "MW", "FR", "WW", "RD"]
+REPLIES = ["Is this still available?", "Could you do a bit less?", "Sounds good, see you then.", "Deal."]
+ID_RE = re.compile(r"/\d+(?=/|$)")
+
+
+class JourneyError(Exception):
+    """Ends the current journey, the failed request has already been recorded."""
+
+
+class Stats:
+    """Latencies and statuses per endpoint, shared by every virtual user."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.journeys = defaultdict(int)
+
+    def record(self, endpoint, status, latency, error):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][str(status)] += 1
+            if error:
+                self.errors[endpoint] += 1
+
+    def journey(self, name):
+        with self.lock:
+            self.journeys[name] += 1
+
+    def report(self, elapsed, options):
+        def summary(latencies, errors, statuses=None):
+            latencies = sorted(latencies)
+            entry = {
+                "requests": len(latencies),
+                "rps": round(len(latencies) / elapsed, 2),
+                "errors": errors,
+                "error_rate": round(errors / len(latencies), 4) if latencies else 0,
+                "latency_ms": {
+                    "mean": round(statistics.mean(latencies) * 1000, 2) if latencies else 0,
+                    **{
+                        f"p{percentile}": round(percentile_of(latencies, percentile / 100) * 1000, 2)
+                        for percentile in (50, 90, 95, 99)
+                    },
+                    "max": round(latencies[-1] * 1000, 2) if latencies else 0,
+                },
+            }
+            if statuses is not None:
+                entry["statuses"] = dict(sorted(statuses.items()))
+            return entry
+
+        with self.lock:
+            endpoints = {
+                endpoint: summary(latencies, self.errors[endpoint], self.statuses[endpoint])
+                for endpoint, latencies in sorted(self.latencies.items())
+            }
+            everything = [latency for latencies in self.latencies.values() for latency in latencies]
+            return {
+                "config": options,
+                "duration_seconds": round(elapsed, 2),
+                "journeys": dict(self.journeys),
+                "total": summary(everything, sum(self.errors.values())),
+                "endpoints": endpoints,
+            }
+
+
+def percentile_of(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else 0.0
+
+
+def endpoint_name(method, path):
+    return f"{method} {ID_RE.sub('/{id}', path.split('?', 1)[0])}"
+
+
+def make_image(rng):
+    buffer = io.BytesIO()
+    Image.new("RGB", (800, 600), tuple(rng.randrange(256) for _ in range(3))).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n".encode()
+        )
+        body.write(content)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, options, stats, deadline):
+        super().__init__(daemon=True)
+        self.options = options
+        self.stats = stats
+        self.deadline = deadline
+        self.rng = random.Random(options["seed"] * 100_003 + index)
+        self.username = f"{options['user_prefix']}{self.rng.randrange(options['accounts'])}"
+        target = urlsplit(options["base_url"])
+        self.connection_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+        self.netloc = target.netloc
+        self.connection = None
+        self.token = None
+        self.user_id = None
+        # Listing ids seen while browsing, reused by the other journeys
+        self.listings = []
+
+    def request(self, method, path, body=None, content_type="application/json", auth=True, expect=(200,), name=None):
+        """Sends a request on the user's keep-alive connection and records it. Returns the
+        decoded JSON body (or None), raises JourneyError on an unexpected status."""
+        headers = {"Accept": "application/json"}
+        if auth and self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if body is not None and content_type == "application/json":
+            body = json.dumps(body).encode()
+        if body is not None:
+            headers["Content-Type"] = content_type
+
+        endpoint = name or endpoint_name(method, path)
+        started = time.perf_counter()
+        for attempt in range(2):
+            reused = self.connection is not None
+            try:
+                if self.connection is None:
+                    self.connection = self.connection_class(self.netloc, timeout=self.options["timeout"])
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                payload = response.read()
+                status = response.status
+                break
+            except (OSError, http.client.HTTPException) as exc:
+                self.connection.close()
+                self.connection = None
+                # The server may close an idle keep-alive connection, retry that once on a
+                # new one like browsers do
+                stale = isinstance(exc, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+                if not (reused and stale and attempt == 0):
+                    self.stats.record(endpoint, "connection_error", time.perf_counter() - started, True)
+                    raise JourneyError(endpoint)
+
+        error = status not in expect
+        self.stats.record(endpoint, status, time.perf_counter() - started, error)
+        if error:
+            raise JourneyError(endpoint)
+        if payload and response.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(payload)
+        return None
+
+    def login(self):
+        tokens = self.request(
+            "POST", "/api/token/", {"username": self.username, "password": self.options["password"]}, auth=False
+        )
+        self.token = tokens["access"]
+        # The access token carries the user id, saves a request to find out who we are
+        claims = self.token.split(".")[1]
+        self.user_id = json.loads(base64.urlsafe_b64decode(claims + "=" * (-len(claims) % 4)))["user_id"]
+
+    def think(self):
+        if self.options["think_time"]:
+            time.sleep(self.rng.expovariate(1 / self.options["think_time"]))
+
+    def run(self):
+        journeys, weights = zip(*self.options["weights"].items())
+        while time.monotonic() < self.deadline:
+            journey = self.rng.choices(journeys, weights=weights)[0]
+            try:
+                if self.token is None:
+                    self.login()
+                getattr(self, f"journey_{journey}")()
+                self.stats.journey(journey)
+            except JourneyError:
+                pass
+        if self.connection is not None:
+            self.connection.close()
+
+    def _remember(self, page):
+        results = page.get("results", page) if isinstance(page, dict) else page
+        ids = [listing["id"] for listing in results or ()]
+        self.listings = (self.listings + ids)[-200:]
+        return results
+
+    def _pick_listing(self):
+        if not self.listings:
+            self._remember(self.request("GET", "/api/listings/?ordering=-hot_score", auth=False))
+        if not self.listings:
+            raise JourneyError("no listings")
+        return self.rng.choice(self.listings)
+
+    def journey_browse(self):
+        rng = self.rng
+        self._remember(self.request("GET", "/api/listings/?ordering=-hot_score", auth=False))
+        self.think()
+        query = {"condition": rng.choice(CONDITIONS), "max_price": rng.choice([20, 50, 100, 500])}
+        self._remember(
+            self.request("GET", f"/api/listings/?{urlencode(query)}", auth=False, name="GET /api/listings/?filters")
+        )
+        self.think()
+        listing = self.request("GET", f"/api/listings/{self._pick_listing()}/", auth=False)
+        image = urlsplit(listing.get("image") or "").path
+        if image:
+            # The media route ends with a slash, APPEND_SLASH would answer with a redirect
+            image = image if image.endswith("/") else f"{image}/"
+            size = rng.choice(["", "?size=400&format=webp", "?size=200"])
+            self.request("GET", f"{image}{size}", auth=False, name="GET /media/{image}")
+        self.request("GET", f"/api/listings/{listing['id']}/similar/", auth=False)
+        self.think()
+        # Last, so a slow search doesn't hide the steps above
+        search = urlencode({"search": rng.choice(SEARCH_TERMS)})
+        self._remember(self.request("GET", f"/api/listings/?{search}", auth=False, name="GET /api/listings/?search"))
+
+    def journey_engage(self):
+        listing_id = self._pick_listing()
+        self.request("POST", f"/api/listings/{listing_id}/like_listing/")
+        self.think()
+        # Saving twice is a 400, which a real client would treat as already saved
+        saved = self.rng.random() < 0.5
+        self.request("POST", f"/api/listings/{listing_id}/save_listing/", expect=(201, 400))
+        self.request("GET", "/api/listings/list_saved_listings/")
+        if saved:
+            self.request("DELETE", f"/api/listings/{listing_id}/remove_saved_listing/", expect=(204, 400))
+
+    def journey_sell(self):
+        rng = self.rng
+        body, content_type = encode_multipart(
+            {
+                "title": f"Load test {rng.choice(SEARCH_TERMS)}",
+                "condition": rng.choice(CONDITIONS),
+                "description": "Created by benchmarks/load_test.py",
+                "price": f"{rng.uniform(5, 200):.2f}",
+            },
+            {"image": ("listing.jpg", make_image(rng), "image/jpeg")},
+        )
+        listing = self.request("POST", "/api/listings/", body, content_type=content_type, expect=(201,))
+        self.think()
+        self.request("GET", f"/api/listings/{listing['id']}/")
+
+    def journey_chat(self):
+        rng = self.rng
+        inbox = self.request("GET", "/api/messages/")
+        self.request("GET", "/api/messages/unread_count/")
+        self.think()
+        if inbox:
+            last = rng.choice(inbox)
+            other = last["receiver"] if last["sender"] == self.user_id else last["sender"]
+            listing_id = last["related_listing"]
+            self.request("GET", f"/api/messages/with_user/?{urlencode({'user': other, 'listing': listing_id})}")
+            conversation = last.get("conversation")
+        else:
+            # Nobody to talk to yet, ask the seller of a listing from the feed
+            listing = self.request("GET", f"/api/listings/{self._pick_listing()}/", auth=False)
+            other, listing_id, conversation = listing["author_id"], listing["id"], None
+
+        self.think()
+        message = self.request(
+            "POST",
+            "/api/messages/",
+            {"receiver": other, "related_listing": listing_id, "content": rng.choice(REPLIES)},
+            # Blocked pairs and messages to oneself are refused, as they should be
+            expect=(201, 400, 403),
+        )
+        conversation = (message or {}).get("conversation") or conversation
+        if conversation:
+            self.request("POST", "/api/messages/mark_read/", {"conversation": conversation})
+
+
+def parse_weights(value):
+    weights = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in JOURNEYS:
+            raise argparse.ArgumentTypeError(f"unknown journey {name!r}, expected one of {', '.join(JOURNEYS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users.")
+    parser.add_argument("--seconds", type=float, default=60, help="How long the test runs.")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which the users start.")
+    parser.add_argument("--think-time", type=float, default=0, help="Mean pause between steps, 0 for none.")
+    parser.add_argument("--weights", type=parse_weights, default=DEFAULT_WEIGHTS, help=f"Default {DEFAULT_WEIGHTS}.")
+    parser.add_argument("--user-prefix", default="seed0_", help="Username prefix of the seeded accounts.")
+    parser.add_argument("--accounts", type=int, default=1000, help="How many seeded accounts to log in as.")
+    parser.add_argument("--password", default="password123", help="Password of the seeded accounts.")
+    parser.add_argument("--timeout", type=float, default=30, help="Per request timeout in seconds.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    if isinstance(args.weights, str):
+        args.weights = parse_weights(args.weights)
+
+    options = {key: value for key, value in vars(args).items() if key != "output"}
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.seconds
+    users = []
+    for index in range(args.users):
+        user = VirtualUser(index, options, stats, deadline)
+        user.start()
+        users.append(user)
+        time.sleep(args.ramp_up / args.users)
+    for user in users:
+        user.join()
+    report = stats.report(time.monotonic() - started, options)
+
+    total = report["total"]
+    print(
+        f"{total['requests']:,} requests, {total['rps']:.1f}/s, {total['error_rate']:.2%} errors, "
+        f"p50 {total['latency_ms']['p50']}ms p95 {total['latency_ms']['p95']}ms p99 {total['latency_ms']['p99']}ms",
+        file=sys.stderr,
+    )
+    for endpoint, entry in report["endpoints"].items():
+        print(
+            f"  {endpoint:55} {entry['requests']:7,} {entry['rps']:8.1f}/s {entry['error_rate']:7.2%}"
+            f"  p50 {entry['latency_ms']['p50']:8.2f}  p95 {entry['latency_ms']['p95']:8.2f}"
+            f"  p99 {entry['latency_ms']['p99']:8.2f}",
+            file=sys.stderr,
+        )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Benchmark of message search, the FTS5 index against a content__icontains scan.
+
+Builds a throwaway SQLite database with the project schema, fills it with synthetic
+messages and times both queries for a sample of users and search terms.
+
+    cd backend
+    python benchmarks/message_search.py --messages 2000000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+WORDS = (
+    "bike lock desk lamp textbook calculus chair mini fridge monitor keyboard mouse charger "
+    "jacket backpack kettle microwave poster shelf mattress pickup campus library dorm cash "
+    "venmo price offer available tomorrow tonight weekend meet still condition new used works"
+).split()
+
+
+def make_vocabulary(size, rng):
+    syllables = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "pe", "do", "re", "fa"]
+    vocabulary = set(WORDS)
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=50, help="Searches timed per method.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="message_search_")
+    database = os.path.join(directory, "benchmark.sqlite3")
+
+    from django.conf import settings
+
+    settings.DATABASES["default"]["NAME"] = database
+
+    import django
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+    from django.db.models import Q
+
+    from user_messages.models import Message
+    from user_messages.search import MESSAGE_INDEX, search_messages
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    # Zipf-like word and user frequencies, a few words are very common and most are rare,
+    # and a few users have a long message history
+    word_weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    user_ids = range(1, args.users + 1)
+    user_weights = list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(args.users)))
+
+    print(f"Generating {args.messages:,} messages between {args.users:,} users in {database}")
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        # Users and listings are irrelevant to search, skip creating them
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        cursor.execute("PRAGMA journal_mode = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        # Bulk load without the sync triggers, then index everything in one pass
+        cursor.execute(f"DROP TRIGGER {MESSAGE_INDEX.table}_insert")
+
+        batch = []
+        for message_id in range(1, args.messages + 1):
+            sender, receiver = rng.choices(user_ids, cum_weights=user_weights, k=2)
+            content = " ".join(rng.choices(vocabulary, cum_weights=word_weights, k=rng.randint(4, 16)))
+            batch.append((message_id, content, sender, receiver))
+            if len(batch) == 50_000:
+                cursor.executemany(
+                    "INSERT INTO user_messages_message (id, content, created_at, edited_at, edited, "
+                    "related_listing_id, sender_id, receiver_id) "
+                    "VALUES (%s, %s, '2025-01-01', '2025-01-01', 0, 1, %s, %s)",
+                    batch,
+                )
+                batch = []
+        if batch:
+            cursor.executemany(
+                "INSERT INTO user_messages_message (id, content, created_at, edited_at, edited, "
+                "related_listing_id, sender_id, receiver_id) "
+                "VALUES (%s, %s, '2025-01-01', '2025-01-01', 0, 1, %s, %s)",
+                batch,
+            )
+        print(f"  inserted in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        cursor.execute(MESSAGE_INDEX.rebuild)
+        cursor.execute(MESSAGE_INDEX.optimize)
+        print(f"  FTS index built in {time.perf_counter() - started:.1f}s")
+        cursor.execute("ANALYZE")
+
+    print(f"  database size {os.path.getsize(database) / 1024 ** 2:.0f} MiB")
+
+    # Users are numbered by activity, so the first ids are the heaviest users
+    groups = {
+        "sampled users": rng.choices(user_ids, cum_weights=user_weights, k=args.queries),
+        "heaviest users": list(user_ids[:10]),
+    }
+    terms = {"frequent terms": vocabulary[:20], "rare terms": vocabulary[len(vocabulary) // 4:]}
+
+    def icontains(user, term):
+        return list(
+            Message.objects.filter(Q(sender_id=user) | Q(receiver_id=user), content__icontains=term)
+            .order_by("-id")[:20]
+        )
+
+    def fts(user, term):
+        return search_messages(user, term, page_size=20)
+
+    print("\nms per search")
+    for name, search in (("icontains", icontains), ("FTS5", fts)):
+        for user_group, users in groups.items():
+            for term_group, vocabulary_slice in terms.items():
+                samples = []
+                for user in users:
+                    term = rng.choice(vocabulary_slice)
+                    started = time.perf_counter()
+                    search(user, term)
+                    samples.append((time.perf_counter() - started) * 1000)
+                print(
+                    f"  {name:10} {user_group:15} {term_group:15}"
+                    f"  mean {statistics.mean(samples):8.2f}"
+                    f"  p50 {percentile(samples, 0.5):8.2f}  p95 {percentile(samples, 0.95):8.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
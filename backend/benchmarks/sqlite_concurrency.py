@@ -0,0 +1,139 @@
+"""Benchmark of concurrent writes against SQLite with and without the tuned profile.
+
+Runs several writer processes against a fresh database for each SQLITE_PROFILE (see
+config/settings.py). Each writer sends messages and likes listings through the services,
+as web workers and huey tasks do, and counts "database is locked" failures.
+
+    cd backend
+    python benchmarks/sqlite_concurrency.py --writers 8 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ("default", "tuned")
+
+
+def setup_django(profile, database):
+    # Runs in a fresh (spawned) process, settings are read once per process
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "config.settings"
+    os.environ["SQLITE_PROFILE"] = profile
+
+    from django.conf import settings
+
+    settings.DATABASES["default"]["NAME"] = database
+
+    import django
+
+    django.setup()
+
+
+def prepare(profile, database, users, listings):
+    setup_django(profile, database)
+
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+
+    from listings.models import Listing
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+    User.objects.bulk_create([User(username=f"user{i}", password="!") for i in range(users)])
+    user_ids = list(User.objects.values_list("id", flat=True))
+    Listing.objects.bulk_create(
+        [
+            Listing(
+                title=f"Listing {i}", condition="FN", description="", price=1,
+                image="listings/benchmark.jpg", author_id_id=user_ids[i % len(user_ids)],
+            )
+            for i in range(listings)
+        ]
+    )
+
+
+def write(profile, database, seconds, seed):
+    setup_django(profile, database)
+
+    import random
+
+    from django.contrib.auth.models import User
+    from django.db import OperationalError, close_old_connections
+
+    from listings.models import Listing
+    from listings.services.listing_services import ListingService
+    from user_messages.services.message_services import MessageService
+
+    rng = random.Random(seed)
+    users = list(User.objects.all())
+    listings = list(Listing.objects.all())
+
+    committed, locked, latencies = 0, 0, []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        # Mostly messages, which read before they write, and some single-UPDATE likes
+        started = time.perf_counter()
+        try:
+            if rng.random() < 0.7:
+                sender, receiver = rng.sample(users, 2)
+                MessageService.create_message(sender, receiver, rng.choice(listings), "Is this still available?")
+            else:
+                ListingService.like_listing(rng.choice(listings))
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            locked += 1
+            continue
+        finally:
+            # As at the end of a request, persistent connections survive this
+            close_old_connections()
+        committed += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+    return committed, locked, latencies
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=8, help="Concurrent writer processes.")
+    parser.add_argument("--seconds", type=float, default=10, help="How long each profile runs.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--listings", type=int, default=500)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    directory = tempfile.mkdtemp(prefix="sqlite_concurrency_")
+    print(f"{args.writers} writers for {args.seconds:g}s per profile, databases in {directory}\n")
+
+    for profile in PROFILES:
+        # Fresh database per profile, WAL mode sticks to the file once set
+        database = os.path.join(directory, f"{profile}.sqlite3")
+        with context.Pool(1) as pool:
+            pool.apply(prepare, (profile, database, args.users, args.listings))
+
+        with context.Pool(args.writers) as pool:
+            results = pool.starmap(
+                write, [(profile, database, args.seconds, seed) for seed in range(args.writers)]
+            )
+
+        committed = sum(result[0] for result in results)
+        locked = sum(result[1] for result in results)
+        latencies = [latency for result in results for latency in result[2]]
+        print(
+            f"  {profile:8}  {committed / args.seconds:8.0f} writes/s  {locked:6d} locked errors"
+            f"  ms p50 {percentile(latencies, 0.5):7.2f}  p95 {percentile(latencies, 0.95):7.2f}"
+            f"  mean {statistics.mean(latencies) if latencies else 0:7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
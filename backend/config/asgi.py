@@ -3,6 +3,11 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project through this entry point (e.g. uvicorn config.asgi:application) for the
+realtime message stream at /api/messages/stream/. Under WSGI every open stream would
+hold a worker thread. Database connections aren't kept between requests here, see
+CONN_MAX_AGE in config/settings.py.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -12,5 +17,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+os.environ.setdefault('SERVER_INTERFACE', 'asgi')
 
 application = get_asgi_application()
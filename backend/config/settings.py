@@ -35,7 +35,8 @@ ALLOWED_HOSTS = ["*"]
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        # JWTAuthentication with the user read from a cached snapshot instead of the database
+        "accounts.authentication.CachedJWTAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -52,6 +53,8 @@ SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=30),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
 }
+# How long an authenticated user is served from the cache, see accounts.authentication
+AUTH_USER_SNAPSHOT_SECONDS = 60
 
 
 # Application definition
@@ -76,6 +79,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.middleware.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -116,21 +120,111 @@ DATABASES = {
     }
 }
 
+# "asgi" when served through config/asgi.py, which sets it, "wsgi" for everything else
+# (WSGI servers, runserver, huey consumers, management commands)
+SERVER_INTERFACE = os.getenv("SERVER_INTERFACE", "wsgi")
+
+# SQLite tuning for concurrent writers (web workers, huey). "tuned" applies the settings
+# below, "default" leaves SQLite's own, see benchmarks/sqlite_concurrency.py
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "tuned")
+# Run on every new connection. WAL lets readers work alongside the single writer, and with
+# it synchronous=NORMAL only syncs at checkpoints. mmap serves reads from the page cache
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # KiB
+    "temp_store": "MEMORY",
+}
+# How long a writer waits for the lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT_SECONDS = 20
+if SQLITE_PROFILE == "tuned":
+    DATABASES["default"]["OPTIONS"] = {
+        "init_command": ";".join(f"PRAGMA {name}={value}" for name, value in SQLITE_PRAGMAS.items()),
+        # Take the write lock at BEGIN, a deferred transaction that upgrades from read to
+        # write fails at once instead of waiting out the busy timeout
+        "transaction_mode": "IMMEDIATE",
+        "timeout": SQLITE_BUSY_TIMEOUT_SECONDS,
+    }
+    # Keep connections open between requests instead of reconnecting and rerunning the pragmas.
+    # WSGI only: under ASGI sync code runs in executor threads that outlive the request, and
+    # Django advises against persistent connections there, each request connects afresh
+    if SERVER_INTERFACE == "wsgi":
+        DATABASES["default"]["CONN_MAX_AGE"] = 600
+        DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
+# Read replicas, comma separated database files kept in sync with the primary outside of
+# Django. Viewsets using api.db_routers.ReplicaReadMixin serve their read only actions from
+# them, config/settings_replica.py sets up a local pair for tests
+DATABASE_REPLICAS = []
+for index, replica_name in enumerate(filter(None, os.getenv("SQLITE_REPLICAS", "").split(","))):
+    DATABASES[f"replica{index + 1}"] = {**DATABASES["default"], "NAME": replica_name}
+    DATABASE_REPLICAS.append(f"replica{index + 1}")
+DATABASE_ROUTERS = ["api.db_routers.ReplicaRouter"]
+# How long a user's reads stay on the primary after they write, covers replication lag
+REPLICA_STICKY_SECONDS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# CACHE_URL (e.g. redis://localhost:6379/1) shares the cache between every web worker and
+# huey consumer. Without it each process has its own, so cached entries (block sets...) are
+# only invalidated in the process that wrote them and have to expire everywhere else, and
+# the huey task metrics aren't exported (see api.metrics)
+CACHE_URL = os.getenv("CACHE_URL")
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "backpackbazaar",
+        }
+    }
+SHARED_CACHE = bool(CACHE_URL)
+# How long a user's block sets stay cached. Blocking invalidates them, but in a per process
+# cache only in the process that served the block, so there they must expire within seconds
+BLOCK_CACHE_SECONDS = 60 * 60 if SHARED_CACHE else 5
+
 # Huey (Asynch tasks)
+# "sqlite" keeps the queue in a local file so the whole async pipeline runs without Redis,
+# "redis" uses REDIS_URL through a connection pool. Start consumers with manage.py run_huey
+HUEY_BACKEND = os.getenv("HUEY_BACKEND", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Tests run tasks inline, everywhere else they go through the consumer. DJANGO_TESTING=1 is
+# set by manage.py test, other runners (pytest, django-admin test) have to set it themselves
+RUNNING_TESTS = os.getenv("DJANGO_TESTING") == "1"
+HUEY_IMMEDIATE = os.getenv("HUEY_IMMEDIATE", "1" if RUNNING_TESTS else "0") == "1"
+
+if HUEY_BACKEND == "redis":
+    import redis
+
+    HUEY_CLASS = "api.task_queue.PriorityRedisHuey"
+    HUEY_CONNECTION = {
+        # Shared by the producer and every consumer worker in the process, a worker waits
+        # for a free connection rather than opening more than max_connections
+        "connection_pool": redis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=int(os.getenv("HUEY_REDIS_MAX_CONNECTIONS", 20)), timeout=10
+        ),
+    }
+else:
+    HUEY_CLASS = "api.task_queue.SqliteHuey"
+    HUEY_CONNECTION = {"filename": os.getenv("HUEY_SQLITE_PATH", os.path.join(BASE_DIR, "huey.sqlite3"))}
+
 HUEY = {
-    'huey_class': 'huey.RedisHuey',  # Huey implementation to use.
+    'huey_class': HUEY_CLASS,  # Huey implementation to use, records enqueue times for metrics.
+    'name': 'backpackbazaar',
     'results': True,  # Store return values of tasks.
-    'immediate': DEBUG,  # If DEBUG=True, run synchronously.
-    'connection': {
-        'host': 'localhost',
-        'port': 6379,
-        'db': 0,
-        'connection_pool': None,  # Definitely you should use pooling!
-        # ... tons of other options, see redis-py for details.
-    },
+    'immediate': HUEY_IMMEDIATE,
+    'connection': HUEY_CONNECTION,
     'consumer': {
-        'workers': 1,
-        'worker_type': 'thread',
+        # Processes by default, tag classification is CPU bound and threads would share the GIL
+        'workers': int(os.getenv("HUEY_WORKERS", os.cpu_count() or 2)),
+        'worker_type': os.getenv("HUEY_WORKER_TYPE", "process"),
         'initial_delay': 0.1,  # Smallest polling interval, same as -d.
         'backoff': 1.15,  # Exponential backoff using this rate, -b.
         'max_delay': 10.0,  # Max possible polling interval, -m.
@@ -141,6 +235,20 @@ HUEY = {
     },
 }
 
+# Task priority by category, when the queue backs up higher priorities are dequeued first
+TASK_PRIORITIES = {
+    "counters": 100,  # hot score refreshes, cheap and user visible
+    "images": 75,  # resized copies of new uploads
+    "tagging": 50,  # tag classification and the similarity index
+    "cleanup": 10,  # garbage collection, archiving, account purges
+}
+
+# Listing similarity index
+# Snapshot written by the rebuild task and loaded by every web process
+SIMILARITY_INDEX_PATH = os.path.join(BASE_DIR, "listings", "classification", "Saved_Model", "similarity_index.joblib")
+# How often (seconds) a process picks up listings modified since its index was built
+SIMILARITY_INDEX_REFRESH_SECONDS = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -184,6 +292,94 @@ STATICFILES_DIRS = [
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    # Listing and profile images, deduplicated by content hash
+    "images": {
+        "BACKEND": "api.storage.ContentAddressedStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+# How long an unreferenced image is kept before the garbage collection task deletes it
+BLOB_GC_GRACE_PERIOD = timedelta(hours=1)
+
+# Listing and profile uploads, see api.uploads.StreamingImageUploadHandler
+IMAGE_UPLOAD_MAX_SIZE = 15 * 1024 * 1024
+IMAGE_UPLOAD_MAX_PIXELS = 50_000_000
+IMAGE_UPLOAD_ALLOWED_FORMATS = ("JPEG", "PNG", "WEBP", "GIF", "MPO")
+# Header bytes buffered while looking for the image format and dimensions
+IMAGE_UPLOAD_SNIFF_BYTES = 256 * 1024
+
+# Resized copies of uploaded images, generated by api.tasks.generate_image_derivatives
+IMAGE_DERIVATIVE_DIR = "derived"
+IMAGE_DERIVATIVE_SIZES = (200, 400, 1024)
+IMAGE_DERIVATIVE_FORMATS = ("webp", "jpeg")
+IMAGE_DERIVATIVE_QUALITY = 80
+
+# Served media never changes under the same name, so browsers can keep it for a year
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Used when the original is served because the requested derivative isn't ready yet
+MEDIA_FALLBACK_CACHE_CONTROL = "public, max-age=60"
+# How long ServeImageView trusts a cached os.stat of a media file
+MEDIA_STAT_CACHE_SECONDS = 10
+# Let the front proxy send the bytes: None, "nginx" (X-Accel-Redirect) or "apache" (X-Sendfile)
+MEDIA_SENDFILE = os.getenv("MEDIA_SENDFILE") or None
+# nginx internal location that aliases MEDIA_ROOT
+MEDIA_SENDFILE_URL_PREFIX = "/protected-media/"
+
+# Fan-out layer for realtime message events, see api.realtime. The in-memory broker only
+# reaches streams served by the same process, use api.realtime.RedisBroker with several workers
+REALTIME_BROKER = {
+    "BACKEND": os.getenv("REALTIME_BROKER", "api.realtime.InMemoryBroker"),
+    # Only used by RedisBroker
+    "OPTIONS": {"url": os.getenv("REALTIME_REDIS_URL", "redis://localhost:6379/1")},
+}
+# Comment sent on idle event streams so proxies keep them open
+REALTIME_HEARTBEAT_SECONDS = 15
+# How long EventSource waits before reconnecting a dropped stream
+REALTIME_RETRY_MILLISECONDS = 3000
+# Default and maximum wait of the /api/messages/wait/ long-poll, kept under proxy read timeouts
+LONG_POLL_TIMEOUT_SECONDS = 25
+LONG_POLL_MAX_TIMEOUT_SECONDS = 55
+
+# Messages older than this move to the archive table, see user_messages.services.archive_services
+MESSAGE_ARCHIVE_AFTER = timedelta(days=180)
+MESSAGE_ARCHIVE_BATCH_SIZE = 1000
+
+# Rows deleted per transaction when purging a deleted account, see accounts.tasks
+ACCOUNT_DELETION_BATCH_SIZE = 500
+
+# Prometheus metrics at /metrics, see api.metrics. When set, scrapers must send this bearer token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or None
+
+# Logs go to stdout as JSON lines. Per-item logs (tag predictions, model loads) are sampled
+LOG_LEVEL = os.getenv("LOG_LEVEL", "CRITICAL" if RUNNING_TESTS else "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {"()": "api.logs.JSONFormatter"},
+    },
+    "filters": {
+        "sample": {"()": "api.logs.SampleFilter", "rate": LOG_SAMPLE_RATE},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "json"},
+        "sampled_console": {"class": "logging.StreamHandler", "formatter": "json", "filters": ["sample"]},
+    },
+    "root": {"handlers": ["console"], "level": LOG_LEVEL},
+    "loggers": {
+        # Replaces Django's default handlers, which would print everything a second time
+        "django": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": False},
+        "listings.classification": {"handlers": ["sampled_console"], "level": LOG_LEVEL, "propagate": False},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,26 @@
+"""Settings with a local primary and read replica, two SQLite files.
+
+Exercises api.db_routers.ReplicaRouter against a real second database:
+
+    python manage.py test --settings=config.settings_replica
+
+Nothing copies rows from the primary to the replica, so a test (or a developer) fills the
+replica directly to stand in for replication.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+DATABASES = {
+    "default": {
+        **DATABASES["default"],
+        "NAME": BASE_DIR / "db.primary.sqlite3",
+        "TEST": {"NAME": BASE_DIR / "test_db.primary.sqlite3"},
+    },
+    "replica": {
+        **DATABASES["default"],
+        "NAME": BASE_DIR / "db.replica.sqlite3",
+        "TEST": {"NAME": BASE_DIR / "test_db.replica.sqlite3"},
+    },
+}
+DATABASE_REPLICAS = ["replica"]
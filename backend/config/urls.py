@@ -19,7 +19,7 @@ Including another URLconf
 """
 
 from accounts.views import UserViewSet
-from api.views import ServeImageView
+from api.views import MetricsView, ServeImageView
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic import RedirectView
@@ -31,7 +31,7 @@ from drf_spectacular.views import (
 from listings.views import ListingViewSet
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from user_messages.views import MessageViewSet
+from user_messages.views import MessageStreamView, MessageViewSet, MessageWaitView
 
 router = DefaultRouter()
 router.register(r"users", UserViewSet, basename="user")
@@ -58,9 +58,17 @@ urlpatterns = [
     path("api/token/", TokenObtainPairView.as_view(), name="get_token"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="refresh"),
 
+    # Realtime message events (Server-Sent Events) and the long-poll fallback, before the
+    # router so "stream" and "wait" aren't taken for message ids
+    path("api/messages/stream/", MessageStreamView.as_view(), name="message-stream"),
+    path("api/messages/wait/", MessageWaitView.as_view(), name="message-wait"),
+
     # Main api urls
     path("api/", include(router.urls)),
     
+    # Prometheus scrape endpoint
+    path("metrics", MetricsView.as_view(), name="metrics"),
+
     # Media urls - this will provide images for any objects such as listings or users
     path("media/<path:image_path>/", ServeImageView.as_view(), name="serve_image"),
     path(
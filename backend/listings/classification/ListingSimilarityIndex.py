@@ -0,0 +1,204 @@
+import os
+
+import joblib
+import numpy as np
+from scipy import sparse
+
+
+class ListingSimilarityIndex:
+    """ In-memory nearest-neighbour index over listing titles.
+
+        Titles are embedded with the tag classifier's fitted TF-IDF vectorizer, which L2
+        normalizes its output, so a sparse dot product is the cosine similarity. Shared tags
+        add a boost on top of the title score. Rows upserted after a build are kept in a
+        small delta segment that is folded into the main matrix once it grows too large.
+    """
+
+    # How much a full tag overlap adds to the cosine similarity of the titles
+    TAG_BOOST = 0.25
+    # Number of pending upserts kept outside the main matrix before compacting
+    COMPACT_THRESHOLD = 512
+
+    def __init__(self, vectorizer):
+        self.vectorizer = vectorizer
+        self.n_features = len(vectorizer.vocabulary_)
+
+        # Main segment, one row per listing
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.title_matrix = sparse.csr_matrix((0, self.n_features))
+        self.tag_matrix = sparse.csr_matrix((0, 1))
+        self.positions = {}
+
+        # Delta segment, listing_id -> (title row, tag ids)
+        self.delta = {}
+        self._delta_cache = None
+
+        # Latest last_modified_at reflected in the index, used for incremental catch up
+        self.watermark = None
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.delta)
+
+    def embed(self, titles: list[str]):
+        """ Vectorizes titles the same way the tag classifier does.
+        """
+        return self.vectorizer.transform([title.strip().lower() for title in titles]).tocsr()
+
+    def build(self, rows, watermark=None):
+        """ Replaces the index contents.
+            rows is an iterable of (listing_id, title, tag_ids).
+        """
+
+        ids, titles, tag_sets = [], [], []
+        for listing_id, title, tag_ids in rows:
+            ids.append(listing_id)
+            titles.append(title)
+            tag_sets.append(tag_ids)
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.title_matrix = self.embed(titles) if titles else sparse.csr_matrix((0, self.n_features))
+        self.tag_matrix = self._tag_rows(tag_sets)
+        self.positions = {listing_id: row for row, listing_id in enumerate(ids)}
+        self.delta = {}
+        self._delta_cache = None
+        self.watermark = watermark
+
+    def upsert(self, listing_id: int, title: str, tag_ids):
+        """ Adds or replaces a single listing without rebuilding the main matrix.
+        """
+
+        self._kill(listing_id)
+        self.delta[listing_id] = (self.embed([title]), frozenset(tag_ids))
+        self._delta_cache = None
+        if len(self.delta) > self.COMPACT_THRESHOLD:
+            self.compact()
+
+    def remove(self, listing_id: int):
+        self._kill(listing_id)
+        if self.delta.pop(listing_id, None) is not None:
+            self._delta_cache = None
+
+    def compact(self):
+        """ Folds the delta segment and dead rows into a fresh main matrix.
+        """
+
+        keep = np.flatnonzero(self.alive)
+        delta_ids = list(self.delta)
+
+        title_parts = [self.title_matrix[keep]]
+        title_parts.extend(self.delta[listing_id][0] for listing_id in delta_ids)
+        tag_sets = [self._row_tags(row) for row in keep]
+        tag_sets.extend(self.delta[listing_id][1] for listing_id in delta_ids)
+
+        ids = np.concatenate([self.ids[keep], np.asarray(delta_ids, dtype=np.int64)])
+        self.ids = ids
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.title_matrix = sparse.vstack(title_parts, format="csr")
+        self.tag_matrix = self._tag_rows(tag_sets)
+        self.positions = {int(listing_id): row for row, listing_id in enumerate(ids)}
+        self.delta = {}
+        self._delta_cache = None
+
+    def query(self, title: str, tag_ids, k: int = 10, exclude_id: int = None) -> list[tuple[int, float]]:
+        """ Returns up to k (listing_id, score) pairs, most similar first.
+        """
+
+        query_vector = self.embed([title]).toarray().ravel()
+        tag_ids = frozenset(tag_ids)
+
+        # Main segment - two sparse matrix-vector products, no per-row python work
+        scores = self.title_matrix @ query_vector
+        if tag_ids and self.tag_matrix.shape[0]:
+            tag_vector = np.zeros(self.tag_matrix.shape[1])
+            tag_vector[[tag for tag in tag_ids if tag < len(tag_vector)]] = 1.0
+            scores += self.TAG_BOOST * (self.tag_matrix @ tag_vector) / len(tag_ids)
+        scores[~self.alive] = 0.0
+        if exclude_id in self.positions:
+            scores[self.positions[exclude_id]] = 0.0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        results = [(int(self.ids[row]), float(scores[row])) for row in candidates]
+
+        # Delta segment is small enough to score every row
+        if self.delta:
+            delta_ids, delta_matrix, delta_tags = self._delta_segment()
+            delta_scores = delta_matrix @ query_vector
+            for listing_id, score, row_tags in zip(delta_ids, delta_scores, delta_tags):
+                if tag_ids:
+                    score += self.TAG_BOOST * len(tag_ids & row_tags) / len(tag_ids)
+                if score > 0 and listing_id != exclude_id:
+                    results.append((listing_id, float(score)))
+
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results[:k]
+
+    def save(self, path: str):
+        """ Writes a snapshot of the index, replacing any existing one atomically.
+        """
+
+        self.compact()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        joblib.dump(
+            {
+                "ids": self.ids,
+                "title_matrix": self.title_matrix,
+                "tag_matrix": self.tag_matrix,
+                "watermark": self.watermark,
+            },
+            tmp_path,
+        )
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> bool:
+        """ Loads a snapshot written by save(), returns False if there is none.
+        """
+
+        try:
+            snapshot = joblib.load(path)
+        except FileNotFoundError:
+            return False
+
+        self.ids = snapshot["ids"]
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.title_matrix = snapshot["title_matrix"]
+        self.tag_matrix = snapshot["tag_matrix"]
+        self.positions = {int(listing_id): row for row, listing_id in enumerate(self.ids)}
+        self.delta = {}
+        self._delta_cache = None
+        self.watermark = snapshot["watermark"]
+        return True
+
+    def _delta_segment(self):
+        # Stacked once per change to the delta rather than once per query
+        if self._delta_cache is None:
+            delta_ids = list(self.delta)
+            self._delta_cache = (
+                delta_ids,
+                sparse.vstack([self.delta[listing_id][0] for listing_id in delta_ids], format="csr"),
+                [self.delta[listing_id][1] for listing_id in delta_ids],
+            )
+        return self._delta_cache
+
+    def _kill(self, listing_id):
+        row = self.positions.pop(listing_id, None)
+        if row is not None:
+            self.alive[row] = False
+
+    def _row_tags(self, row):
+        start, end = self.tag_matrix.indptr[row], self.tag_matrix.indptr[row + 1]
+        return frozenset(int(tag) for tag in self.tag_matrix.indices[start:end])
+
+    def _tag_rows(self, tag_sets):
+        # Tag ids are used directly as column indexes
+        width = max((max(tags) for tags in tag_sets if tags), default=0) + 1
+        indptr, indices = [0], []
+        for tags in tag_sets:
+            indices.extend(sorted(tags))
+            indptr.append(len(indices))
+        data = np.ones(len(indices))
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(tag_sets), width))
@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 
 import joblib
@@ -9,6 +10,8 @@ from sklearn.multiclass import OneVsRestClassifier
 from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.svm import SVC
 
+logger = logging.getLogger(__name__)
+
 
 class ListingTagClassifier:
     def __init__(self):
@@ -49,7 +52,7 @@ class ListingTagClassifier:
         joblib.dump(self.model, os.path.join(self.BASE_PATH, self.MODEL_PATH))
         joblib.dump(self.vectorizer, os.path.join(self.BASE_PATH, self.VECTORIZER_PATH))
         joblib.dump(self.mlb, os.path.join(self.BASE_PATH, self.MLB_PATH))
-        print("Model and preprocessors saved successfully.")
+        logger.info("Model and preprocessors saved", extra={"path": self.BASE_PATH})
 
     def load_model(self):
         """ Loads the trained model if it exsists.
@@ -62,10 +65,10 @@ class ListingTagClassifier:
             )
             self.mlb = joblib.load(os.path.join(self.BASE_PATH, self.MLB_PATH))
 
-            print(f"Model and preprocessors loaded from '{self.BASE_PATH}/'.")
+            logger.info("Model and preprocessors loaded", extra={"path": self.BASE_PATH})
             return True
         except FileNotFoundError:
-            print(f"No saved model found in '{self.BASE_PATH}/'. Train model first.")
+            logger.warning("No saved model found, train the model first", extra={"path": self.BASE_PATH})
             return None, None, None
 
     def read_listings_from_file(self, file_path: str) -> list:
@@ -148,8 +151,10 @@ class ListingTagClassifier:
         # Probabilities for the top 3
         top_probs = predictions[0][top_indices]
         
-        print(f"Top tags: {top_tags}")
-        print(f"Top Probs: {top_probs}")
+        logger.info(
+            "Predicted listing tags",
+            extra={"tags": top_tags.tolist(), "probabilities": [round(float(prob), 3) for prob in top_probs]},
+        )
 
 
         # If the most likely tag is fairly unprobable, assign the tag as misc
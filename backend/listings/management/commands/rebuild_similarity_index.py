@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from listings.services.similarity_services import SimilarityService
+from listings.tasks import rebuild_similarity_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the listing similarity index, run this after bulk retagging listings."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="Rebuild in this process instead of queueing a background task.",
+        )
+
+    def handle(self, *args, **options):
+        if options["sync"]:
+            count = SimilarityService.rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Indexed {count} listings."))
+        else:
+            rebuild_similarity_index()
+            self.stdout.write(self.style.SUCCESS("Queued similarity index rebuild."))
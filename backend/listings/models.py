@@ -1,5 +1,7 @@
+from api.storage import image_storage
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
 
 
 class Tag(models.Model):
@@ -21,14 +23,28 @@ class Listing(models.Model):
     )
     description = models.CharField(max_length=500)
     price = models.FloatField()
-    image = models.ImageField(upload_to="listings/")
+    image = models.ImageField(upload_to="listings/", storage=image_storage)
+    # Resized copies of image, {"200": {"webp": name, "jpeg": name}, ...}
+    image_variants = models.JSONField(default=dict, blank=True)
     likes = models.IntegerField(default=0)
     dislikes = models.IntegerField(default=0)
+    saves = models.IntegerField(default=0)
+    # Precomputed ranking, refreshed by the refresh_hot_scores periodic task
+    hot_score = models.FloatField(default=0)
+    hot_score_stale = models.BooleanField(default=True, db_index=True)
     tags = models.ManyToManyField(Tag, blank=True) # null=True has no effect according to docs
-    created_at = models.DateField(auto_now_add=True)
-    last_modified_at = models.DateTimeField(auto_now=True)
+    # The date in TIME_ZONE, the same day HotScoreService ages new listings from
+    created_at = models.DateField(default=timezone.localdate, editable=False)
+    last_modified_at = models.DateTimeField(auto_now=True, db_index=True)
     author_id = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # Serves ?ordering=-hot_score with keyset pagination
+            models.Index(fields=["-hot_score", "-id"], name="listing_hot_score_idx"),
+        ]
+
+
 class SavedListing(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="saved_listings")
     listing = models.ForeignKey(Listing, on_delete=models.CASCADE)
@@ -1,3 +1,4 @@
+from api.serializers import ImageVariantsField, SniffedImageField
 from rest_framework import serializers
 from .models import Listing
 
@@ -5,6 +6,8 @@ from .models import Listing
 class ListingSerializer(serializers.ModelSerializer):
     tags = serializers.CharField(write_only=True, required=False)
     tags_out = serializers.SerializerMethodField()
+    image = SniffedImageField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Listing
@@ -15,8 +18,11 @@ class ListingSerializer(serializers.ModelSerializer):
             "description",
             "price",
             "image",
+            "image_variants",
             "likes",
             "dislikes",
+            "saves",
+            "hot_score",
             "tags",
             "tags_out",
             "created_at",
@@ -26,6 +32,8 @@ class ListingSerializer(serializers.ModelSerializer):
         read_only_fields = [
             "likes",
             "dislikes",
+            "saves",
+            "hot_score",
             "created_at",
             "last_modified_at",
             "author_id",
@@ -1,6 +1,10 @@
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
-from listings.models import Listing, Tag
+from api.tasks import generate_image_derivatives, refresh_image_variants
+from listings.models import Listing, SavedListing, Tag
+from listings.services.ranking_services import HotScoreService
 from listings.tasks import generate_tags
 
 
@@ -8,6 +12,8 @@ class ListingService:
     @staticmethod
     @transaction.atomic
     def create_listing(author_id, title, condition, description, price, image, tags):
+        # One date for both, so the score ages the listing from the day it is stored with
+        created_at = timezone.localdate()
         listing = Listing.objects.create(
             author_id=author_id,
             title=title,
@@ -15,10 +21,14 @@ class ListingService:
             description=description,
             price=price,
             image=image,
+            created_at=created_at,
+            hot_score=HotScoreService.initial_score(created_at),
+            hot_score_stale=False,
         )
         # For now we will ignore user given tags - we can make them read only later
 
         generate_tags(listing.id, title, description)
+        generate_image_derivatives("listings.Listing", listing.id)
         """
         for tag_name in tags:
             tag, _ = Tag.objects.get_or_create(tag_name=tag_name)
@@ -41,6 +51,7 @@ class ListingService:
         listing.condition = condition
         listing.description = description
         listing.price = price
+        old_image_name = listing.image.name
         listing.image = image
         listing.tags.clear()
         generate_tags(listing.id, title, description)
@@ -51,6 +62,9 @@ class ListingService:
         """
 
         listing.save()
+        # Re-uploading the same bytes resolves to the same content addressed name
+        if listing.image.name != old_image_name:
+            refresh_image_variants(listing)
         return listing
 
     @staticmethod
@@ -73,6 +87,7 @@ class ListingService:
             listing.description = description
         if price:
             listing.price = price
+        old_image_name = listing.image.name
         if image:
             listing.image = image
         if title or description:
@@ -85,16 +100,38 @@ class ListingService:
             """
         
         listing.save()
+        # Re-uploading the same bytes resolves to the same content addressed name
+        if listing.image.name != old_image_name:
+            refresh_image_variants(listing)
         return listing
 
     @staticmethod
     @transaction.atomic
     def like_listing(listing):
-        listing.likes += 1
-        listing.save()
+        # Single UPDATE with F() so concurrent likes aren't lost
+        HotScoreService.mark_stale(listing.id, likes=F("likes") + 1)
 
     @staticmethod
     @transaction.atomic
     def dislike_listing(listing):
-        listing.dislikes += 1
-        listing.save()
\ No newline at end of file
+        HotScoreService.mark_stale(listing.id, dislikes=F("dislikes") + 1)
+
+    @staticmethod
+    @transaction.atomic
+    def save_listing(user, listing):
+        # Returns False if the listing was already saved
+        if SavedListing.objects.filter(user=user, listing=listing).exists():
+            return False
+        SavedListing.objects.create(user=user, listing=listing)
+        HotScoreService.mark_stale(listing.id, saves=F("saves") + 1)
+        return True
+
+    @staticmethod
+    @transaction.atomic
+    def remove_saved_listing(user, listing):
+        # Returns False if the listing wasn't saved
+        deleted, _ = SavedListing.objects.filter(user=user, listing=listing).delete()
+        if not deleted:
+            return False
+        HotScoreService.mark_stale(listing.id, saves=F("saves") - deleted)
+        return True
\ No newline at end of file
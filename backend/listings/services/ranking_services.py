@@ -0,0 +1,72 @@
+import math
+from datetime import date
+
+from django.db import transaction
+from django.utils import timezone
+
+from listings.models import Listing
+
+
+class HotScoreService:
+    """Maintains Listing.hot_score.
+
+    The score uses a reddit style formula: the log of the net engagement plus the listing
+    age expressed as a constant offset. Newer listings get a permanently higher base rather
+    than older ones being decayed, so a score only has to be recomputed when its likes,
+    dislikes or saves change, which is what the hot_score_stale flag tracks.
+    """
+
+    EPOCH = date(2024, 1, 1)
+    # Seconds of listing age worth one order of magnitude of engagement (12.5 hours)
+    DECAY_SECONDS = 45000
+    SAVE_WEIGHT = 2
+    BATCH_SIZE = 500
+
+    @classmethod
+    def compute(cls, likes, dislikes, saves, created_at):
+        net = likes - dislikes + cls.SAVE_WEIGHT * saves
+        order = math.log10(max(abs(net), 1))
+        sign = (net > 0) - (net < 0)
+        age_seconds = (created_at - cls.EPOCH).total_seconds()
+        return round(sign * order + age_seconds / cls.DECAY_SECONDS, 7)
+
+    @classmethod
+    def initial_score(cls, created_at=None):
+        # Same day as Listing.created_at, which refresh_stale recomputes from
+        return cls.compute(0, 0, 0, created_at or timezone.localdate())
+
+    @staticmethod
+    def mark_stale(listing_id, **counter_changes):
+        """Applies F() counter updates to a listing and flags its score for the next refresh."""
+        Listing.objects.filter(id=listing_id).update(hot_score_stale=True, **counter_changes)
+
+    @classmethod
+    def refresh_stale(cls, batch_size=None):
+        """Recomputes scores for listings whose engagement changed since the last run."""
+        batch_size = batch_size or cls.BATCH_SIZE
+        refreshed = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                # Walk the stale flag index in id order, each batch in its own short transaction
+                rows = list(
+                    Listing.objects.select_for_update()
+                    .filter(hot_score_stale=True, id__gt=last_id)
+                    .order_by("id")
+                    .values_list("id", "likes", "dislikes", "saves", "created_at")[:batch_size]
+                )
+                if not rows:
+                    return refreshed
+
+                listings = [
+                    Listing(
+                        id=listing_id,
+                        hot_score=cls.compute(likes, dislikes, saves, created_at),
+                        hot_score_stale=False,
+                    )
+                    for listing_id, likes, dislikes, saves, created_at in rows
+                ]
+                Listing.objects.bulk_update(listings, ["hot_score", "hot_score_stale"])
+
+            refreshed += len(rows)
+            last_id = rows[-1][0]
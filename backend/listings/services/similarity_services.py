@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+import joblib
+from django.conf import settings
+
+from listings.classification.ListingSimilarityIndex import ListingSimilarityIndex
+from listings.classification.ListingTagClassifier import ListingTagClassifier
+from listings.models import Listing
+
+
+class SimilarityService:
+    """Owns the per-process listing similarity index.
+
+    The index is loaded from the snapshot written by the rebuild task, then kept fresh by
+    upserting listings whose last_modified_at reached the index watermark. That catch up
+    runs at most once per SIMILARITY_INDEX_REFRESH_SECONDS, so requests never scan the
+    listing table. Without a snapshot the rebuild task is queued and there are no similar
+    listings until it has written one, a full build is too slow to run in a request.
+
+    Catch up and compaction change the index in place, so queries hold the same lock.
+    """
+
+    _index = None
+    _snapshot_mtime = None
+    _checked_at = None
+    _rebuild_queued_at = None
+    _lock = threading.Lock()
+
+    CHUNK_SIZE = 2000
+    # A rebuild that hasn't written a snapshot by then has failed or was dropped, queue another
+    REBUILD_RETRY_SECONDS = 10 * 60
+
+    @classmethod
+    def similar_listings(cls, listing, k=10):
+        tag_ids = list(listing.tags.values_list("id", flat=True))
+        with cls._lock:
+            index = cls._refreshed_index()
+            if index is None:
+                return []
+            # Over-fetch so deleted or inactive listings can be dropped below
+            matches = index.query(listing.title, tag_ids, k=k * 2 + 5, exclude_id=listing.id)
+        ranked_ids = [listing_id for listing_id, _ in matches]
+
+        listings = Listing.objects.filter(
+            id__in=ranked_ids, author_id__is_active=True
+        ).prefetch_related("tags")
+        by_id = {similar.id: similar for similar in listings}
+        return [by_id[listing_id] for listing_id in ranked_ids if listing_id in by_id][:k]
+
+    @classmethod
+    def get_index(cls):
+        """The process's index, or None while the first snapshot is being built.
+
+        Callers that query it must hold _lock, see similar_listings.
+        """
+        with cls._lock:
+            return cls._refreshed_index()
+
+    @classmethod
+    def rebuild(cls):
+        """Builds the index from scratch and writes a snapshot for every process to load."""
+        index = cls._new_index()
+        cls._build(index)
+        index.save(settings.SIMILARITY_INDEX_PATH)
+        return len(index)
+
+    @classmethod
+    def reset(cls):
+        """Drops the in-process index, mostly useful for tests."""
+        with cls._lock:
+            cls._index = None
+            cls._snapshot_mtime = None
+            cls._checked_at = None
+            cls._rebuild_queued_at = None
+
+    @classmethod
+    def _refreshed_index(cls):
+        now = time.monotonic()
+        stale = cls._checked_at is None or now - cls._checked_at >= settings.SIMILARITY_INDEX_REFRESH_SECONDS
+        snapshot_mtime = cls._current_snapshot_mtime() if stale else cls._snapshot_mtime
+        if snapshot_mtime is None and not cls._rebuild_pending(now):
+            cls._queue_rebuild(now)
+            # Already written if tasks run immediately
+            snapshot_mtime = cls._current_snapshot_mtime()
+        # Pick up a fresh snapshot from the background rebuild if there is one
+        if snapshot_mtime is not None and (cls._index is None or snapshot_mtime != cls._snapshot_mtime):
+            cls._load()
+        elif stale and cls._index is not None:
+            cls._catch_up(cls._index)
+        if stale:
+            cls._checked_at = now
+        return cls._index
+
+    @classmethod
+    def _rebuild_pending(cls, now):
+        return cls._rebuild_queued_at is not None and now - cls._rebuild_queued_at < cls.REBUILD_RETRY_SECONDS
+
+    @classmethod
+    def _queue_rebuild(cls, now):
+        from listings.tasks import rebuild_similarity_index
+
+        cls._rebuild_queued_at = now
+        try:
+            rebuild_similarity_index()
+        except Exception:
+            # Not queued, the next request tries again
+            cls._rebuild_queued_at = None
+            raise
+
+    @classmethod
+    def _load(cls):
+        index = cls._new_index()
+        snapshot_mtime = cls._current_snapshot_mtime()
+        if not index.load(settings.SIMILARITY_INDEX_PATH):
+            return
+        cls._catch_up(index)
+        cls._index = index
+        cls._snapshot_mtime = snapshot_mtime
+        # A snapshot that goes missing later is rebuilt again
+        cls._rebuild_queued_at = None
+
+    @staticmethod
+    def _new_index():
+        return ListingSimilarityIndex(joblib.load(ListingTagClassifier().VECTORIZER_PATH))
+
+    @staticmethod
+    def _current_snapshot_mtime():
+        try:
+            return os.stat(settings.SIMILARITY_INDEX_PATH).st_mtime
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def _build(cls, index):
+        rows = Listing.objects.order_by("id").values_list("id", "title", "last_modified_at")
+        listing_rows = list(rows.iterator(chunk_size=cls.CHUNK_SIZE))
+        tags = defaultdict(set)
+        for listing_id, tag_id in Listing.tags.through.objects.values_list(
+            "listing_id", "tag_id"
+        ).iterator(chunk_size=cls.CHUNK_SIZE):
+            tags[listing_id].add(tag_id)
+
+        watermark = max((modified for _, _, modified in listing_rows), default=None)
+        index.build(
+            ((listing_id, title, tags[listing_id]) for listing_id, title, _ in listing_rows),
+            watermark=watermark,
+        )
+
+    @classmethod
+    def _catch_up(cls, index):
+        # Only listings touched since the index was built - served by the last_modified_at index.
+        # The watermark's own tick is read again, a listing saved in the same tick after the
+        # build would be missed otherwise. Upserting a row twice is harmless
+        changed = Listing.objects.order_by("last_modified_at")
+        if index.watermark is not None:
+            changed = changed.filter(last_modified_at__gte=index.watermark)
+
+        for listing in changed.prefetch_related("tags").iterator(chunk_size=cls.CHUNK_SIZE):
+            index.upsert(listing.id, listing.title, [tag.id for tag in listing.tags.all()])
+            index.watermark = listing.last_modified_at
@@ -1,16 +1,24 @@
+import logging
+
 from .classification import ListingTagClassifier
+from .services.ranking_services import HotScoreService
+from .services.similarity_services import SimilarityService
 from listings.models import Listing, Tag
 
-from huey.contrib.djhuey import db_task, on_commit_task
+from django.conf import settings
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, db_task, lock_task, on_commit_task
+
+logger = logging.getLogger(__name__)
 
-@db_task()
+@db_task(priority=settings.TASK_PRIORITIES["tagging"])
 def add_listing_tags(listing_id: int, tags: list[str]):
     # This task executes queries. Once the task finishes, the connection
     # will be closed.
     try:
         listing = Listing.objects.get(id=listing_id)
     except Exception as e:
-        print("Automatic addition of listing tags failed", e)
+        logger.warning("Automatic addition of listing tags failed", extra={"listing_id": listing_id, "error": str(e)})
         return False
     for tag_name in tags:
         tag, _ = Tag.objects.get_or_create(tag_name=tag_name.strip())
@@ -18,7 +26,7 @@ def add_listing_tags(listing_id: int, tags: list[str]):
     
     listing.save()
 
-@on_commit_task()
+@on_commit_task(priority=settings.TASK_PRIORITIES["tagging"])
 def generate_tags(listing_id: int, title: str, description: str):
     INCLUDE_DESC = False
     # This task executes queries. Once the task finishes, the connection
@@ -30,4 +38,23 @@ def generate_tags(listing_id: int, title: str, description: str):
     listing_text = [title.strip().lower() + description.strip().lower()] if INCLUDE_DESC else [title.strip().lower()]
     
     top_tags = ltg.predict_listing_tags(listing_text)
-    add_listing_tags(listing_id, top_tags)
\ No newline at end of file
+    add_listing_tags(listing_id, top_tags)
+
+@db_task(priority=settings.TASK_PRIORITIES["tagging"])
+@lock_task("rebuild-similarity-index")
+def rebuild_similarity_index():
+    # Full rebuild, e.g. after bulk retagging. Web processes pick up the new snapshot on their next refresh
+    return SimilarityService.rebuild()
+
+
+@db_periodic_task(crontab(minute="0", hour="4"), priority=settings.TASK_PRIORITIES["tagging"])
+def rebuild_similarity_index_nightly():
+    # Compacts away rows that were upserted or deleted during the day
+    rebuild_similarity_index()
+
+
+@db_periodic_task(crontab(minute="*"), priority=settings.TASK_PRIORITIES["counters"])
+@lock_task("refresh-hot-scores")
+def refresh_hot_scores():
+    # Only touches listings whose likes, dislikes or saves changed since the last run
+    return HotScoreService.refresh_stale()
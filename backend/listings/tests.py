@@ -1,21 +1,36 @@
 import os
+import shutil
+import tempfile
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.utils import timezone
 from PIL import Image
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APIClient, APITestCase
 
+from accounts.services.block_services import BlockService
+
 from .models import Listing, Tag
 from .serializers import ListingSerializer
+from .services.listing_services import ListingService
+from .services.ranking_services import HotScoreService
+from .services.similarity_services import SimilarityService
+from .tasks import refresh_hot_scores
 
 
 class ListingBaseTestCase(APITestCase):
     """Base test class providing setup for listing-related tests."""
 
     def setUp(self):
+        # Cached block sets are keyed by user id, which the next test reuses
+        cache.clear()
         self.client = APIClient()
         self.user = User.objects.create_user(username="testuser", password="testpass")
         self.client.force_authenticate(user=self.user)
@@ -133,4 +148,280 @@ class ListAndFilterListingsTestCase(ListingBaseTestCase):
             author_id=self.user,
         )
         response = self.client.get(reverse("listing-list") + "?ordering=price")
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_excludes_blocked_authors(self):
+        other_user = User.objects.create_user(username="otheruser", password="testpass")
+        other_listing = Listing.objects.create(
+            title="Other Listing",
+            condition="MW",
+            description="Another sample.",
+            price=50.0,
+            image=self._retrieve_test_image(),
+            author_id=other_user,
+        )
+
+        def listed_ids():
+            return {listing["id"] for listing in self.client.get(reverse("listing-list")).data["results"]}
+
+        self.assertIn(other_listing.id, listed_ids())
+        # Hidden whichever side placed the block
+        BlockService.block(other_user, self.user)
+        self.assertNotIn(other_listing.id, listed_ids())
+        BlockService.unblock(other_user, self.user)
+        self.assertIn(other_listing.id, listed_ids())
+        BlockService.block(self.user, other_user)
+        self.assertEqual(listed_ids(), {self.listing.id})
+
+class SimilarListingsTestCase(ListingBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        self.index_path = os.path.join(index_dir, "similarity_index.joblib")
+        override = override_settings(SIMILARITY_INDEX_PATH=self.index_path)
+        override.enable()
+        self.addCleanup(override.disable)
+        SimilarityService.reset()
+        self.addCleanup(SimilarityService.reset)
+        self.calculator = self._create_listing("Graphing calculator")
+        self.other_calculator = self._create_listing("Scientific calculator")
+        self.chair = self._create_listing("Desk chair")
+
+    def _create_listing(self, title):
+        return Listing.objects.create(
+            title=title,
+            condition="FN",
+            description="A sample description.",
+            price=10.0,
+            image=self._retrieve_test_image(),
+            author_id=self.user,
+        )
+
+    def test_similar_listings(self):
+        self.client.logout()
+        response = self.client.get(
+            reverse("listing-similar", kwargs={"pk": self.calculator.pk})
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        similar_ids = [listing["id"] for listing in response.data]
+        self.assertEqual(similar_ids[0], self.other_calculator.pk)
+        self.assertNotIn(self.calculator.pk, similar_ids)
+        self.assertNotIn(self.chair.pk, similar_ids)
+
+    def test_missing_snapshot_is_built_by_the_task(self):
+        self.assertFalse(os.path.exists(self.index_path))
+        # Tasks run immediately in tests, the queued rebuild has written the snapshot
+        self.assertEqual(len(SimilarityService.get_index()), Listing.objects.count())
+        self.assertTrue(os.path.exists(self.index_path))
+
+    def test_lost_rebuild_is_queued_again(self):
+        # A rebuild was queued moments ago and hasn't finished, don't queue another
+        SimilarityService._rebuild_queued_at = time.monotonic()
+        self.assertIsNone(SimilarityService.get_index())
+        self.assertFalse(os.path.exists(self.index_path))
+
+        # Long enough ago that the task must have failed or been dropped
+        SimilarityService._rebuild_queued_at = time.monotonic() - SimilarityService.REBUILD_RETRY_SECONDS
+        SimilarityService._checked_at = None
+        self.assertEqual(len(SimilarityService.get_index()), Listing.objects.count())
+        self.assertIsNone(SimilarityService._rebuild_queued_at)
+
+    def test_similar_listings_queries_under_the_lock(self):
+        index = SimilarityService.get_index()
+        query = index.query
+        locked = []
+
+        def checked_query(*args, **kwargs):
+            locked.append(SimilarityService._lock.locked())
+            return query(*args, **kwargs)
+
+        index.query = checked_query
+        SimilarityService.similar_listings(self.calculator)
+        self.assertEqual(locked, [True])
+
+    def test_similar_listings_picks_up_new_listings(self):
+        SimilarityService.get_index()
+        new_calculator = self._create_listing("Calculator TI-84")
+
+        with self.settings(SIMILARITY_INDEX_REFRESH_SECONDS=0):
+            response = self.client.get(
+                reverse("listing-similar", kwargs={"pk": self.calculator.pk})
+            )
+        similar_ids = [listing["id"] for listing in response.data]
+        self.assertIn(new_calculator.pk, similar_ids)
+
+    def test_edit_in_the_watermark_tick_is_picked_up(self):
+        index = SimilarityService.get_index()
+        Listing.objects.filter(id=self.chair.id).update(
+            title="Calculator stand", last_modified_at=index.watermark
+        )
+
+        with self.settings(SIMILARITY_INDEX_REFRESH_SECONDS=0):
+            index = SimilarityService.get_index()
+        similar_ids = [listing_id for listing_id, _ in index.query("Calculator stand", [], k=5)]
+        self.assertIn(self.chair.id, similar_ids)
+
+    def test_similar_listings_tag_boost(self):
+        self.calculator.tags.set([self.tag1])
+        self.chair.tags.set([self.tag1])
+        index = SimilarityService.get_index()
+        index.build(
+            [
+                (self.other_calculator.id, self.other_calculator.title, []),
+                (self.chair.id, self.chair.title, [self.tag1.id]),
+            ]
+        )
+
+        results = index.query(self.calculator.title, [self.tag1.id], k=5)
+        self.assertEqual([listing_id for listing_id, _ in results], [self.other_calculator.id, self.chair.id])
+
+    def test_similar_listings_excludes_inactive_authors(self):
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(
+            reverse("listing-similar", kwargs={"pk": self.calculator.pk})
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+
+
+class HotScoreTestCase(ListingBaseTestCase):
+    def test_engagement_marks_score_stale(self):
+        Listing.objects.update(hot_score_stale=False)
+        self.client.post(reverse("listing-like-listing", kwargs={"pk": self.listing.pk}))
+        self.client.post(reverse("listing-save-listing", kwargs={"pk": self.listing.pk}))
+
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.likes, 1)
+        self.assertEqual(self.listing.saves, 1)
+        self.assertTrue(self.listing.hot_score_stale)
+
+    def test_refresh_only_touches_stale_listings(self):
+        fresh = Listing.objects.create(
+            title="Fresh Listing",
+            condition="FN",
+            description="A sample description.",
+            price=10.0,
+            image=self._retrieve_test_image(),
+            author_id=self.user,
+            hot_score=-1,
+            hot_score_stale=False,
+        )
+        ListingService.like_listing(self.listing)
+
+        self.assertEqual(refresh_hot_scores.call_local(), 1)
+        self.listing.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertFalse(self.listing.hot_score_stale)
+        self.assertEqual(
+            self.listing.hot_score,
+            HotScoreService.compute(1, 0, 0, self.listing.created_at),
+        )
+        self.assertEqual(fresh.hot_score, -1)
+
+    @override_settings(TIME_ZONE="Pacific/Kiritimati")
+    def test_new_listing_score_matches_refresh(self):
+        # Fourteen hours ahead of UTC, the local and UTC dates differ for most of the day
+        listing = ListingService.create_listing(
+            self.user, "Fresh Listing", "FN", "A sample description.", 10.0, self._retrieve_test_image(), []
+        )
+        listing.refresh_from_db()
+        self.assertEqual(listing.created_at, timezone.localdate())
+        initial = listing.hot_score
+
+        Listing.objects.filter(id=listing.id).update(hot_score_stale=True)
+        refresh_hot_scores.call_local()
+        listing.refresh_from_db()
+        self.assertEqual(listing.hot_score, initial)
+
+    def test_order_by_hot_score_uses_cursor(self):
+        for i in range(3):
+            Listing.objects.create(
+                title=f"Hot Listing {i}",
+                condition="FN",
+                description="A sample description.",
+                price=10.0,
+                image=self._retrieve_test_image(),
+                author_id=self.user,
+                hot_score=i,
+            )
+
+        response = self.client.get(
+            reverse("listing-list"), {"ordering": "-hot_score", "page_size": 2}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([listing["hot_score"] for listing in response.data["results"]], [2, 1])
+        self.assertNotIn("count", response.data)
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual([listing["hot_score"] for listing in response.data["results"]], [0, 0])
+
+
+class ImageDerivativesTestCase(ListingBaseTestCase):
+    def test_create_listing_generates_derivatives(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("listing-list"), self.valid_listing_data, format="multipart"
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        listing = Listing.objects.get(pk=response.data["id"])
+        self.assertEqual(set(listing.image_variants), {"200", "400", "1024"})
+        with default_storage.open(listing.image_variants["200"]["webp"]) as derived:
+            with Image.open(derived) as image:
+                self.assertEqual(image.format, "WEBP")
+                # The test image is 100px, derivatives are never upscaled
+                self.assertEqual(image.size, (100, 100))
+                self.assertNotIn("exif", image.info)
+
+    def test_serve_image_derivative(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("listing-list"), self.valid_listing_data, format="multipart"
+            )
+        listing = Listing.objects.get(pk=response.data["id"])
+
+        response = self.client.get(
+            f"/media/{listing.image.name}/", {"size": 150}, HTTP_ACCEPT="image/webp"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/webp")
+
+        # Sizes above the largest derivative get the original
+        response = self.client.get(f"/media/{listing.image.name}/", {"size": 4000})
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+
+class StreamingUploadTestCase(ListingBaseTestCase):
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=256)
+    def test_oversized_upload_rejected(self):
+        response = self.client.post(
+            reverse("listing-list"), self.valid_listing_data, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Listing.objects.count(), 1)
+
+    def test_invalid_image_rejected(self):
+        self.valid_listing_data["image"] = SimpleUploadedFile(
+            "not_an_image.jpg", b"plain text, not an image" * 100, content_type="image/jpeg"
+        )
+        response = self.client.post(
+            reverse("listing-list"), self.valid_listing_data, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("image", response.data)
+
+    @override_settings(IMAGE_UPLOAD_ALLOWED_FORMATS=("PNG",))
+    def test_disallowed_format_rejected(self):
+        response = self.client.post(
+            reverse("listing-list"), self.valid_listing_data, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_upload_streamed_to_disk(self):
+        response = self.client.post(
+            reverse("listing-list"), self.valid_listing_data, format="multipart"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(response.wsgi_request.upload_stats["bytes"], 0)
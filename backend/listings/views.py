@@ -2,13 +2,20 @@ from django_filters import rest_framework as filters
 from rest_framework import filters as rest_filters
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.parsers import FormParser, JSONParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
+from accounts.services.block_services import BlockService
+from api.db_routers import ReplicaReadMixin
+from api.pagination import HotScoreCursorPagination
+from api.uploads import StreamingImageMultiPartParser
+
 from .models import Listing, SavedListing
 from .serializers import ListingSerializer
 from .tasks import generate_tags
 from .services.listing_services import ListingService
+from .services.similarity_services import SimilarityService
 
 
 class ListingFilter(filters.FilterSet):
@@ -25,9 +32,13 @@ class ListingFilter(filters.FilterSet):
         ]
 
 
-class ListingViewSet(viewsets.ModelViewSet):
+class ListingViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Listing.objects.all()
     serializer_class = ListingSerializer
+    # Browsing is served from a read replica when one is configured
+    replica_actions = {"list", "retrieve", "similar", "list_saved_listings"}
+    # Uploads stream to disk with early size and format checks
+    parser_classes = [JSONParser, StreamingImageMultiPartParser, FormParser]
     filter_backends = [
         filters.DjangoFilterBackend,
         rest_filters.SearchFilter,
@@ -44,12 +55,34 @@ class ListingViewSet(viewsets.ModelViewSet):
         "likes",
         "dislikes",
         "created_at",
+        "hot_score",
     ]
 
+    @property
+    def paginator(self):
+        # Hot ordering uses keyset pagination over the (hot_score, id) index
+        if (
+            not hasattr(self, "_paginator")
+            and self.request is not None
+            and self.request.query_params.get("ordering") == "-hot_score"
+        ):
+            self._paginator = HotScoreCursorPagination()
+        return super().paginator
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # The feed leaves out listings by users blocked either way, read from the cached
+        # block sets so it costs no extra query
+        if self.action == "list" and self.request.user.is_authenticated:
+            hidden_user_ids = BlockService.hidden_user_ids(self.request.user.id)
+            if hidden_user_ids:
+                queryset = queryset.exclude(author_id__in=hidden_user_ids)
+        return queryset
+
     def get_permissions(self):
         # User must be authenticated if performing any action other than retrieve/list
         self.permission_classes = (
-            [AllowAny] if (self.action in ["list", "retrieve"]) else [IsAuthenticated]
+            [AllowAny] if (self.action in ["list", "retrieve", "similar"]) else [IsAuthenticated]
         )
         return super().get_permissions()
     
@@ -133,22 +166,37 @@ class ListingViewSet(viewsets.ModelViewSet):
 
     # Additional actions
 
+    # Full url example: /listings/5/similar/?k=10
+    @action(detail=True, methods=["get"])
+    def similar(self, request, pk=None):
+        listing = self.get_object()
+        try:
+            k = min(max(int(request.query_params.get("k", 10)), 1), 50)
+        except ValueError:
+            return Response(
+                {"error": "k must be an integer."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        similar_listings = SimilarityService.similar_listings(listing, k=k)
+        if request.user.is_authenticated:
+            hidden_user_ids = BlockService.hidden_user_ids(request.user.id)
+            similar_listings = [
+                similar for similar in similar_listings if similar.author_id_id not in hidden_user_ids
+            ]
+        serializer = self.get_serializer(similar_listings, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=["post"], permission_classes=[IsAuthenticated])
     def save_listing(self, request, pk=None):
         listing = self.get_object()
-        # Check if already saved
-        if SavedListing.objects.filter(user=request.user, listing=listing).exists():
+        if not ListingService.save_listing(request.user, listing):
             return Response({"detail": "Listing is already saved."}, status=status.HTTP_400_BAD_REQUEST)
-
-        SavedListing.objects.create(user=request.user, listing=listing)
         return Response({"detail": "Listing saved successfully."}, status=status.HTTP_201_CREATED)
 
     @action(detail=True, methods=["delete"], permission_classes=[IsAuthenticated])
     def remove_saved_listing(self, request, pk=None):
         listing = self.get_object()
-        saved_listing = SavedListing.objects.filter(user=request.user, listing=listing)
-        if saved_listing.exists():
-            saved_listing.delete()
+        if ListingService.remove_saved_listing(request.user, listing):
             return Response({"detail": "Listing removed from saved listings."}, status=status.HTTP_204_NO_CONTENT)
         return Response({"detail": "Listing was not saved."}, status=status.HTTP_400_BAD_REQUEST)
 
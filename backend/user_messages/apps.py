@@ -1,6 +1,35 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate, pre_delete
+
+
+def create_search_index(sender, using, **kwargs):
+    from user_messages.search import ensure_search_index
+
+    ensure_search_index(connections[using])
+
+
+def release_listing_unread(sender, instance, **kwargs):
+    from user_messages.models import Conversation
+    from user_messages.services.message_services import MessageService
+
+    # The listing's conversations are deleted by the cascade, their unread messages with them
+    MessageService.release_unread(Conversation.objects.filter(related_listing_id=instance.id))
+
+
+def archive_listing_messages(sender, instance, **kwargs):
+    from user_messages.services.archive_services import ArchiveService
+
+    # Runs before the delete cascades to the listing's messages
+    ArchiveService.archive_listing_messages(instance.id)
 
 
 class MessagesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user_messages'
+
+    def ready(self):
+        # The FTS table and its triggers aren't models, see user_messages.search
+        post_migrate.connect(create_search_index, sender=self)
+        pre_delete.connect(release_listing_unread, sender="listings.Listing")
+        pre_delete.connect(archive_listing_messages, sender="listings.Listing")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Greatest, Least
+
+from user_messages.models import Message
+from user_messages.services.message_services import MessageService
+
+
+class Command(BaseCommand):
+    help = "Creates Conversation rows for messages written before conversations existed."
+
+    def handle(self, *args, **options):
+        pairs = (
+            Message.objects.filter(conversation__isnull=True)
+            .annotate(user_one=Least("sender", "receiver"), user_two=Greatest("sender", "receiver"))
+            .values_list("related_listing", "user_one", "user_two")
+            .distinct()
+        )
+
+        count = 0
+        # Materialized first, each backfill removes its messages from the query above
+        for related_listing_id, user_one_id, user_two_id in list(pairs):
+            if MessageService.backfill_conversation(related_listing_id, user_one_id, user_two_id):
+                count += 1
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {count} conversations."))
@@ -3,6 +3,80 @@ from django.db import models
 from listings.models import Listing
 
 
+class Conversation(models.Model):
+    """One row per (listing, user pair), kept up to date as messages are sent.
+
+    The pair is stored in a fixed order, user_one always has the lower id, so both
+    participants resolve to the same row. The inbox reads this table instead of grouping
+    every message the user has ever sent or received.
+    """
+
+    related_listing = models.ForeignKey(
+        Listing, on_delete=models.CASCADE, related_name="conversations"
+    )
+    user_one = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="+"
+    )
+    user_two = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="+"
+    )
+    last_message = models.ForeignKey(
+        "Message", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # Read cursors, the id of the newest message each participant has read
+    user_one_last_read_id = models.PositiveBigIntegerField(default=0)
+    user_two_last_read_id = models.PositiveBigIntegerField(default=0)
+    # Messages each participant received after their read cursor
+    user_one_unread = models.PositiveIntegerField(default=0)
+    user_two_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["related_listing", "user_one", "user_two"],
+                name="unique_conversation",
+            ),
+        ]
+        indexes = [
+            # One index per side, the inbox query ORs the two
+            models.Index(fields=["user_one", "-last_message_at", "-id"], name="conversation_user_one_idx"),
+            models.Index(fields=["user_two", "-last_message_at", "-id"], name="conversation_user_two_idx"),
+        ]
+
+    @staticmethod
+    def ordered_pair(user_a_id, user_b_id):
+        return (user_a_id, user_b_id) if user_a_id < user_b_id else (user_b_id, user_a_id)
+
+    def unread_field(self, user_id):
+        return "user_one_unread" if user_id == self.user_one_id else "user_two_unread"
+
+    def unread_for(self, user_id):
+        return getattr(self, self.unread_field(user_id))
+
+    def last_read_field(self, user_id):
+        return "user_one_last_read_id" if user_id == self.user_one_id else "user_two_last_read_id"
+
+    def last_read_for(self, user_id):
+        return getattr(self, self.last_read_field(user_id))
+
+    def other_user_id(self, user_id):
+        return self.user_two_id if user_id == self.user_one_id else self.user_one_id
+
+
+class InboxCounter(models.Model):
+    """Unread messages per user across all their conversations.
+
+    Kept in step with the per-conversation counts by MessageService, so an unread badge is
+    a primary key lookup instead of a scan of the user's received messages.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="inbox_counter"
+    )
+    unread = models.PositiveIntegerField(default=0)
+
+
 class Message(models.Model):
     content = models.CharField(max_length=500)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -21,3 +95,53 @@ class Message(models.Model):
     receiver = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name="received_messages"
     )
+    # Null only for messages written before conversations existed, see backfill_conversations
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, null=True, blank=True, related_name="messages"
+    )
+
+    class Meta:
+        indexes = [
+            # Serves the thread between two users on a listing, in id order, one range scan
+            # per direction
+            models.Index(
+                fields=["related_listing", "sender", "receiver", "id"], name="message_thread_idx"
+            ),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """A message moved out of the live table by ArchiveService.
+
+    Keeps the original id and field names, so archived messages serialize like live ones
+    and a thread can continue from the live table into the archive by id. Listings and
+    conversations may be deleted after their messages were archived, those references
+    aren't enforced.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    content = models.CharField(max_length=500)
+    created_at = models.DateTimeField()
+    edited_at = models.DateTimeField()
+    edited = models.BooleanField(default=False)
+    related_listing = models.ForeignKey(
+        Listing, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["related_listing", "sender", "receiver", "id"], name="archived_message_thread_idx"
+            ),
+        ]
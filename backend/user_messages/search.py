@@ -0,0 +1,196 @@
+import base64
+import re
+
+from django.db import connection
+
+from listings.models import Listing
+
+from .models import ArchivedMessage, Message
+
+
+class FtsIndex:
+    """FTS5 index over the content of a message table.
+
+    It is an external content table, so the text is read from the message table rather than
+    stored twice. sender_id and receiver_id are indexed alongside the content so the
+    participant filter is part of the MATCH. Triggers keep it in step with every write.
+    """
+
+    def __init__(self, table, content_table):
+        self.table = table
+        self.content_table = content_table
+        self.create = f"""
+        CREATE VIRTUAL TABLE {table} USING fts5(
+            content, sender_id, receiver_id,
+            content='{content_table}', content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2'
+        )
+        """
+        # Only the message text counts towards the ranking, the participant columns are filters
+        self.set_rank = f"INSERT INTO {table}({table}, rank) VALUES('rank', 'bm25(1.0, 0.0, 0.0)')"
+        self.rebuild = f"INSERT INTO {table}({table}) VALUES('rebuild')"
+        # Merges the index into a single b-tree, worth running after a bulk load
+        self.optimize = f"INSERT INTO {table}({table}) VALUES('optimize')"
+        self.triggers = [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {content_table} BEGIN
+                INSERT INTO {table}(rowid, content, sender_id, receiver_id)
+                VALUES (new.id, new.content, new.sender_id, new.receiver_id);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {content_table} BEGIN
+                INSERT INTO {table}({table}, rowid, content, sender_id, receiver_id)
+                VALUES ('delete', old.id, old.content, old.sender_id, old.receiver_id);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_update
+            AFTER UPDATE OF content, sender_id, receiver_id ON {content_table} BEGIN
+                INSERT INTO {table}({table}, rowid, content, sender_id, receiver_id)
+                VALUES ('delete', old.id, old.content, old.sender_id, old.receiver_id);
+                INSERT INTO {table}(rowid, content, sender_id, receiver_id)
+                VALUES (new.id, new.content, new.sender_id, new.receiver_id);
+            END
+            """,
+        ]
+
+    def hits(self, after):
+        """Query for the best (id, rank, snippet) matches in this index, its LIMIT a parameter."""
+        return f"""
+        SELECT * FROM (
+            SELECT rowid AS id, rank, snippet({self.table}, 0, '<b>', '</b>', '…', 12) AS snippet
+            FROM {self.table}
+            WHERE {self.table} MATCH %s {after}
+            ORDER BY rank, rowid
+            LIMIT %s
+        )
+        """
+
+
+MESSAGE_INDEX = FtsIndex("user_messages_message_fts", Message._meta.db_table)
+# Archived messages keep their ids, so a rowid identifies a message across both indexes
+ARCHIVE_INDEX = FtsIndex("user_messages_archivedmessage_fts", ArchivedMessage._meta.db_table)
+INDEXES = [MESSAGE_INDEX, ARCHIVE_INDEX]
+
+# Both indexes are searched, a message is still found after ArchiveService moves it. Their
+# bm25 ranks come from separate term statistics, close enough to merge into one ordering
+SEARCH = f"""
+{MESSAGE_INDEX.hits("{after}")}
+UNION ALL
+{ARCHIVE_INDEX.hits("{after}")}
+ORDER BY rank, id
+LIMIT %s
+"""
+
+TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def is_supported(using=connection):
+    return using.vendor == "sqlite"
+
+
+def ensure_search_index(using=connection):
+    """Creates the FTS tables and their triggers if they are missing, indexing existing
+    messages. Returns whether any table was created.
+
+    Runs after every migrate, so it must be cheap when the indexes already exist.
+    """
+    if not is_supported(using):
+        return False
+
+    created = False
+    with using.cursor() as cursor:
+        for index in INDEXES:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [index.table])
+            if cursor.fetchone() is None:
+                created = True
+                cursor.execute(index.create)
+                cursor.execute(index.set_rank)
+                cursor.execute(index.rebuild)
+                cursor.execute(index.optimize)
+            for trigger in index.triggers:
+                cursor.execute(trigger)
+    return created
+
+
+def build_match(user_id, query):
+    """FTS5 MATCH expression for query scoped to the user's messages, or None if there are
+    no searchable terms. Every term must appear, matched on its stem (bikes finds bike).
+    Terms are quoted, so user input can't use FTS5 syntax.
+
+    Prefix queries aren't offered: a prefix of a common word merges the doclists of every
+    term it expands to, which made a single search cost tens of milliseconds at 2M messages.
+    """
+    terms = TERM_RE.findall(query.lower())
+    if not terms:
+        return None
+    phrases = [f'"{term}"' for term in terms]
+    # A column set filter reads the participant's doclist once for both columns
+    return f'{{sender_id receiver_id}}:{int(user_id)} AND content:({" ".join(phrases)})'
+
+
+def encode_cursor(rank, message_id):
+    return base64.urlsafe_b64encode(f"{rank!r}:{message_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return float(rank), int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor.")
+
+
+def search_messages(user_id, query, page_size=20, cursor=None):
+    """Ranked hits for query among the messages user_id sent or received, live or archived.
+
+    Returns (messages, next_cursor). Each message has a highlighted `snippet` attribute and
+    its listing loaded for context. Pages are keyset paginated on (rank, id), so a page
+    never costs more than the first one.
+    """
+    match = build_match(user_id, query)
+    if match is None:
+        return [], None
+
+    params = [match]
+    after = ""
+    if cursor is not None:
+        rank, message_id = decode_cursor(cursor)
+        after = "AND (rank > %s OR (rank = %s AND rowid > %s))"
+        params += [rank, rank, message_id]
+    params.append(page_size + 1)
+    # Same filter and limit for each index, then the limit on the merged hits
+    params = params * 2 + [page_size + 1]
+
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(SEARCH.format(after=after), params)
+        hits = db_cursor.fetchall()
+
+    next_cursor = None
+    if len(hits) > page_size:
+        hits = hits[:page_size]
+        next_cursor = encode_cursor(hits[-1][1], hits[-1][0])
+
+    messages = _load_messages([hit[0] for hit in hits])
+    results = []
+    for message_id, _, snippet in hits:
+        message = messages.get(message_id)
+        if message is not None:
+            message.snippet = snippet
+            results.append(message)
+    return results, next_cursor
+
+
+def _load_messages(ids):
+    """Live and archived messages by id, with their listings loaded."""
+    messages = Message.objects.select_related("related_listing").in_bulk(ids)
+    archived = ArchivedMessage.objects.in_bulk([id_ for id_ in ids if id_ not in messages])
+    if archived:
+        listings = Listing.objects.in_bulk({message.related_listing_id for message in archived.values()})
+        for message in archived.values():
+            # The listing may be deleted by now, its title then serializes as null
+            if message.related_listing_id in listings:
+                message.related_listing = listings[message.related_listing_id]
+        messages.update(archived)
+    return messages
@@ -1,3 +1,4 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from .models import Message
 
@@ -14,10 +15,46 @@ class MessageSerializer(serializers.ModelSerializer):
             "related_listing",
             "sender",
             "receiver",
+            "conversation",
         ]
         read_only_fields = [
             "created_at",
             "edited_at",
             "edited",
             "sender",
+            "conversation",
         ]
+        # Messages can only be sent to active accounts
+        extra_kwargs = {"receiver": {"queryset": User.objects.filter(is_active=True)}}
+
+
+class InboxMessageSerializer(MessageSerializer):
+    """Latest message of a conversation, with the requesting user's unread count and the
+    read cursors of both participants (other_last_read_id doubles as a read receipt)."""
+
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read_id = serializers.IntegerField(read_only=True)
+    other_last_read_id = serializers.IntegerField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ["unread_count", "last_read_id", "other_last_read_id"]
+
+
+class MarkReadSerializer(serializers.Serializer):
+    conversation = serializers.IntegerField()
+    up_to = serializers.IntegerField(required=False, min_value=0)
+
+
+class MessageSearchHitSerializer(MessageSerializer):
+    """A search hit, with the highlighted match and the conversation it belongs to."""
+
+    snippet = serializers.CharField(read_only=True)
+    listing_title = serializers.CharField(source="related_listing.title", read_only=True)
+    other_user = serializers.SerializerMethodField()
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ["snippet", "listing_title", "other_user"]
+
+    def get_other_user(self, message):
+        user_id = self.context["request"].user.id
+        return message.receiver_id if message.sender_id == user_id else message.sender_id
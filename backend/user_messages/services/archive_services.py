@@ -0,0 +1,145 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from user_messages.models import ArchivedMessage, Conversation, Message
+from user_messages.services.message_services import MessageService
+
+ARCHIVED_FIELDS = [
+    "id",
+    "content",
+    "created_at",
+    "edited_at",
+    "edited",
+    "related_listing_id",
+    "sender_id",
+    "receiver_id",
+    "conversation_id",
+]
+
+
+class ArchiveService:
+    """Moves messages nobody is likely to read again out of the live Message table.
+
+    Messages are archived when they are older than MESSAGE_ARCHIVE_AFTER, or when their
+    listing's author has been deactivated, or when the listing is deleted. Age alone never
+    archives a conversation's last message, so the conversation stays in its participants'
+    inboxes. Within a thread the archived messages are therefore always older than the live
+    ones, and thread reads continue into the archive once the live messages run out.
+    """
+
+    @staticmethod
+    def archivable_messages():
+        cutoff = timezone.now() - settings.MESSAGE_ARCHIVE_AFTER
+        is_last_message = Exists(Conversation.objects.filter(last_message=OuterRef("pk")))
+        return Message.objects.filter(
+            (Q(created_at__lt=cutoff) & ~is_last_message)
+            | Q(related_listing__author_id__is_active=False)
+        )
+
+    @classmethod
+    def archive_old_messages(cls, batch_size=None):
+        """Archives every archivable message in batches, each in its own short transaction.
+
+        Returns the number of messages archived.
+        """
+        batch_size = batch_size or settings.MESSAGE_ARCHIVE_BATCH_SIZE
+        archived = 0
+        last_id = 0
+        while True:
+            ids = list(
+                cls.archivable_messages()
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return archived
+            archived += cls.archive(Message.objects.filter(id__in=ids))
+            last_id = ids[-1]
+
+    @staticmethod
+    @transaction.atomic
+    def archive(messages):
+        """Copies messages into the archive and deletes them from the live table.
+
+        Archived messages the receiver hadn't read come off the conversation's unread count
+        and the receiver's inbox counter, mark_read only reaches live messages.
+        """
+        rows = list(messages.values(*ARCHIVED_FIELDS))
+        if not rows:
+            return 0
+        ArchivedMessage.objects.bulk_create(
+            [ArchivedMessage(**row) for row in rows], ignore_conflicts=True
+        )
+
+        rows_by_conversation = {}
+        for row in rows:
+            if row["conversation_id"] is not None:
+                rows_by_conversation.setdefault(row["conversation_id"], []).append(row)
+        conversations = Conversation.objects.select_for_update().filter(id__in=rows_by_conversation)
+        for conversation in conversations:
+            update_fields = []
+            for user_id in (conversation.user_one_id, conversation.user_two_id):
+                last_read_id = conversation.last_read_for(user_id)
+                archived_unread = sum(
+                    1 for row in rows_by_conversation[conversation.id]
+                    if row["receiver_id"] == user_id and row["id"] > last_read_id
+                )
+                # Never below zero, the count may already have been released
+                released = min(archived_unread, conversation.unread_for(user_id))
+                if released:
+                    unread_field = conversation.unread_field(user_id)
+                    setattr(conversation, unread_field, getattr(conversation, unread_field) - released)
+                    update_fields.append(unread_field)
+                    MessageService._add_unread(user_id, -released)
+            if update_fields:
+                conversation.save(update_fields=update_fields)
+
+        # Conversations whose last message is archived drop out of the inbox (SET_NULL)
+        Message.objects.filter(id__in=[row["id"] for row in rows]).delete()
+        return len(rows)
+
+    @classmethod
+    def archive_listing_messages(cls, listing_id):
+        return cls.archive(Message.objects.filter(related_listing_id=listing_id))
+
+    @staticmethod
+    def get_archived_thread_directions(user_id, other_user_id, listing_id):
+        """Archived counterpart of MessageService.get_thread_directions."""
+        return [
+            ArchivedMessage.objects.filter(
+                related_listing_id=listing_id, sender_id=user_id, receiver_id=other_user_id
+            ),
+            ArchivedMessage.objects.filter(
+                related_listing_id=listing_id, sender_id=other_user_id, receiver_id=user_id
+            ),
+        ]
+
+
+class LiveThenArchived:
+    """Newest-first sequence over a thread's live messages followed by its archived ones.
+
+    Supports slicing, so a paginator that doesn't need a total (UncountedPageNumberPagination)
+    can page through both tables as if they were one. The archive is only queried for slices
+    that reach past the end of the live messages.
+    """
+
+    ordered = True
+
+    def __init__(self, live, archived):
+        self.live = live
+        self.archived = archived
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        start, stop = index.start or 0, index.stop
+        rows = list(self.live[start:stop])
+        if len(rows) < stop - start:
+            # The live messages ran out inside this slice, or before it
+            live_count = start + len(rows) if rows else self.live.count()
+            rows += list(self.archived[max(start - live_count, 0):stop - live_count])
+        return rows
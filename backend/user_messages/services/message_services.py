@@ -0,0 +1,254 @@
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from api.realtime import publish_to_users
+from user_messages.models import ArchivedMessage, Conversation, InboxCounter, Message
+from user_messages.serializers import MessageSerializer
+
+
+class MessageService:
+    """Writes messages and keeps their Conversation row in step.
+
+    Every change to a message happens in the same transaction as the update to its
+    conversation, with the conversation row locked, so the inbox never points at a message
+    that doesn't exist or misses one that does.
+    """
+
+    @staticmethod
+    def conversation_filter(user):
+        return Q(user_one=user) | Q(user_two=user)
+
+    @staticmethod
+    def get_inbox(user, exclude_user_ids=()):
+        """Conversations involving user, most recently active first.
+
+        Conversations with any of exclude_user_ids (blocked users) are left out.
+        """
+        conversations = Conversation.objects.filter(MessageService.conversation_filter(user)).filter(
+            last_message__isnull=False
+        )
+        if exclude_user_ids:
+            conversations = conversations.exclude(user_one_id__in=exclude_user_ids).exclude(
+                user_two_id__in=exclude_user_ids
+            )
+        return conversations.select_related("last_message").order_by("-last_message_at", "-id")
+
+    @staticmethod
+    def get_thread_directions(user_id, other_user_id, listing_id):
+        """The messages user sent to other_user and the ones they got back, as two querysets.
+
+        Each one is a single range of the message_thread_idx index.
+        """
+        return [
+            Message.objects.filter(related_listing_id=listing_id, sender_id=user_id, receiver_id=other_user_id),
+            Message.objects.filter(related_listing_id=listing_id, sender_id=other_user_id, receiver_id=user_id),
+        ]
+
+    @staticmethod
+    @transaction.atomic
+    def create_message(sender, receiver, related_listing, content):
+        user_one_id, user_two_id = Conversation.ordered_pair(sender.id, receiver.id)
+        conversation, _ = Conversation.objects.select_for_update().get_or_create(
+            related_listing=related_listing, user_one_id=user_one_id, user_two_id=user_two_id
+        )
+
+        message = Message.objects.create(
+            sender=sender,
+            receiver=receiver,
+            related_listing=related_listing,
+            content=content,
+            conversation=conversation,
+        )
+
+        unread_field = conversation.unread_field(receiver.id)
+        Conversation.objects.filter(id=conversation.id).update(
+            last_message=message,
+            last_message_at=message.created_at,
+            **{unread_field: F(unread_field) + 1},
+        )
+        MessageService._add_unread(receiver.id, 1)
+        MessageService._publish("message.created", message)
+        return message
+
+    @staticmethod
+    @transaction.atomic
+    def edit_message(message, content):
+        # Nothing denormalized depends on the content, the conversation is left as is
+        message.content = content
+        message.edited = True
+        message.save(update_fields=["content", "edited", "edited_at"])
+        MessageService._publish("message.edited", message)
+        return message
+
+    @staticmethod
+    @transaction.atomic
+    def delete_message(message):
+        MessageService._publish("message.deleted", message)
+        if message.conversation_id is None:
+            message.delete()
+            return
+
+        conversation = Conversation.objects.select_for_update().get(id=message.conversation_id)
+
+        # Only messages past the receiver's read cursor count as unread
+        unread_field = conversation.unread_field(message.receiver_id)
+        unread = getattr(conversation, unread_field)
+        if unread and message.id > conversation.last_read_for(message.receiver_id):
+            setattr(conversation, unread_field, unread - 1)
+            MessageService._add_unread(message.receiver_id, -1)
+
+        was_last = conversation.last_message_id == message.id
+        message.delete()
+        if was_last:
+            latest = conversation.messages.order_by("-id").first()
+            if latest is not None:
+                conversation.last_message = latest
+                conversation.last_message_at = latest.created_at
+            else:
+                # Archived history still belongs to the conversation, it stays without a
+                # live last message and out of the inbox
+                archived = ArchivedMessage.objects.filter(conversation_id=conversation.id).order_by("-id").first()
+                if archived is None:
+                    conversation.delete()
+                    return
+                conversation.last_message = None
+                conversation.last_message_at = archived.created_at
+        conversation.save()
+
+    @staticmethod
+    @transaction.atomic
+    def discard_conversations(user_id, conversation_ids):
+        """Deletes conversations of a departing user whose messages are already gone.
+
+        The other participants' inbox counters drop by what they hadn't read. Returns the
+        number of conversations deleted.
+        """
+        conversations = Conversation.objects.select_for_update().filter(id__in=conversation_ids)
+        for conversation in conversations:
+            other_user_id = conversation.other_user_id(user_id)
+            unread = conversation.unread_for(other_user_id)
+            if unread:
+                MessageService._add_unread(other_user_id, -unread)
+        _, deleted = Conversation.objects.filter(id__in=conversation_ids).delete()
+        return deleted.get(Conversation._meta.label, 0)
+
+    @staticmethod
+    @transaction.atomic
+    def release_unread(conversations):
+        """Takes what the participants of conversations haven't read off their inbox counters.
+
+        For conversations about to be deleted along with their listing, the counters would
+        otherwise keep counting messages that no longer exist.
+        """
+        for conversation in conversations.select_for_update():
+            for user_id in (conversation.user_one_id, conversation.user_two_id):
+                unread = conversation.unread_for(user_id)
+                if unread:
+                    MessageService._add_unread(user_id, -unread)
+        conversations.update(user_one_unread=0, user_two_unread=0)
+
+    @staticmethod
+    def _publish(event_type, message):
+        # Serialized now, the message may be gone by the time the transaction commits
+        event = {"type": event_type, "message": MessageSerializer(message).data}
+        participants = [message.sender_id, message.receiver_id]
+        transaction.on_commit(lambda: publish_to_users(participants, event))
+
+    @staticmethod
+    def get_conversation(user, other_user_id, listing_id):
+        """The user's conversation with other_user about a listing, or None."""
+        user_one_id, user_two_id = Conversation.ordered_pair(user.id, int(other_user_id))
+        return Conversation.objects.filter(
+            related_listing_id=listing_id, user_one_id=user_one_id, user_two_id=user_two_id
+        ).first()
+
+    @staticmethod
+    def mark_read(user, conversation, up_to_id=None):
+        """Moves the user's read cursor up to up_to_id, or to the latest message.
+
+        Returns the updated conversation. The other participant is sent a
+        conversation.read event they can use as a read receipt.
+        """
+        # Cursors only move forward, so a conversation that is already read needs no queries,
+        # not even a transaction
+        target = (conversation.last_message_id or 0) if up_to_id is None else up_to_id
+        if target <= conversation.last_read_for(user.id):
+            return conversation
+
+        with transaction.atomic():
+            conversation = Conversation.objects.select_for_update().get(id=conversation.id)
+            last_message_id = conversation.last_message_id or 0
+            up_to_id = last_message_id if up_to_id is None else min(up_to_id, last_message_id)
+
+            last_read_field = conversation.last_read_field(user.id)
+            if up_to_id <= getattr(conversation, last_read_field):
+                # Cursors only move forward
+                return conversation
+
+            unread_field = conversation.unread_field(user.id)
+            unread = getattr(conversation, unread_field)
+            remaining = 0
+            if unread and up_to_id < last_message_id:
+                remaining = Message.objects.filter(
+                    conversation=conversation, receiver=user, id__gt=up_to_id
+                ).count()
+
+            setattr(conversation, last_read_field, up_to_id)
+            setattr(conversation, unread_field, remaining)
+            conversation.save(update_fields=[last_read_field, unread_field])
+            if unread > remaining:
+                MessageService._add_unread(user.id, remaining - unread)
+
+            event = {
+                "type": "conversation.read",
+                "message": {"conversation": conversation.id, "user": user.id, "last_read_id": up_to_id},
+            }
+            other_user_id = conversation.other_user_id(user.id)
+            transaction.on_commit(lambda: publish_to_users([other_user_id], event))
+            return conversation
+
+    @staticmethod
+    def unread_count(user):
+        """Total unread messages for the user, a single primary key lookup."""
+        return InboxCounter.objects.filter(user=user).values_list("unread", flat=True).first() or 0
+
+    @staticmethod
+    def _add_unread(user_id, delta):
+        # A single UPDATE once the user has a counter row
+        if InboxCounter.objects.filter(user_id=user_id).update(unread=Greatest(F("unread") + delta, 0)):
+            return
+        counter, created = InboxCounter.objects.get_or_create(
+            user_id=user_id, defaults={"unread": max(delta, 0)}
+        )
+        if not created:
+            InboxCounter.objects.filter(user_id=user_id).update(unread=Greatest(F("unread") + delta, 0))
+
+    @staticmethod
+    @transaction.atomic
+    def backfill_conversation(related_listing_id, user_one_id, user_two_id):
+        """Creates or repairs the conversation for one (listing, user pair) from its messages.
+
+        Messages without a conversation are attached to it and last_message is recomputed.
+        There is no read state to derive unread counts from, so both participants start
+        with everything read.
+        """
+        conversation, created = Conversation.objects.select_for_update().get_or_create(
+            related_listing_id=related_listing_id, user_one_id=user_one_id, user_two_id=user_two_id
+        )
+        Message.objects.filter(
+            Q(sender_id=user_one_id, receiver_id=user_two_id) | Q(sender_id=user_two_id, receiver_id=user_one_id),
+            related_listing_id=related_listing_id,
+            conversation__isnull=True,
+        ).update(conversation=conversation)
+
+        latest = conversation.messages.order_by("-id").first()
+        if latest is None:
+            conversation.delete()
+            return None
+        conversation.last_message = latest
+        conversation.last_message_at = latest.created_at
+        if created:
+            conversation.user_one_last_read_id = conversation.user_two_last_read_id = latest.id
+        conversation.save()
+        return conversation
@@ -0,0 +1,12 @@
+from django.conf import settings
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, lock_task
+
+from .services.archive_services import ArchiveService
+
+
+@db_periodic_task(crontab(hour="3", minute="30"), priority=settings.TASK_PRIORITIES["cleanup"])
+@lock_task("archive-messages")
+def archive_messages():
+    # Batched, so the live table is never locked for long
+    return ArchiveService.archive_old_messages()
@@ -1,20 +1,41 @@
+import asyncio
+import json
 import os
+import time
+from datetime import timedelta
+from io import StringIO
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.test import TransactionTestCase
 from django.urls import reverse
+from django.utils import timezone
 from listings.models import Listing, Tag
 from PIL import Image
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
 
-from .models import Message
+from accounts.services.block_services import BlockService
+from api.realtime import get_broker, publish_to_users, user_channel
+
+from .models import ArchivedMessage, Conversation, InboxCounter, Message
 from .serializers import MessageSerializer
+from .services.archive_services import ArchiveService
+from .services.message_services import MessageService
+from .tasks import archive_messages
 
 
 class MessageBaseTestCase(APITestCase):
     def setUp(self):
+        # Cached block sets are keyed by user id, which the next test reuses
+        cache.clear()
         self.client = APIClient()
         self.user1 = User.objects.create_user(username="user1", password="password123")
         self.user2 = User.objects.create_user(username="user2", password="password123")
@@ -34,13 +55,13 @@ class MessageBaseTestCase(APITestCase):
         )
         self.listing.tags.set([self.tag1, self.tag2])
 
-        self.message1 = Message.objects.create(
+        self.message1 = MessageService.create_message(
             sender=self.user1,
             receiver=self.user2,
             related_listing=self.listing,
             content="Hello from user1",
         )
-        self.message2 = Message.objects.create(
+        self.message2 = MessageService.create_message(
             sender=self.user2,
             receiver=self.user1,
             related_listing=self.listing,
@@ -68,6 +89,20 @@ class ListMessagesTestCase(MessageBaseTestCase):
         # Add more specific logic later
 
 
+class BlockedMessagesTestCase(MessageBaseTestCase):
+    def test_inbox_hides_blocked_users(self):
+        self.assertEqual(len(self.client.get(reverse("message-list")).data), 1)
+        BlockService.block(self.user2, self.user1)
+        self.assertEqual(self.client.get(reverse("message-list")).data, [])
+        BlockService.unblock(self.user2, self.user1)
+        self.assertEqual(len(self.client.get(reverse("message-list")).data), 1)
+
+    def test_blocked_user_messages_are_hidden(self):
+        BlockService.block(self.user1, self.user2)
+        url = reverse("message-detail", kwargs={"pk": self.message2.pk})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+
 class CreateMessageTestCase(MessageBaseTestCase):
     def test_create_message(self):
         data = {
@@ -79,6 +114,26 @@ class CreateMessageTestCase(MessageBaseTestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Message.objects.count(), 3)
 
+    def test_create_message_to_blocking_user(self):
+        BlockService.block(self.user2, self.user1)
+        data = {"receiver": self.user2.id, "related_listing": self.listing.id, "content": "Hi"}
+        response = self.client.post(reverse("message-list"), data)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_create_message_to_blocked_user(self):
+        BlockService.block(self.user1, self.user2)
+        data = {"receiver": self.user2.id, "related_listing": self.listing.id, "content": "Hi"}
+        response = self.client.post(reverse("message-list"), data)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_create_message_to_inactive_user(self):
+        User.objects.filter(id=self.user2.id).update(is_active=False)
+        data = {"receiver": self.user2.id, "related_listing": self.listing.id, "content": "Hi"}
+        response = self.client.post(reverse("message-list"), data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("receiver", response.data)
+
 
 class RetrieveMessageTestCase(MessageBaseTestCase):
     def test_retrieve_message(self):
@@ -176,3 +231,616 @@ class ListMessagesWithUserTestCase(MessageBaseTestCase):
         # We want to check the top 25 messages, as each page has 25 items
         serializer = MessageSerializer(messages.order_by("-created_at")[:25], many=True)
         self.assertEqual(message_results, serializer.data)
+
+
+class ConversationTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user3 = User.objects.create_user(username="user3", password="password123")
+        self.conversation = Conversation.objects.get()
+
+    def test_messages_share_one_conversation(self):
+        self.assertEqual(self.message1.conversation_id, self.conversation.id)
+        self.assertEqual(self.message2.conversation_id, self.conversation.id)
+        self.assertEqual(self.conversation.last_message_id, self.message2.id)
+        self.assertEqual(self.conversation.user_one_unread, 1)
+        self.assertEqual(self.conversation.user_two_unread, 1)
+
+    def test_inbox_lists_latest_message_per_conversation(self):
+        MessageService.create_message(self.user3, self.user1, self.listing, "Is this available?")
+        response = self.client.get(reverse("message-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(response.data[0]["content"], "Is this available?")
+        self.assertEqual(response.data[0]["unread_count"], 1)
+        self.assertEqual(response.data[1]["id"], self.message2.id)
+
+    def test_inbox_cursor_pagination(self):
+        MessageService.create_message(self.user3, self.user1, self.listing, "Is this available?")
+        response = self.client.get(reverse("message-list"), {"page_size": 1})
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertIsNotNone(response.data["next"])
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual(response.data["results"][0]["id"], self.message2.id)
+        self.assertIsNone(response.data["next"])
+
+    def test_with_user_marks_conversation_read(self):
+        self.client.get(reverse("message-with-user"), {"user": self.user2.id, "listing": self.listing.id})
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.user_one_unread, 0)
+        self.assertEqual(self.conversation.user_two_unread, 1)
+
+    def test_delete_last_message_moves_conversation_back(self):
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.delete(reverse("message-detail", args=[self.message2.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, self.message1.id)
+        self.assertEqual(self.conversation.user_one_unread, 0)
+
+    def test_deleting_every_message_removes_conversation(self):
+        MessageService.delete_message(self.message1)
+        MessageService.delete_message(self.message2)
+        self.assertFalse(Conversation.objects.exists())
+
+    def test_backfill_conversations(self):
+        # Messages written before conversations existed
+        Message.objects.update(conversation=None)
+        Conversation.objects.all().delete()
+        Message.objects.create(
+            sender=self.user3, receiver=self.user1, related_listing=self.listing, content="Old message"
+        )
+        call_command("backfill_conversations", stdout=StringIO())
+
+        self.assertEqual(Conversation.objects.count(), 2)
+        self.assertFalse(Message.objects.filter(conversation__isnull=True).exists())
+        self.conversation = Conversation.objects.get(user_one=self.user1, user_two=self.user2)
+        self.assertEqual(self.conversation.last_message_id, self.message2.id)
+
+
+class MessageCursorTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.thread = [self.message1, self.message2] + [
+            MessageService.create_message(self.user1, self.user2, self.listing, f"Message {i}")
+            for i in range(5)
+        ]
+        self.url = reverse("message-with-user")
+        self.params = {"user": self.user2.id, "listing": self.listing.id}
+
+    def test_after_id_returns_newer_messages_oldest_first(self):
+        response = self.client.get(self.url, {**self.params, "after_id": self.thread[3].id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m["id"] for m in response.data["results"]], [m.id for m in self.thread[4:]])
+        self.assertFalse(response.data["has_more"])
+
+    def test_after_latest_id_is_empty(self):
+        response = self.client.get(self.url, {**self.params, "after_id": self.thread[-1].id})
+        self.assertEqual(response.data["results"], [])
+
+    def test_before_id_scrolls_back_newest_first(self):
+        response = self.client.get(
+            self.url, {**self.params, "before_id": self.thread[5].id, "page_size": 2}
+        )
+        self.assertEqual([m["id"] for m in response.data["results"]], [self.thread[4].id, self.thread[3].id])
+        self.assertTrue(response.data["has_more"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {**self.params, "after_id": "abc"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_other_threads_excluded(self):
+        user3 = User.objects.create_user(username="user3", password="password123")
+        MessageService.create_message(user3, self.user1, self.listing, "Another thread")
+        response = self.client.get(self.url, {**self.params, "after_id": 0, "page_size": 100})
+        self.assertEqual(len(response.data["results"]), len(self.thread))
+
+
+class MessageStreamTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("message-stream")
+        self.token = str(AccessToken.for_user(self.user2))
+
+    def test_stream_requires_token(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.get(self.url, {"token": "not-a-token"})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_stream_rejects_inactive_and_deleted_users(self):
+        self.user2.is_active = False
+        self.user2.save()
+        response = self.client.get(self.url, {"token": self.token})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user2.delete()
+        response = self.client.get(self.url, {"token": self.token})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_stream_delivers_published_events(self):
+        response = await self.async_client.get(self.url, headers={"authorization": f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        events = response.streaming_content
+        self.assertTrue((await anext(events)).startswith(b"retry:"))
+        message = {"id": 1, "sender": self.user1.id, "receiver": self.user2.id}
+        publish_to_users([self.user2.id], {"type": "message.created", "message": message})
+        self.assertEqual(
+            await anext(events),
+            f'event: message.created\ndata: {json.dumps(message)}\n\n'.encode(),
+        )
+        await events.aclose()
+
+    async def test_stream_drops_events_from_blocked_users(self):
+        user3 = await sync_to_async(User.objects.create_user)(username="user3", password="password123")
+        await sync_to_async(BlockService.block)(self.user2, self.user1)
+        response = await self.async_client.get(self.url, {"token": self.token})
+        events = response.streaming_content
+        await anext(events)
+
+        publish_to_users(
+            [self.user2.id],
+            {"type": "message.edited", "message": {"id": 1, "sender": self.user1.id, "receiver": self.user2.id}},
+        )
+        publish_to_users(
+            [self.user2.id],
+            {"type": "conversation.read", "message": {"conversation": 1, "user": self.user1.id, "last_read_id": 1}},
+        )
+        publish_to_users(
+            [self.user2.id],
+            {"type": "message.created", "message": {"id": 2, "sender": user3.id, "receiver": self.user2.id}},
+        )
+        self.assertIn(b'"id": 2', await anext(events))
+        await events.aclose()
+
+    async def test_stream_sends_keepalive_when_idle(self):
+        with self.settings(REALTIME_HEARTBEAT_SECONDS=0.01):
+            response = await self.async_client.get(self.url, {"token": self.token})
+            events = response.streaming_content
+            await anext(events)
+            self.assertEqual(await anext(events), b": keepalive\n\n")
+            await events.aclose()
+
+    def test_message_writes_notify_both_participants(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def subscribe(user):
+            return get_broker().subscribe(user_channel(user.id))
+
+        subscriptions = [loop.run_until_complete(subscribe(user)) for user in (self.user1, self.user2)]
+        with self.captureOnCommitCallbacks(execute=True):
+            message = MessageService.create_message(self.user1, self.user2, self.listing, "Still for sale?")
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageService.edit_message(message, "Is it still for sale?")
+
+        for subscription in subscriptions:
+            created = loop.run_until_complete(subscription.get(timeout=1))
+            edited = loop.run_until_complete(subscription.get(timeout=1))
+            self.assertEqual(created["type"], "message.created")
+            self.assertEqual(edited["type"], "message.edited")
+            self.assertEqual(edited["message"]["content"], "Is it still for sale?")
+            loop.run_until_complete(subscription.__aexit__(None, None, None))
+
+
+class MessageStreamConnectionTestCase(TransactionTestCase):
+    async def test_stream_holds_no_database_connection(self):
+        user = await sync_to_async(User.objects.create_user)(username="streamer", password="password123")
+        await sync_to_async(cache.clear)()
+        token = str(AccessToken.for_user(user))
+
+        # The in-memory test database ignores close(), so count the calls instead. Views run
+        # their sync code on this thread, which has its own connection object
+        closed = []
+
+        def spy_on_close():
+            sync_connection = connections["default"]
+            close = sync_connection.close
+            sync_connection.close = lambda: closed.append(True) or close()
+            self.addCleanup(delattr, sync_connection, "close")
+
+        await sync_to_async(spy_on_close)()
+
+        response = await self.async_client.get(reverse("message-stream"), {"token": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        events = response.streaming_content
+        await anext(events)
+        # The user was read from the database, and the connection released before streaming
+        self.assertTrue(closed)
+        await events.aclose()
+
+
+class MessageWaitTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("message-wait")
+        self.auth = {"authorization": f"Bearer {AccessToken.for_user(self.user1)}"}
+
+    def payload(self, message_id, sender=None):
+        return {"id": message_id, "sender": (sender or self.user2).id, "receiver": self.user1.id}
+
+    def test_wait_requires_token_and_after_id(self):
+        response = self.client.get(self.url, {"after_id": 0})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.get(self.url, headers=self.auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wait_rejects_inactive_users(self):
+        self.user1.is_active = False
+        self.user1.save()
+        response = self.client.get(self.url, {"after_id": 0}, headers=self.auth)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_returns_pending_messages_immediately(self):
+        response = await self.async_client.get(
+            self.url, {"after_id": self.message1.id, "timeout": 5}, headers=self.auth
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m["id"] for m in json.loads(response.content)["results"]], [self.message2.id])
+
+    async def test_wakes_up_on_new_message(self):
+        async def publish_later():
+            await asyncio.sleep(0.05)
+            publish_to_users(
+                [self.user1.id],
+                {"type": "message.edited", "message": self.payload(self.message2.id)},
+            )
+            publish_to_users(
+                [self.user1.id],
+                {"type": "message.created", "message": self.payload(self.message2.id + 1)},
+            )
+
+        started = time.monotonic()
+        response, _ = await asyncio.gather(
+            self.async_client.get(self.url, {"after_id": self.message2.id, "timeout": 5}, headers=self.auth),
+            publish_later(),
+        )
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(json.loads(response.content)["results"], [self.payload(self.message2.id + 1)])
+
+    async def test_returns_events_queued_together(self):
+        async def publish_later():
+            await asyncio.sleep(0.05)
+            for offset in (1, 2):
+                publish_to_users(
+                    [self.user1.id],
+                    {"type": "message.created", "message": self.payload(self.message2.id + offset)},
+                )
+
+        response, _ = await asyncio.gather(
+            self.async_client.get(self.url, {"after_id": self.message2.id, "timeout": 5}, headers=self.auth),
+            publish_later(),
+        )
+        self.assertEqual(
+            json.loads(response.content)["results"],
+            [self.payload(self.message2.id + 1), self.payload(self.message2.id + 2)],
+        )
+
+    async def test_skips_messages_from_blocked_users(self):
+        user3 = await sync_to_async(User.objects.create_user)(username="user3", password="password123")
+        await sync_to_async(BlockService.block)(self.user1, self.user2)
+
+        async def publish_later():
+            await asyncio.sleep(0.05)
+            for sender in (self.user2, user3):
+                publish_to_users(
+                    [self.user1.id],
+                    {"type": "message.created", "message": self.payload(self.message2.id + 1, sender)},
+                )
+
+        # message2 from user2 is already waiting but hidden, only user3's message is returned
+        response, _ = await asyncio.gather(
+            self.async_client.get(self.url, {"after_id": self.message1.id, "timeout": 5}, headers=self.auth),
+            publish_later(),
+        )
+        self.assertEqual(
+            json.loads(response.content)["results"], [self.payload(self.message2.id + 1, user3)]
+        )
+
+    async def test_times_out_without_new_messages(self):
+        response = await self.async_client.get(
+            self.url, {"after_id": self.message2.id, "timeout": 0.05}, headers=self.auth
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)["results"], [])
+
+
+class ReadReceiptTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation = Conversation.objects.get()
+        self.later = [
+            MessageService.create_message(self.user2, self.user1, self.listing, f"Follow up {i}")
+            for i in range(3)
+        ]
+        self.mark_read_url = reverse("message-mark-read")
+        self.unread_url = reverse("message-unread-count")
+
+    def test_unread_count_is_maintained(self):
+        response = self.client.get(self.unread_url)
+        self.assertEqual(response.data, {"unread_count": 4})
+        self.assertEqual(InboxCounter.objects.get(user=self.user2).unread, 1)
+
+    def test_unread_count_is_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(MessageService.unread_count(self.user1), 4)
+
+    def test_mark_conversation_read(self):
+        response = self.client.post(self.mark_read_url, {"conversation": self.conversation.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["last_read_id"], self.later[-1].id)
+        self.assertEqual(response.data["unread_count"], 0)
+        self.assertEqual(self.client.get(self.unread_url).data["unread_count"], 0)
+
+    def test_mark_read_up_to_message(self):
+        response = self.client.post(
+            self.mark_read_url, {"conversation": self.conversation.id, "up_to": self.later[0].id}
+        )
+        self.assertEqual(response.data["unread_count"], 2)
+        self.assertEqual(MessageService.unread_count(self.user1), 2)
+
+        # The cursor never moves back
+        response = self.client.post(
+            self.mark_read_url, {"conversation": self.conversation.id, "up_to": self.message2.id}
+        )
+        self.assertEqual(response.data["last_read_id"], self.later[0].id)
+
+    def test_mark_read_other_users_conversation(self):
+        user3 = User.objects.create_user(username="user3", password="password123")
+        self.client.force_authenticate(user=user3)
+        response = self.client.post(self.mark_read_url, {"conversation": self.conversation.id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_deleting_unread_message_updates_counters(self):
+        MessageService.delete_message(self.later[-1])
+        self.assertEqual(MessageService.unread_count(self.user1), 3)
+
+        MessageService.mark_read(self.user1, self.conversation)
+        MessageService.delete_message(self.later[0])
+        self.assertEqual(MessageService.unread_count(self.user1), 0)
+
+    def test_deleting_listing_releases_unread(self):
+        self.listing.delete()
+        self.assertFalse(Conversation.objects.exists())
+        self.assertEqual(MessageService.unread_count(self.user1), 0)
+        self.assertEqual(MessageService.unread_count(self.user2), 0)
+        self.assertEqual(self.client.get(self.unread_url).data["unread_count"], 0)
+
+    def test_inbox_shows_read_receipt(self):
+        MessageService.mark_read(self.user2, self.conversation)
+        response = self.client.get(reverse("message-list"))
+        self.assertEqual(response.data[0]["unread_count"], 4)
+        self.assertEqual(response.data[0]["other_last_read_id"], self.later[-1].id)
+
+
+class MessageSearchTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user3 = User.objects.create_user(username="user3", password="password123")
+        self.url = reverse("message-search")
+        MessageService.create_message(self.user1, self.user2, self.listing, "Is the bike lock included?")
+        MessageService.create_message(self.user2, self.user1, self.listing, "Yes, the lock and both keys")
+        # Not visible to user1
+        MessageService.create_message(self.user3, self.user2, self.listing, "Bike lock still available?")
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_search_is_scoped_to_participant(self):
+        data = self.search(q="lock")
+        self.assertEqual(len(data["results"]), 2)
+        self.assertTrue(all(hit["other_user"] == self.user2.id for hit in data["results"]))
+        self.assertIn("<b>lock</b>", data["results"][0]["snippet"])
+        self.assertEqual(data["results"][0]["listing_title"], self.listing.title)
+
+    def test_all_terms_must_match(self):
+        data = self.search(q="bikes lock")
+        self.assertEqual([hit["content"] for hit in data["results"]], ["Is the bike lock included?"])
+
+    def test_search_sees_edits_and_deletes(self):
+        message = MessageService.create_message(self.user1, self.user2, self.listing, "Helmet too?")
+        self.assertEqual(len(self.search(q="helmet")["results"]), 1)
+
+        MessageService.edit_message(message, "Gloves too?")
+        self.assertEqual(len(self.search(q="helmet")["results"]), 0)
+        self.assertEqual(len(self.search(q="gloves")["results"]), 1)
+
+        MessageService.delete_message(message)
+        self.assertEqual(len(self.search(q="gloves")["results"]), 0)
+
+    def test_search_query_syntax_is_escaped(self):
+        self.assertEqual(self.search(q='lock" OR sender_id:3')["results"], [])
+        self.assertEqual(self.search(q="***")["results"], [])
+
+    def test_search_cursor_pagination(self):
+        for i in range(4):
+            MessageService.create_message(self.user2, self.user1, self.listing, f"Another lock message {i}")
+        first = self.search(q="lock", page_size=4)
+        self.assertEqual(len(first["results"]), 4)
+
+        second = self.client.get(first["next"]).data
+        self.assertEqual(len(second["results"]), 2)
+        self.assertIsNone(second["next"])
+        ids = [hit["id"] for hit in first["results"] + second["results"]]
+        self.assertEqual(len(set(ids)), 6)
+
+    def test_search_finds_archived_messages(self):
+        ArchiveService.archive(Message.objects.filter(content__startswith="Is the bike"))
+        data = self.search(q="bike lock")
+        self.assertEqual([hit["content"] for hit in data["results"]], ["Is the bike lock included?"])
+        self.assertEqual(data["results"][0]["listing_title"], self.listing.title)
+
+        # Archived with the listing, the hit stays without its title
+        self.listing.delete()
+        data = self.search(q="lock")
+        self.assertEqual(len(data["results"]), 2)
+        self.assertTrue(all(hit["listing_title"] is None for hit in data["results"]))
+
+    def test_search_cursor_pagination_across_archive(self):
+        for i in range(4):
+            MessageService.create_message(self.user2, self.user1, self.listing, f"Another lock message {i}")
+        ArchiveService.archive(Message.objects.filter(content__contains="message")[:2])
+        pages = [self.search(q="lock", page_size=2)]
+        while pages[-1]["next"]:
+            pages.append(self.client.get(pages[-1]["next"]).data)
+        ids = [hit["id"] for page in pages for hit in page["results"]]
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(len(set(ids)), 6)
+
+    def test_search_requires_query(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MessageArchiveTestCase(MessageBaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.thread = [self.message1, self.message2] + [
+            MessageService.create_message(self.user1, self.user2, self.listing, f"Message {i}")
+            for i in range(5)
+        ]
+        # Everything but the two newest messages is past the archive age
+        Message.objects.filter(id__in=[m.id for m in self.thread[:-2]]).update(
+            created_at=timezone.now() - settings.MESSAGE_ARCHIVE_AFTER - timedelta(days=1)
+        )
+        self.url = reverse("message-with-user")
+        self.params = {"user": self.user2.id, "listing": self.listing.id}
+
+    def test_archives_old_messages_in_batches(self):
+        self.assertEqual(ArchiveService.archive_old_messages(batch_size=2), 5)
+        self.assertEqual(Message.objects.count(), 2)
+        archived = ArchivedMessage.objects.get(id=self.message1.id)
+        self.assertEqual(archived.content, self.message1.content)
+        self.assertEqual(archived.conversation_id, self.message1.conversation_id)
+
+    def test_conversation_last_message_is_kept(self):
+        Message.objects.update(created_at=timezone.now() - settings.MESSAGE_ARCHIVE_AFTER - timedelta(days=1))
+        ArchiveService.archive_old_messages()
+        self.assertEqual(list(Message.objects.values_list("id", flat=True)), [self.thread[-1].id])
+        self.assertEqual(len(self.client.get(reverse("message-list")).data), 1)
+
+    def test_archived_unread_messages_leave_the_counters(self):
+        self.assertEqual(MessageService.unread_count(self.user2), 6)
+        ArchiveService.archive_old_messages()
+        # Only the two live messages are still unread
+        self.assertEqual(MessageService.unread_count(self.user2), 2)
+        self.assertEqual(MessageService.unread_count(self.user1), 0)
+
+        MessageService.mark_read(self.user2, Conversation.objects.get())
+        self.assertEqual(MessageService.unread_count(self.user2), 0)
+
+    def test_deleting_last_live_message_keeps_archived_conversation(self):
+        ArchiveService.archive_old_messages()
+        for message in self.thread[-2:]:
+            MessageService.delete_message(Message.objects.get(id=message.id))
+
+        conversation = Conversation.objects.get()
+        self.assertIsNone(conversation.last_message)
+        self.assertEqual(
+            ArchivedMessage.objects.filter(conversation=conversation).count(), len(self.thread) - 2
+        )
+        self.assertEqual(MessageService.unread_count(self.user2), 0)
+
+    def test_inactive_author_listing_is_archived(self):
+        User.objects.filter(id=self.user1.id).update(is_active=False)
+        archive_messages.call_local()
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(ArchivedMessage.objects.count(), len(self.thread))
+        self.assertEqual(MessageService.unread_count(self.user2), 0)
+        self.assertEqual(Conversation.objects.get().unread_for(self.user2.id), 0)
+
+    def test_deleted_listing_messages_are_archived(self):
+        self.listing.delete()
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(ArchivedMessage.objects.count(), len(self.thread))
+
+    def test_thread_pages_continue_into_archive(self):
+        ArchiveService.archive_old_messages()
+        response = self.client.get(self.url, self.params)
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data["next"])
+        self.assertEqual(
+            [m["id"] for m in response.data["results"]], [m.id for m in reversed(self.thread)]
+        )
+
+    def test_first_thread_page_leaves_archive_alone(self):
+        ArchiveService.archive_old_messages()
+        newer = [
+            MessageService.create_message(self.user2, self.user1, self.listing, f"Newer {i}")
+            for i in range(26)
+        ]
+        archive_table = ArchivedMessage._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, self.params)
+        self.assertFalse([query for query in queries if archive_table in query["sql"]])
+        self.assertEqual([m["id"] for m in response.data["results"]], [m.id for m in reversed(newer[1:])])
+
+        # The second page runs out of live messages and continues into the archive
+        response = self.client.get(response.data["next"])
+        self.assertEqual(len(response.data["results"]), 1 + len(self.thread))
+        self.assertIsNone(response.data["next"])
+
+    def test_thread_cursor_falls_back_to_archive(self):
+        ArchiveService.archive_old_messages()
+        response = self.client.get(
+            self.url, {**self.params, "before_id": self.thread[-1].id, "page_size": 3}
+        )
+        self.assertEqual(
+            [m["id"] for m in response.data["results"]], [m.id for m in self.thread[-2:-5:-1]]
+        )
+        self.assertTrue(response.data["has_more"])
+
+        response = self.client.get(
+            self.url, {**self.params, "before_id": self.thread[-4].id, "page_size": 3}
+        )
+        self.assertEqual([m["id"] for m in response.data["results"]], [m.id for m in self.thread[2::-1]])
+        self.assertFalse(response.data["has_more"])
+
+
+class MessageQueryBudgetTestCase(MessageBaseTestCase):
+    """Pins the number of queries on the hot write and read paths."""
+
+    def setUp(self):
+        super().setUp()
+        # Warm the block cache the way an active user would
+        BlockService.is_blocked_by(self.user1.id, self.user2.id)
+        self.data = {"receiver": self.user2.id, "related_listing": self.listing.id, "content": "Hi"}
+
+    def test_create_query_count(self):
+        # receiver and listing validation, the conversation upsert, the message insert and
+        # the counter update, plus the savepoints around them
+        with self.assertNumQueries(8):
+            response = self.client.post(reverse("message-list"), self.data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_update_query_count(self):
+        # A single fetch of the message, then the update of the edited columns
+        url = reverse("message-detail", kwargs={"pk": self.message1.pk})
+        with self.assertNumQueries(4):
+            response = self.client.patch(url, {"content": "Edited"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_thread_query_count(self):
+        params = {"user": self.user2.id, "listing": self.listing.id, "after_id": 0}
+        # Read once so the conversation is already marked read, leaving the conversation
+        # lookup and one range scan per direction
+        self.client.get(reverse("message-with-user"), params)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("message-with-user"), params)
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def test_blocked_sender_costs_no_extra_queries(self):
+        # Only the receiver and listing validation, the block comes from the cache
+        BlockService.block(self.user2, self.user1)
+        BlockService.is_blocked_by(self.user1.id, self.user2.id)
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse("message-list"), self.data)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
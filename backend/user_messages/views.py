@@ -1,67 +1,97 @@
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Case, F, Max, Q, When
+from django.db import connection, models
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.db.models import Q
 from listings.models import Listing
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
-from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from accounts.services.block_services import BlockService
+from api.db_routers import ReplicaReadMixin
+from api.pagination import IdCursorPagination, InboxCursorPagination, UncountedPageNumberPagination
+from api.realtime import authenticate_stream, get_broker, user_channel
 
-from .models import Message
-from .serializers import MessageSerializer
+from .models import ArchivedMessage, Conversation, Message
+from .search import search_messages
+from .serializers import (
+    InboxMessageSerializer,
+    MarkReadSerializer,
+    MessageSearchHitSerializer,
+    MessageSerializer,
+)
+from .services.archive_services import ArchiveService, LiveThenArchived
+from .services.message_services import MessageService
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     pagination_class = None  # temporary
     permission_classes = [IsAuthenticated]
+    # Read only actions that may lag behind the primary, with_user marks messages read so
+    # it stays on the primary
+    replica_actions = {"list", "retrieve", "unread_count"}
 
     def get_queryset(self):
         user = self.request.user
-        # If not performing list action, queryset should be any message that involves the user
-        if self.action != "list":
-            return Message.objects.filter(Q(sender=user) | Q(receiver=user))
-
-        # Show most recent message for each unique (reciever, related_listing) pair
-        latest_messages = (
-            Message.objects.filter(
-                Q(sender=self.request.user) | Q(receiver=self.request.user)
-            )
-            .annotate(
-                # Normalize the sender, reciever id order, so we dont retrieve multiple messages for the same conversation
-                # Ex. ids (sender=5, receiver=3, related_listing=1) would retrieve a message
-                # and ids (sender=3, receiver=5, related_listing=1) would retrieve a message from same convo - which we dont want
-                # Thus the order will always be (a,b) where a<b
-                user_one=Case(
-                    When(sender__lt=F("receiver"), then=F("sender")),
-                    default=F("receiver"),
-                ),
-                user_two=Case(
-                    When(sender__lt=F("receiver"), then=F("receiver")),
-                    default=F("sender"),
-                ),
+        queryset = Message.objects.filter(Q(sender=user) | Q(receiver=user))
+        # Messages exchanged with a blocked user are hidden, whoever placed the block
+        hidden_user_ids = BlockService.hidden_user_ids(user.id)
+        if hidden_user_ids:
+            queryset = queryset.exclude(sender_id__in=hidden_user_ids).exclude(
+                receiver_id__in=hidden_user_ids
             )
-            # Group by related_related listing_id and sender_id (or reciever_id)
-            .values("related_listing", "user_one", "user_two")
-            # Save id for the newest message in each distinct group
-            .annotate(latest_message_id=Max("id"))
-            # Create a list of all the collected message ids
-            .values_list("latest_message_id", flat=True)
-        )
+        return queryset
 
-        return (
-            # Filter ids that we collected above
-            Message.objects.filter(id__in=latest_messages)
-            .select_related("sender", "receiver", "related_listing")
-            .order_by("-created_at")
+    def list(self, request, *args, **kwargs):
+        # Show most recent message for each conversation the user is part of, read from
+        # the denormalized Conversation table rather than grouping the message history
+        conversations = MessageService.get_inbox(
+            request.user, exclude_user_ids=BlockService.hidden_user_ids(request.user.id)
         )
 
+        # The inbox is a plain list unless the client asks for pages
+        paginator = None
+        if "cursor" in request.query_params or "page_size" in request.query_params:
+            paginator = InboxCursorPagination()
+            conversations = paginator.paginate_queryset(conversations, request, view=self)
+
+        messages = []
+        for conversation in conversations:
+            message = conversation.last_message
+            message.unread_count = conversation.unread_for(request.user.id)
+            message.last_read_id = conversation.last_read_for(request.user.id)
+            message.other_last_read_id = conversation.last_read_for(conversation.other_user_id(request.user.id))
+            messages.append(message)
+
+        serializer = InboxMessageSerializer(messages, many=True)
+        if paginator is not None:
+            return paginator.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
+        # The serializer has already checked that the receiver is an active user, blocks
+        # in either direction come from the cache
+        if BlockService.is_blocked_between(self.request.user.id, serializer.validated_data["receiver"].id):
+            raise PermissionDenied("You can't message this user.")
+
         # Set sender to currently authenticated user
-        serializer.save(sender=self.request.user)
+        serializer.instance = MessageService.create_message(
+            sender=self.request.user,
+            receiver=serializer.validated_data["receiver"],
+            related_listing=serializer.validated_data["related_listing"],
+            content=serializer.validated_data["content"],
+        )
 
     def update(self, request, *args, **kwargs):
         # Extract only message content from request data
@@ -69,7 +99,7 @@ class MessageViewSet(viewsets.ModelViewSet):
         if "content" not in request.data or len(request.data) > 1:
             raise PermissionDenied("Only the 'content' field can be updated.")
 
-        # Update message manually
+        # Update message manually, the object fetched here is the only lookup
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=partial_data, partial=True)
         serializer.is_valid(raise_exception=True)
@@ -79,7 +109,7 @@ class MessageViewSet(viewsets.ModelViewSet):
 
     def perform_update(self, serializer):
         # Only the sender can modify their message
-        if self.get_object().sender != self.request.user:
+        if serializer.instance.sender_id != self.request.user.id:
             raise PermissionDenied("You are not allowed to edit this message.")
 
         # Only allow updates to content field
@@ -87,16 +117,82 @@ class MessageViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Only the 'content' field can be updated.")
 
         # When message is updated, set updated to true
-        serializer.save(edited=True)
+        serializer.instance = MessageService.edit_message(
+            serializer.instance, serializer.validated_data["content"]
+        )
 
     def destroy(self, request, *args, **kwargs):
         message = self.get_object()
-        if message.sender != request.user:
+        if message.sender_id != request.user.id:
             raise PermissionDenied("You are not allowed to delete this message.")
-        return super().destroy(request, *args, **kwargs)
+        MessageService.delete_message(message)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    # Move the current user's read cursor in a conversation, to the latest message by default
+    # Body: {"conversation": 3, "up_to": 120}
+    @action(detail=False, methods=["post"], permission_classes=[IsAuthenticated])
+    def mark_read(self, request):
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        conversation = (
+            Conversation.objects.filter(MessageService.conversation_filter(request.user))
+            .filter(id=serializer.validated_data["conversation"])
+            .first()
+        )
+        if conversation is None:
+            return Response(
+                {"error": "Conversation not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        conversation = MessageService.mark_read(
+            request.user, conversation, serializer.validated_data.get("up_to")
+        )
+        return Response(
+            {
+                "conversation": conversation.id,
+                "last_read_id": conversation.last_read_for(request.user.id),
+                "unread_count": conversation.unread_for(request.user.id),
+            }
+        )
+
+    # Total unread messages for the current user, for badges
+    @action(detail=False, methods=["get"], permission_classes=[IsAuthenticated])
+    def unread_count(self, request):
+        return Response({"unread_count": MessageService.unread_count(request.user)})
+
+    # Full-text search over the current user's messages, best matches first
+    # Full url example: /messages/search/?q=bike+lock
+    @action(detail=False, methods=["get"], permission_classes=[IsAuthenticated])
+    def search(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response(
+                {"error": "q parameter is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            page_size = min(max(int(request.query_params.get("page_size", 20)), 1), 100)
+        except ValueError:
+            page_size = 20
+
+        try:
+            messages, next_cursor = search_messages(
+                request.user.id, query, page_size, request.query_params.get("cursor")
+            )
+        except ValueError:
+            return Response(
+                {"error": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        url = request.build_absolute_uri()
+        next_url = replace_query_param(url, "cursor", next_cursor) if next_cursor else None
+        serializer = MessageSearchHitSerializer(messages, many=True, context={"request": request})
+        return Response({"next": next_url, "results": serializer.data})
 
     # List messages between the current user and another user specified by user_id
     # Full url example: /messages/with_user/?user_id=1
+    # Incremental fetch: /messages/with_user/?user=1&listing=2&after_id=40
     @action(detail=False, methods=["get"], permission_classes=[IsAuthenticated])
     def with_user(self, request):
         user_id = request.query_params.get("user")
@@ -114,37 +210,204 @@ class MessageViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            other_user = User.objects.get(pk=user_id)
-        except User.DoesNotExist:
+            other_user_id, listing_id = int(user_id), int(listing_id)
+        except ValueError:
             return Response(
-                {"error": "User not found."}, status=status.HTTP_404_NOT_FOUND
+                {"error": "user and listing must be ids."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            related_listing = Listing.objects.get(pk=listing_id)
-        except Listing.DoesNotExist:
-            return Response(
-                {"error": "Listing not found."}, status=status.HTTP_404_NOT_FOUND
-            )
+        # A conversation implies the user and the listing exist, so they are only looked up
+        # when there is none
+        conversation = MessageService.get_conversation(request.user, other_user_id, listing_id)
+        if conversation is None:
+            if not User.objects.filter(pk=other_user_id).exists():
+                return Response(
+                    {"error": "User not found."}, status=status.HTTP_404_NOT_FOUND
+                )
+            if not Listing.objects.filter(pk=listing_id).exists():
+                return Response(
+                    {"error": "Listing not found."}, status=status.HTTP_404_NOT_FOUND
+                )
+        else:
+            # Opening the conversation marks it read for this user
+            MessageService.mark_read(request.user, conversation)
 
         # models.Q used for more eloborate query
         # to retrieve all messages between specified users
-        messages = Message.objects.filter(
-            models.Q(related_listing=related_listing)
-            & (
-                (models.Q(sender=self.request.user) & models.Q(receiver=other_user))
-                | (models.Q(sender=other_user) & models.Q(receiver=self.request.user))
+        thread_filter = models.Q(related_listing_id=listing_id) & (
+            (models.Q(sender=request.user) & models.Q(receiver_id=other_user_id))
+            | (models.Q(sender_id=other_user_id) & models.Q(receiver=request.user))
+        )
+
+        # ?after_id= fetches only newer messages, ?before_id= scrolls back through older ones
+        if IdCursorPagination.is_requested(request):
+            paginator = IdCursorPagination()
+            page = paginator.paginate_queryset(
+                MessageService.get_thread_directions(request.user.id, other_user_id, listing_id),
+                request,
+                view=self,
+                # Older messages may have been archived, scrolling back continues there
+                fallback=ArchiveService.get_archived_thread_directions(
+                    request.user.id, other_user_id, listing_id
+                ),
             )
-        ).order_by("-created_at")
+            serializer = self.get_serializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
 
-        # Create pagination class for this method alone
-        paginator = PageNumberPagination()
-        paginator.page_size = 25 # 25 messages at a time
+        # The archive is only read for pages past the end of the live messages
+        messages = LiveThenArchived(
+            Message.objects.filter(thread_filter).order_by("-created_at", "-id"),
+            ArchivedMessage.objects.filter(thread_filter).order_by("-created_at", "-id"),
+        )
 
+        # 25 messages at a time, without a COUNT that would have to include the archive
+        paginator = UncountedPageNumberPagination()
         page = paginator.paginate_queryset(messages, request)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return paginator.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
+
+def _other_user_id(message, user_id):
+    """The other user a realtime event payload for user_id is about, see MessageService."""
+    if "user" in message:
+        # conversation.read, the reader
+        return message["user"]
+    return message["receiver"] if message["sender"] == user_id else message["sender"]
+
+
+def _hidden_user_ids(user_id):
+    try:
+        return BlockService.hidden_user_ids(user_id)
+    finally:
+        # A cache miss reads the blocks, the stream mustn't hold on to that connection
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+class MessageStreamView(View):
+    """Server-Sent Events stream of the authenticated user's message events.
+
+    Each event is named after its type (message.created, message.edited or
+    message.deleted) and carries the serialized message as JSON. The access token is read
+    from the Authorization header or ?token=, since EventSource can't set headers. Events
+    involving users blocked either way round are dropped, as in the list views.
+
+    The stream is an async generator, so under ASGI an idle connection is a suspended
+    coroutine waiting on the broker: it holds no thread and no database connection. After
+    a reconnect, clients fill any gap with with_user?after_id=.
+    """
+
+    async def get(self, request):
+        user_id = await sync_to_async(self._authenticate)(request)
+        if user_id is None:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided or are invalid."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+
+        response = StreamingHttpResponse(self._events(user_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # Stops nginx from buffering the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def _authenticate(request):
+        try:
+            return authenticate_stream(request)
+        finally:
+            # A snapshot cache miss reads the user row, don't keep that connection open for
+            # the life of the stream
+            if not connection.in_atomic_block:
+                connection.close()
+
+    @staticmethod
+    async def _events(user_id):
+        async with get_broker().subscribe(user_channel(user_id)) as subscription:
+            yield f"retry: {settings.REALTIME_RETRY_MILLISECONDS}\n\n"
+            while True:
+                event = await subscription.get(timeout=settings.REALTIME_HEARTBEAT_SECONDS)
+                if event is None:
+                    # Comment line, keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if _other_user_id(event["message"], user_id) in await sync_to_async(_hidden_user_ids)(user_id):
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['message'])}\n\n"
+
+
+class MessageWaitView(View):
+    """Long-poll for new messages, for clients that can't keep an event stream open.
+
+    GET /api/messages/wait/?after_id=<last seen message id>&timeout=<seconds> answers as
+    soon as the user has a message newer than after_id, or with an empty list once the
+    timeout passes. Either way the client immediately asks again with the newest id it has.
+
+    Messages already waiting are read with one query, and the connection is released
+    before the view parks on the realtime broker. The wait itself is a suspended coroutine
+    that holds no database connection or worker thread and is woken by MessageService when
+    a message is created.
+    """
+
+    # New messages returned at once when the client is behind
+    MAX_MESSAGES = 100
+
+    async def get(self, request):
+        user_id = await sync_to_async(authenticate_stream)(request)
+        if user_id is None:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided or are invalid."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        try:
+            after_id = int(request.GET["after_id"])
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "after_id parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            timeout = float(request.GET.get("timeout", settings.LONG_POLL_TIMEOUT_SECONDS))
+        except ValueError:
+            timeout = settings.LONG_POLL_TIMEOUT_SECONDS
+        timeout = min(max(timeout, 0), settings.LONG_POLL_MAX_TIMEOUT_SECONDS)
+
+        # Subscribe before looking at the database so nothing created in between is missed
+        async with get_broker().subscribe(user_channel(user_id)) as subscription:
+            hidden_user_ids, messages = await sync_to_async(self._pending_messages)(user_id, after_id)
+
+            def is_new(event):
+                return (
+                    event["type"] == "message.created"
+                    and event["message"]["id"] > after_id
+                    and _other_user_id(event["message"], user_id) not in hidden_user_ids
+                )
+
+            deadline = time.monotonic() + timeout
+            while not messages and (remaining := deadline - time.monotonic()) > 0:
+                event = await subscription.get(timeout=remaining)
+                if event is not None and is_new(event):
+                    messages.append(event["message"])
+                    # Take anything else that arrived with it
+                    while (event := await subscription.get(timeout=0)) is not None:
+                        if is_new(event):
+                            messages.append(event["message"])
+
+        return JsonResponse({"results": messages})
+
+    def _pending_messages(self, user_id, after_id):
+        """(hidden user ids, serialized messages newer than after_id) for user_id."""
+        try:
+            # Blocked either way round, as in the list views
+            hidden_user_ids = BlockService.hidden_user_ids(user_id)
+            messages = Message.objects.filter(
+                Q(receiver_id=user_id) | Q(sender_id=user_id), id__gt=after_id
+            )
+            if hidden_user_ids:
+                messages = messages.exclude(sender_id__in=hidden_user_ids).exclude(
+                    receiver_id__in=hidden_user_ids
+                )
+            messages = messages.order_by("id")[: self.MAX_MESSAGES]
+            return hidden_user_ids, list(MessageSerializer(messages, many=True).data)
+        finally:
+            # Don't keep the connection open for the length of the wait
+            if not connection.in_atomic_block:
+                connection.close()
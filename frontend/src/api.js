@@ -3,7 +3,9 @@ import { ACCESS_TOKEN } from "./constants";
 
 
 const api = axios.create({
-  baseURL: import.meta.env.VITE_API_URL
+  baseURL: import.meta.env.VITE_API_URL,
+  // Sends the API's cookies cross-origin, e.g. the one keeping reads on the primary after a write
+  withCredentials: true
 });
 
 api.interceptors.request.use(